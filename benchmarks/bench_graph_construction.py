@@ -0,0 +1,90 @@
+"""Time the construction of the per-run mnitobold workflows, built or cloned from prototypes
+
+Builds the workflows of ``--n-runs`` runs spread over a few structures (with and
+without SDC, different numbers of dummy scans and outputs) twice: calling
+``init_run_wf`` for every run, as mnitobold used to, and cloning them from
+``WorkflowPrototypes``. Checks that both give the same nodes and connections.
+
+Usage: python benchmarks/bench_graph_construction.py [--n-runs 1000] [--repeat 3]
+"""
+import sys
+import time
+from argparse import ArgumentParser
+
+# (use_sdc, n_dummy, outputs) of the simulated runs, cycled over
+STRUCTURES = (
+    (False, 4, ('hmc_xform', 'mni2bold_xform', 'tsnr', 'roistats', 'grandstd')),
+    (True, 4, ('hmc_xform', 'mni2bold_xform', 'tsnr', 'roistats', 'grandstd')),
+    (False, 0, ('hmc_xform', 'mni2bold_xform', 'tsnr', 'roistats', 'grandstd')),
+    (True, 6, ('hmc_bold', 'template', 'dseg', 'scaled_bold')),
+)
+
+
+def run_arguments(n_runs, mem_gb=1.0, omp_nthreads=1):
+    """Names and ``init_run_wf`` arguments of ``n_runs`` simulated runs"""
+    for index in range(n_runs):
+        use_sdc, n_dummy, outputs = STRUCTURES[index % len(STRUCTURES)]
+        yield (f'func_preproc_task_rest_run_{index:04d}_wf',
+               dict(mem_gb=mem_gb, omp_nthreads=omp_nthreads, n_dummy=n_dummy,
+                    outputs=frozenset(outputs), use_sdc=use_sdc))
+
+
+def build_all(n_runs):
+    from comppsychflows.cli.mnitobold import init_run_wf
+
+    return [init_run_wf(name, **arguments) for name, arguments in run_arguments(n_runs)]
+
+
+def clone_all(n_runs):
+    from comppsychflows.cli.mnitobold import init_run_wf
+    from comppsychflows.workflows.prototypes import WorkflowPrototypes
+
+    prototypes = WorkflowPrototypes(init_run_wf)
+    return [prototypes.clone(name, **arguments) for name, arguments in run_arguments(n_runs)]
+
+
+def _structure(workflow):
+    """Names of the nodes and the connections of a workflow, without its name"""
+    nodes = sorted(workflow.list_node_names())
+    edges = sorted((src.fullname, dst.fullname, repr(data['connect']))
+                   for src, dst, data in workflow._graph.edges(data=True))
+    return workflow.name, nodes, edges
+
+
+def get_parser():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--n-runs', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    return parser
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    opts = get_parser().parse_args(args=args)
+
+    # Build one workflow first so that the lazy imports stay out of the timings
+    build_all(1)
+
+    timings = {}
+    workflows = {}
+    for label, func in (('build', build_all), ('clone', clone_all)):
+        times = []
+        for _ in range(opts.repeat):
+            start = time.perf_counter()
+            workflows[label] = func(opts.n_runs)
+            times.append(time.perf_counter() - start)
+        timings[label] = min(times)
+
+    mismatches = sum(_structure(built) != _structure(cloned)
+                     for built, cloned in zip(workflows['build'], workflows['clone']))
+    print(f"{opts.n_runs} runs, {len(STRUCTURES)} structures (best of {opts.repeat})")
+    for label, seconds in timings.items():
+        print(f"{label:<6} {seconds:8.3f} s {1e3 * seconds / opts.n_runs:8.2f} ms/run")
+    print(f"speedup {timings['build'] / timings['clone']:.1f}x, "
+          f"{mismatches} workflows differ")
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
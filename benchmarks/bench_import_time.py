@@ -0,0 +1,89 @@
+"""Check the import time of the CLI entry points against a budget
+
+Runs ``python -X importtime`` on each module in a fresh interpreter and reports
+its cumulative import time and the modules with the largest self time. Exits with status 1
+when a module takes longer than its budget, so it can run in CI.
+
+Usage: python benchmarks/bench_import_time.py [--budget-ms 150] [--repeat 5]
+"""
+import subprocess
+import sys
+import time
+from argparse import ArgumentParser
+
+# Modules that must stay cheap to import: they are imported before any argument
+# is parsed by every job of an array
+MODULES = (
+    'comppsychflows',
+    'comppsychflows.cli.mnitobold',
+    'comppsychflows.cli.swarm',
+    'comppsychflows.workflows.util',
+)
+
+
+def import_time(module):
+    """
+    Import ``module`` in a fresh interpreter.
+
+    Returns its cumulative import time and the self time of every module it
+    imported (both in us), leaving out the interpreter's own startup imports.
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    entries = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        entries.append((name.strip(), depth, int(self_us), int(cumulative_us)))
+    # Entries are printed once imported, so the subtree of the top-level import of
+    # module is everything after the previous top-level entry
+    end = max(idx for idx, entry in enumerate(entries) if entry[1] == 0)
+    start = max([idx + 1 for idx, entry in enumerate(entries[:end]) if entry[1] == 0],
+                default=0)
+    self_times = {name: self_us for name, _, self_us, _ in entries[start:end + 1]}
+    return entries[end][3], self_times
+
+
+def help_time(module, repeat):
+    """Best wall time (s) of ``python -m <module> --help``"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-m', module, '--help'], stdout=subprocess.DEVNULL,
+                       check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(args=None):
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--budget-ms', type=float, default=150,
+                        help="maximum cumulative import time of each module")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=5,
+                        help="number of slowest imports to show per module")
+    opts = parser.parse_args(args=args)
+
+    over_budget = []
+    for module in MODULES:
+        total_us, self_times = min((import_time(module) for _ in range(opts.repeat)),
+                                   key=lambda result: result[0])
+        total_ms = total_us / 1000
+        print(f"{module:40s} {total_ms:8.1f} ms")
+        for name, usec in sorted(self_times.items(), key=lambda item: -item[1])[:opts.top]:
+            print(f"    {name:36s} {usec / 1000:8.1f} ms (self)")
+        if total_ms > opts.budget_ms:
+            over_budget.append(module)
+
+    for module in ('comppsychflows.cli.mnitobold', 'comppsychflows.cli.swarm'):
+        print(f"python -m {module} --help: {help_time(module, opts.repeat):.2f} s")
+
+    if over_budget:
+        print(f"Over the {opts.budget_ms:g} ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Compare roi_grand_std against the pandas groupby implementation it replaced
+
+With pandas < 3, ``groupby('oseg').apply`` passed the ``oseg`` column to the
+function along with the data, so the old grand_std of each label included its
+label value among the samples. roi_grand_std leaves the label out, like the old
+code does with pandas >= 3. Both behaviours of the old code are spelled out
+below, whatever the installed pandas: the new implementation must match the
+one without the label, and its difference from the one with it is reported.
+
+Usage: python benchmarks/bench_roi_grand_std.py [--shape 78 93 78 300] [--n-labels 400]
+"""
+import os
+import time
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+
+import numpy as np
+import nibabel as nb
+import pandas as pd
+
+
+def roi_grand_std_groupby(in_file, dseg_file, out_file=None, include_label=False):
+    """roi_grand_std as it was implemented before the bincount reduction
+
+    ``include_label`` reproduces pandas < 3, where each group handed to ``apply``
+    still had its ``oseg`` column.
+    """
+    from nilearn import image as nli
+    from nilearn._utils import check_niimg_4d
+
+    n_dummy = 4
+    if out_file is None:
+        out_file = os.getcwd() + '/grand_std.csv'
+    atlaslabels = nli.load_img(dseg_file).get_fdata()
+    img_nii = check_niimg_4d(in_file, dtype="auto",)
+    func_data = nli.load_img(img_nii).get_fdata()[:, :, :, n_dummy:]
+    ntsteps = func_data.shape[-1]
+    data = func_data[atlaslabels > 0].reshape(-1, ntsteps)
+    oseg = atlaslabels[atlaslabels > 0].reshape(-1)
+    df = pd.DataFrame(data)
+    df['oseg'] = oseg
+    df['oseg'] = df.oseg.astype(int)
+    columns = list(range(ntsteps))
+    if include_label:
+        df['label'] = df.oseg
+        columns.append('label')
+    grand_stats = df.groupby('oseg')[columns].apply(
+        lambda x: pd.Series(x.values.flatten().std()))
+    grand_stats.columns = ['grand_std']
+    grand_stats.to_csv(out_file)
+    return out_file
+
+
+def make_inputs(out_dir, shape, n_labels, seed=0):
+    """Write a scaled-bold-like series and a parcellation with ``n_labels`` labels"""
+    rng = np.random.default_rng(seed)
+    bold = rng.normal(100, 5, size=shape).astype(np.float32)
+    dseg = rng.integers(0, n_labels + 1, size=shape[:3]).astype(np.int16)
+    bold_file = os.path.join(out_dir, 'bold.nii')
+    dseg_file = os.path.join(out_dir, 'dseg.nii')
+    nb.Nifti1Image(bold, np.eye(4)).to_filename(bold_file)
+    nb.Nifti1Image(dseg, np.eye(4)).to_filename(dseg_file)
+    return bold_file, dseg_file
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main(args=None):
+    from comppsychflows.cli.mnitobold import roi_grand_std
+
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=4, default=[78, 93, 78, 300],
+                        help="shape of the synthetic bold (default: 2.5mm MNI, 300 volumes)")
+    parser.add_argument('--n-labels', type=int, default=400)
+    opts = parser.parse_args(args=args)
+
+    with TemporaryDirectory() as tmpdir:
+        bold_file, dseg_file = make_inputs(tmpdir, tuple(opts.shape), opts.n_labels)
+        old_csv = os.path.join(tmpdir, 'groupby.csv')
+        labelled_csv = os.path.join(tmpdir, 'groupby_label.csv')
+        new_csv = os.path.join(tmpdir, 'bincount.csv')
+        old_time = _time(roi_grand_std_groupby, bold_file, dseg_file, old_csv)
+        roi_grand_std_groupby(bold_file, dseg_file, labelled_csv, include_label=True)
+        new_time = _time(roi_grand_std, bold_file, dseg_file, new_csv)
+
+        old = pd.read_csv(old_csv, index_col='oseg')
+        labelled = pd.read_csv(labelled_csv, index_col='oseg')
+        new = pd.read_csv(new_csv, index_col='oseg')
+        assert old.index.equals(new.index) and labelled.index.equals(new.index)
+        max_diff = np.abs(old.grand_std - new.grand_std).max()
+        label_diff = np.abs(labelled.grand_std - new.grand_std).max()
+        assert np.allclose(old.grand_std, new.grand_std, rtol=1e-10, atol=0)
+
+    print(f"shape={tuple(opts.shape)} labels={opts.n_labels}")
+    print(f"groupby:  {old_time:8.2f} s")
+    print(f"bincount: {new_time:8.2f} s  ({old_time / new_time:.1f}x faster)")
+    print(f"max abs difference in grand_std: {max_diff:.3g} "
+          f"({label_diff:.3g} from the pandas < 3 output, which includes the label)")
+
+
+if __name__ == '__main__':
+    main()
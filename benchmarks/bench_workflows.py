@@ -0,0 +1,226 @@
+"""Time every workflow builder, the stats interfaces and the full mnitobold on synthetic data
+
+Each target runs in its own process on a synthetic fmriprep-like dataset (see
+comppsychflows.utils.synthetic), so no template download or network access is
+needed. Wall time, peak RSS (of the process and the tools it runs) and bytes
+read/written (all reads and writes, and those that reached the disk) are reported.
+Targets whose tools (ANTs, AFNI, niworkflows) are missing are reported as failed.
+
+Usage: python benchmarks/bench_workflows.py [--shape 64 64 40 120] [--n-labels 400]
+           [--targets hmc_ants scale ...] [--nprocs 4] [--omp-nthreads 4] [--json out.json]
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from argparse import SUPPRESS, ArgumentParser
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+TARGETS = ('hmc_ants', 'hmc_numpy', 'backtransform', 'scale', 'getstats', 'roi_grand_std',
+           'fused_stats', 'main')
+
+
+def make_inputs(out_dir, shape, n_labels, sdc=False, seed=0):
+    """Write a synthetic dataset, template and bold space dseg; return their paths"""
+    import nibabel as nb
+    from comppsychflows.utils.fmriprep import index_runs
+    from comppsychflows.utils.synthetic import (BOLD_ZOOM, _centered_affine, make_dseg,
+                                                make_fmriprep_dataset, make_template)
+
+    fmriprep_dir = make_fmriprep_dataset(Path(out_dir) / 'fmriprep', shape=shape, sdc=sdc,
+                                         seed=seed)
+    template_file, dseg_file = make_template(Path(out_dir) / 'template', n_labels=n_labels)
+    run = index_runs(fmriprep_dir)[0]
+    bold_dseg = Path(out_dir) / 'bold_dseg.nii.gz'
+    nb.Nifti1Image(make_dseg(shape, n_labels), _centered_affine(shape, BOLD_ZOOM)).to_filename(
+        str(bold_dseg))
+    return dict(run, fmriprep_dir=fmriprep_dir, template_file=template_file,
+                dseg_file=dseg_file, bold_dseg=bold_dseg.as_posix())
+
+
+def _run_wf(workflow, work_dir, opts):
+    workflow.base_dir = work_dir
+    if opts.nprocs > 1:
+        workflow.run(plugin='MultiProc', plugin_args={'n_procs': opts.nprocs,
+                                                      'raise_insufficient': False})
+    else:
+        workflow.run(plugin='Linear')
+
+
+def bench_hmc_ants(inputs, work_dir, opts, in_memory=False):
+    from comppsychflows.workflows.util import init_apply_hmc_only_wf
+
+    workflow = init_apply_hmc_only_wf(opts.mem_gb, opts.omp_nthreads, split_file=True,
+                                      in_memory=in_memory)
+    workflow.inputs.inputnode.bold_file = inputs['bold_file']
+    workflow.inputs.inputnode.name_source = inputs['bold_file']
+    workflow.inputs.inputnode.hmc_xforms = inputs['hmc_transform']
+    _run_wf(workflow, work_dir, opts)
+
+
+def bench_hmc_numpy(inputs, work_dir, opts):
+    bench_hmc_ants(inputs, work_dir, opts, in_memory=True)
+
+
+def bench_backtransform(inputs, work_dir, opts):
+    from comppsychflows.workflows.util import init_backtransform_wf
+
+    workflow = init_backtransform_wf(opts.mem_gb, opts.omp_nthreads,
+                                     stats_engine=opts.stats_engine,
+                                     outputs=['combined_transforms', 'transformed_template',
+                                              'transformed_dseg'])
+    workflow.inputs.inputnode.template_file = inputs['template_file']
+    workflow.inputs.inputnode.dseg_file = inputs['dseg_file']
+    workflow.inputs.inputnode.reference_image = inputs['ref']
+    workflow.inputs.inputnode.transforms = [inputs['mni_to_t1'], inputs['t1_to_bold']]
+    _run_wf(workflow, work_dir, opts)
+
+
+def bench_scale(inputs, work_dir, opts):
+    from comppsychflows.workflows.util import init_scale_wf
+
+    workflow = init_scale_wf(opts.mem_gb, opts.omp_nthreads, n_dummy=4)
+    workflow.inputs.inputnode.bold_file = inputs['bold_file']
+    _run_wf(workflow, work_dir, opts)
+
+
+def bench_getstats(inputs, work_dir, opts):
+    from comppsychflows.workflows.util import init_getstats_wf
+
+    workflow = init_getstats_wf(opts.mem_gb, opts.omp_nthreads, n_dummy=4,
+                                stats_engine=opts.stats_engine)
+    workflow.inputs.inputnode.bold_file = inputs['bold_file']
+    workflow.inputs.inputnode.dseg_file = inputs['bold_dseg']
+    _run_wf(workflow, work_dir, opts)
+
+
+def bench_roi_grand_std(inputs, work_dir, opts):
+    from comppsychflows.cli.mnitobold import roi_grand_std
+
+    os.makedirs(work_dir, exist_ok=True)
+    roi_grand_std(inputs['bold_file'], inputs['bold_dseg'],
+                  os.path.join(work_dir, 'grand_std.csv'), mem_gb=opts.stream_mem_gb)
+
+
+def bench_fused_stats(inputs, work_dir, opts):
+    from comppsychflows.interfaces.stats import FusedBoldStats
+
+    os.makedirs(work_dir, exist_ok=True)
+    os.chdir(work_dir)
+    FusedBoldStats(in_file=inputs['bold_file'], dseg_file=inputs['bold_dseg'],
+                   n_dummy=4).run()
+
+
+def bench_main(inputs, work_dir, opts):
+    from comppsychflows.cli.mnitobold import main
+
+    main([inputs['fmriprep_dir'], work_dir, inputs['template_file'], inputs['dseg_file'],
+          '--nprocs', str(opts.nprocs), '--omp-nthreads', str(opts.omp_nthreads),
+          '--node-mem-gb', str(opts.mem_gb), '--stats-engine', opts.stats_engine,
+          '--plugin', 'MultiProc' if opts.nprocs > 1 else 'Linear',
+          '--index-file', os.path.join(work_dir, 'index.json')])
+
+
+def _io_counters():
+    """Bytes read and written by this process and its reaped children (Linux only)"""
+    try:
+        with open('/proc/self/io') as fobj:
+            counters = dict(line.split(': ') for line in fobj.read().splitlines())
+    except OSError:
+        return {}
+    return {key: int(value) for key, value in counters.items()}
+
+
+def run_target(target, inputs, work_dir, opts):
+    """Run one target in this process and return its measurements"""
+    io_before = _io_counters()
+    start = time.perf_counter()
+    globals()['bench_' + target](inputs, work_dir, opts)
+    wall = time.perf_counter() - start
+    io_after = _io_counters()
+    # ru_maxrss is in kB on Linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+    result = {'target': target, 'wall_s': wall, 'peak_rss_mb': peak_rss}
+    for key, name in (('rchar', 'read_mb'), ('wchar', 'written_mb'),
+                      ('read_bytes', 'disk_read_mb'), ('write_bytes', 'disk_written_mb')):
+        if key in io_after:
+            result[name] = (io_after[key] - io_before[key]) / 1024 ** 2
+    return result
+
+
+def get_parser():
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('--shape', type=int, nargs=4, default=[64, 64, 40, 120],
+                        help="shape of the synthetic bold (3mm voxels)")
+    parser.add_argument('--n-labels', type=int, default=400)
+    parser.add_argument('--sdc', action='store_true', help="include a Qwarp SDC warp")
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=list(TARGETS))
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--nprocs', type=int, default=1)
+    parser.add_argument('--omp-nthreads', type=int, default=1)
+    parser.add_argument('--mem-gb', type=float, default=1.0)
+    parser.add_argument('--stream-mem-gb', type=float, default=1.0)
+    parser.add_argument('--stats-engine', choices=['afni', 'numpy'], default='afni')
+    parser.add_argument('--json', help="also write the measurements to this file")
+    # Internal: run a single target in a child process
+    parser.add_argument('--run-target', help=SUPPRESS)
+    parser.add_argument('--inputs', help=SUPPRESS)
+    parser.add_argument('--work-dir', help=SUPPRESS)
+    parser.add_argument('--result', help=SUPPRESS)
+    return parser
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
+    opts = get_parser().parse_args(args=args)
+
+    if opts.run_target:
+        inputs = json.loads(Path(opts.inputs).read_text())
+        result = run_target(opts.run_target, inputs, opts.work_dir, opts)
+        Path(opts.result).write_text(json.dumps(result))
+        return
+
+    results = []
+    with TemporaryDirectory() as tmpdir:
+        inputs = make_inputs(os.path.join(tmpdir, 'inputs'), tuple(opts.shape), opts.n_labels,
+                             sdc=opts.sdc)
+        inputs_file = os.path.join(tmpdir, 'inputs.json')
+        Path(inputs_file).write_text(json.dumps(inputs))
+        print(f"shape={tuple(opts.shape)} labels={opts.n_labels} sdc={opts.sdc} "
+              f"nprocs={opts.nprocs} omp_nthreads={opts.omp_nthreads}")
+        print(f"{'target':<14} {'wall s':>8} {'peak MB':>8} {'read MB':>8} "
+              f"{'write MB':>8} {'disk r':>8} {'disk w':>8}")
+        for target in opts.targets:
+            for rep in range(opts.repeat):
+                work_dir = os.path.join(tmpdir, 'work', f'{target}_{rep}')
+                result_file = os.path.join(tmpdir, f'{target}_{rep}.json')
+                # A fresh process per target so that peak RSS and I/O are its own
+                proc = subprocess.run(
+                    [sys.executable, __file__] + args + [
+                        '--run-target', target, '--inputs', inputs_file,
+                        '--work-dir', work_dir, '--result', result_file],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+                if proc.returncode:
+                    error = (proc.stderr.strip().splitlines() or ['failed'])[-1]
+                    results.append({'target': target, 'error': error})
+                    print(f"{target:<14} failed: {error}")
+                    break
+                result = json.loads(Path(result_file).read_text())
+                results.append(result)
+                print(f"{target:<14} {result['wall_s']:8.2f} {result['peak_rss_mb']:8.0f} "
+                      + ' '.join(f"{result.get(key, float('nan')):8.1f}" for key in (
+                          'read_mb', 'written_mb', 'disk_read_mb', 'disk_written_mb')))
+
+    if opts.json:
+        Path(opts.json).write_text(json.dumps({'options': {
+            key: value for key, value in vars(opts).items()
+            if key not in ('json', 'run_target', 'inputs', 'work_dir', 'result')},
+            'results': results}, indent=1))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 """CompPsych Workflows (comppsychflows) is a selection of image processing workflows."""
 import logging
+import os
 
 from .__about__ import __version__, __packagename__, __credits__
 
@@ -15,12 +16,5 @@ __all__ = [
 COMPPSYCHFLOWS_LOG = logging.getLogger(__packagename__)
 COMPPSYCHFLOWS_LOG.setLevel(logging.INFO)
 
-try:
-    import matplotlib
-
-    matplotlib.use("Agg")
-except ImportError:
-    pass
-from ._version import get_versions
-__version__ = get_versions()['version']
-del get_versions
+# Select the non-interactive backend without paying for importing matplotlib
+os.environ.setdefault("MPLBACKEND", "Agg")
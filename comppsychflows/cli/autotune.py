@@ -0,0 +1,247 @@
+"""Calibrate the mnitobold steps on this node and recommend the threads of each node
+
+Short calibration runs of the head motion correction (MultiApplyTransforms),
+the back transformation of the template and dseg (ApplyTransforms) and the
+stats are timed on synthetic data with the geometry of the dataset's bold
+series. Each step is timed with every candidate number of threads, running
+as many copies at once as fill the CPUs. A model of the time of each step
+against its threads is fitted and written to a tuning file, which
+comppsychflows-mnitobold --tuning-file uses to pick --omp-nthreads for the
+runs it is given.
+"""
+import os
+
+
+def get_parser():
+    """Build parser object."""
+    from argparse import SUPPRESS, ArgumentParser, RawTextHelpFormatter
+
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    parser.add_argument("out_file", action="store",
+                        help="tuning file to write (json)")
+    parser.add_argument("--fmriprep-dir", action="store",
+                        help="fmriprep directory whose most common bold geometry and number "
+                             "of runs are calibrated for")
+    parser.add_argument("--index-file", action="store", default=None,
+                        help="Run index of --fmriprep-dir shared with comppsychflows-mnitobold")
+    parser.add_argument("--shape", action="store", type=int, nargs=4,
+                        metavar=('X', 'Y', 'Z', 'VOLS'), default=[64, 64, 40, 300],
+                        help="bold geometry when there is no --fmriprep-dir")
+    parser.add_argument("--dseg-path", action="store",
+                        help="segmentation whose grid and number of labels the synthetic one "
+                             "matches (default: --template-shape and --n-labels)")
+    parser.add_argument("--template-shape", action="store", type=int, nargs=3,
+                        default=[80, 96, 80])
+    parser.add_argument("--n-labels", action="store", type=int, default=400)
+    parser.add_argument("--nprocs", action="store", type=int, default=None,
+                        help="CPUs to calibrate with (default: the CPUs granted to the job)")
+    parser.add_argument("--threads", action="store", type=int, nargs="+",
+                        help="threads per node to time (default: powers of two up to "
+                             "--nprocs, and --nprocs)")
+    parser.add_argument("--calibration-vols", action="store", type=int, default=16,
+                        help="Volumes of the synthetic bold; the time of the steps that "
+                             "process every volume is scaled to the dataset's")
+    parser.add_argument("--hmc-engine", action="store", choices=["ants", "numpy"],
+                        default="ants")
+    parser.add_argument("--stats-engine", action="store", choices=["afni", "numpy"],
+                        default="afni")
+    parser.add_argument("--work-dir", action="store",
+                        help="Directory of the synthetic data and calibration runs "
+                             "(default: a temporary directory)")
+    # Internal: time a single step in a child process
+    parser.add_argument("--run-step", help=SUPPRESS)
+    parser.add_argument("--inputs", help=SUPPRESS)
+    parser.add_argument("--step-dir", help=SUPPRESS)
+    parser.add_argument("--step-threads", type=int, help=SUPPRESS)
+    return parser
+
+
+def _init_step_wf(step, inputs, n_threads, opts):
+    """Workflow of a calibrated step and its inputs"""
+    from comppsychflows.workflows.util import (init_apply_hmc_only_wf, init_backtransform_wf,
+                                               init_getstats_wf)
+
+    if step == 'hmc':
+        workflow = init_apply_hmc_only_wf(1.0, n_threads, split_file=True,
+                                          in_memory=opts.hmc_engine == 'numpy')
+        workflow.inputs.inputnode.bold_file = inputs['bold_file']
+        workflow.inputs.inputnode.name_source = inputs['bold_file']
+        workflow.inputs.inputnode.hmc_xforms = inputs['hmc_transform']
+    elif step == 'backtransform':
+        workflow = init_backtransform_wf(1.0, n_threads, stats_engine=opts.stats_engine,
+                                         outputs=['combined_transforms', 'transformed_template',
+                                                  'transformed_dseg'])
+        workflow.inputs.inputnode.template_file = inputs['template_file']
+        workflow.inputs.inputnode.dseg_file = inputs['dseg_file']
+        workflow.inputs.inputnode.reference_image = inputs['ref']
+        workflow.inputs.inputnode.transforms = [inputs['mni_to_t1'], inputs['t1_to_bold']]
+    else:
+        workflow = init_getstats_wf(1.0, n_threads, n_dummy=0, stats_engine=opts.stats_engine)
+        workflow.inputs.inputnode.bold_file = inputs['bold_file']
+        workflow.inputs.inputnode.dseg_file = inputs['bold_dseg']
+    return workflow
+
+
+def run_step(step, inputs, step_dir, n_threads, opts):
+    """Run a step with ``n_threads`` threads per node; return its wall time in seconds"""
+    import time
+    from comppsychflows.utils.limits import limit_node_threads
+
+    workflow = _init_step_wf(step, inputs, n_threads, opts)
+    limit_node_threads(workflow, n_threads)
+    workflow.base_dir = step_dir
+    start = time.perf_counter()
+    workflow.run(plugin='Linear')
+    return time.perf_counter() - start
+
+
+def make_inputs(out_dir, shape, template_shape, n_labels):
+    """Write a synthetic run, template and bold space dseg; return their paths"""
+    from pathlib import Path
+    import nibabel as nb
+    from comppsychflows.utils.fmriprep import index_runs
+    from comppsychflows.utils.synthetic import (BOLD_ZOOM, _centered_affine, make_dseg,
+                                                make_fmriprep_dataset, make_template)
+
+    fmriprep_dir = make_fmriprep_dataset(Path(out_dir) / 'fmriprep', shape=shape,
+                                         template_shape=template_shape)
+    template_file, dseg_file = make_template(Path(out_dir) / 'template',
+                                             shape=template_shape, n_labels=n_labels)
+    run = index_runs(fmriprep_dir)[0]
+    bold_dseg = Path(out_dir) / 'bold_dseg.nii.gz'
+    nb.Nifti1Image(make_dseg(shape[:3], n_labels),
+                   _centered_affine(shape[:3], BOLD_ZOOM)).to_filename(str(bold_dseg))
+    return dict(run, template_file=template_file, dseg_file=dseg_file,
+                bold_dseg=bold_dseg.as_posix())
+
+
+def calibrate(inputs_file, work_dir, steps, threads, n_cpus, args):
+    """
+    Time every step with every number of threads, filling the CPUs with copies of it.
+
+    Returns
+    -------
+    measurements : :obj:`list` of :obj:`dict`
+        ``step``, ``threads``, number of ``concurrent`` copies and the median
+        wall time in ``seconds`` of a copy (``None`` when the step failed)
+
+    """
+    import json
+    import subprocess
+    import sys
+    from pathlib import Path
+    from statistics import median
+    from comppsychflows import COMPPSYCHFLOWS_LOG
+
+    measurements = []
+    for step in steps:
+        for n_threads in threads:
+            concurrent = max(1, n_cpus // n_threads)
+            step_dirs = [Path(work_dir) / 'calibration' / ('%s_%d_%d' % (step, n_threads, copy))
+                         for copy in range(concurrent)]
+            procs = [subprocess.Popen(
+                [sys.executable, '-m', 'comppsychflows.cli.autotune'] + args + [
+                    '--run-step', step, '--inputs', str(inputs_file),
+                    '--step-dir', str(step_dir), '--step-threads', str(n_threads)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for step_dir in step_dirs]
+            seconds = []
+            for proc, step_dir in zip(procs, step_dirs):
+                if proc.wait() == 0:
+                    seconds.append(json.loads((step_dir / 'seconds.json').read_text()))
+            measurement = {'step': step, 'threads': n_threads, 'concurrent': concurrent,
+                           'seconds': median(seconds) if len(seconds) == concurrent else None}
+            measurements.append(measurement)
+            if measurement['seconds'] is None:
+                COMPPSYCHFLOWS_LOG.warning('Calibration of %s with %d threads failed',
+                                           step, n_threads)
+                break
+            COMPPSYCHFLOWS_LOG.info('%s: %d x %d threads, %.1f s', step, concurrent,
+                                    n_threads, measurement['seconds'])
+    return measurements
+
+
+def main(args=None):
+    """Entry point."""
+    import json
+    import sys
+    from pathlib import Path
+    from tempfile import TemporaryDirectory
+    from comppsychflows import COMPPSYCHFLOWS_LOG
+    from comppsychflows.utils.autotune import STEPS, fit_step, recommend, typical_shape
+    from comppsychflows.utils.limits import available_cpus
+
+    args = list(sys.argv[1:] if args is None else args)
+    opts = get_parser().parse_args(args=args)
+
+    if opts.run_step:
+        inputs = json.loads(Path(opts.inputs).read_text())
+        os.makedirs(opts.step_dir, exist_ok=True)
+        seconds = run_step(opts.run_step, inputs, opts.step_dir, opts.step_threads, opts)
+        Path(opts.step_dir, 'seconds.json').write_text(json.dumps(seconds))
+        return
+
+    shape, n_runs = tuple(opts.shape), None
+    if opts.fmriprep_dir:
+        from comppsychflows.utils.fmriprep import index_runs
+
+        runs = [run for run in index_runs(opts.fmriprep_dir, index_file=opts.index_file)
+                if run['bold_file'] is not None]
+        shape, n_runs = typical_shape(runs) or shape, len(runs)
+    template_shape, n_labels = tuple(opts.template_shape), opts.n_labels
+    if opts.dseg_path:
+        import nibabel as nb
+        import numpy as np
+
+        dseg = nb.load(opts.dseg_path)
+        template_shape = dseg.shape[:3]
+        n_labels = int(np.count_nonzero(np.unique(np.asanyarray(dseg.dataobj))))
+
+    n_cpus = opts.nprocs or available_cpus()
+    threads = sorted(set(opts.threads or [
+        2 ** power for power in range(n_cpus.bit_length()) if 2 ** power <= n_cpus] + [n_cpus]))
+    threads = [n_threads for n_threads in threads if 0 < n_threads <= n_cpus]
+    calibration_shape = tuple(shape[:3]) + (min(opts.calibration_vols, shape[3]),)
+
+    with TemporaryDirectory(dir=opts.work_dir) as work_dir:
+        COMPPSYCHFLOWS_LOG.info('Calibrating on %s bold, %s dseg with %d labels, %d CPUs',
+                                calibration_shape, template_shape, n_labels, n_cpus)
+        inputs_file = Path(work_dir) / 'inputs.json'
+        inputs_file.write_text(json.dumps(make_inputs(
+            Path(work_dir) / 'inputs', calibration_shape, template_shape, n_labels)))
+        # The children need the options that select the engines
+        child_args = ['--hmc-engine', opts.hmc_engine, '--stats-engine', opts.stats_engine,
+                      opts.out_file]
+        measurements = calibrate(inputs_file, work_dir, list(STEPS), threads, n_cpus,
+                                 child_args)
+
+    steps = {}
+    for step in STEPS:
+        timed = [item for item in measurements
+                 if item['step'] == step and item['seconds'] is not None]
+        if timed:
+            steps[step] = fit_step([item['threads'] for item in timed],
+                                   [item['seconds'] for item in timed])
+    if not steps:
+        COMPPSYCHFLOWS_LOG.error('Every calibration run failed, is ANTs/AFNI/FSL available?')
+        sys.exit(1)
+
+    tuning = {'n_cpus': n_cpus, 'shape': list(shape), 'calibration_vols': calibration_shape[3],
+              'template_shape': list(template_shape), 'n_labels': n_labels,
+              'hmc_engine': opts.hmc_engine, 'stats_engine': opts.stats_engine,
+              'steps': steps, 'measurements': measurements}
+    # For the whole dataset in one job, or a single run when there is no dataset
+    tuning['recommended'] = dict(recommend(tuning, n_cpus, n_runs or 1, shape[3]),
+                                 n_runs=n_runs or 1)
+    os.makedirs(os.path.dirname(os.path.abspath(opts.out_file)), exist_ok=True)
+    Path(opts.out_file).write_text(json.dumps(tuning, indent=1))
+    print('%d runs on %d CPUs: --omp-nthreads %d (%d concurrent runs, ~%.0f s of '
+          'calibrated steps)' % (tuning['recommended']['n_runs'], n_cpus,
+                                 tuning['recommended']['omp_nthreads'],
+                                 tuning['recommended']['concurrent_runs'],
+                                 tuning['recommended']['predicted_s']))
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    main(args=argv[1:])
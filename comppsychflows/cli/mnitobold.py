@@ -1,6 +1,39 @@
 """Run the mni to bold transformation on an fmriprep output"""
 import os
 
+from comppsychflows.workflows.prototypes import WorkflowPrototypes
+
+# Outputs that can be requested with --outputs, and the ones written by default
+OUTPUTS = ('hmc_xform', 'hmc_bold', 'mni2bold_xform', 'template', 'dseg',
+           'scaled_bold', 'tsnr', 'tsnr_roistats', 'roistats', 'grandstd', 'scaled_std')
+DEFAULT_OUTPUTS = OUTPUTS[:-1]
+# Outputs derived from the head motion corrected bold and the bold space dseg
+STAT_OUTPUTS = {'scaled_bold', 'tsnr', 'tsnr_roistats', 'roistats', 'grandstd', 'scaled_std'}
+
+
+def _output_list(value):
+    """Parse a comma separated list of outputs"""
+    from argparse import ArgumentTypeError
+
+    outputs = {output.strip() for output in value.split(',') if output.strip()}
+    unknown = outputs.difference(OUTPUTS)
+    if unknown:
+        raise ArgumentTypeError('unknown outputs %s (choose from %s)' % (
+            ', '.join(sorted(unknown)), ', '.join(OUTPUTS)))
+    return outputs
+
+
+def _shard(value):
+    """Parse an i/N shard for argparse"""
+    from argparse import ArgumentTypeError
+    from comppsychflows.utils.scheduling import parse_shard
+
+    try:
+        return parse_shard(value)
+    except ValueError as err:
+        raise ArgumentTypeError(str(err))
+
+
 def get_parser():
     """Build parser object."""
     from argparse import ArgumentParser
@@ -25,43 +58,210 @@ def get_parser():
         "--omp-nthreads",
         action="store",
         type=int,
-        default=os.cpu_count(),
-        help="Number of CPUs available to individual processes",
+        default=None,
+        help="Number of CPUs available to individual processes (default: the CPUs of "
+             "the job divided among the runs it processes concurrently)",
     )
     parser.add_argument(
         "--mem-gb",
         action="store",
+        type=float,
+        default=None,
+        help="Memory in GB of the whole job, shared by the nodes that run at once: a node "
+             "only starts when its estimated peak fits in what the running nodes leave "
+             "(default: 90%% of the memory limit of the job's cgroup, or of the node); "
+             "in a slurm job, $((SLURM_MEM_PER_NODE / 1024)) is its memory in GB",
+    )
+    parser.add_argument(
+        "--node-mem-gb",
+        action="store",
+        type=float,
+        default=1.0,
+        help="Memory in GB of each node with --no-resource-estimation, and of the nodes "
+             "whose memory is not estimated",
+    )
+    parser.add_argument(
+        "--nprocs",
+        action="store",
         type=int,
-        default=1,
-        help="Gigs of ram avialable"
+        default=None,
+        help="Maximum number of processes used to run all func runs concurrently "
+             "(default: the CPUs granted to the job by its affinity mask and cgroup quota)",
+    )
+    parser.add_argument(
+        "--tuning-file",
+        action="store",
+        default=None,
+        help="Tuning file written by comppsychflows-autotune; without --omp-nthreads, the "
+             "threads per node that process the runs of this job the fastest are picked "
+             "from its calibration (ignored when it was calibrated on another number of "
+             "CPUs, or with other --hmc-engine or --stats-engine)",
+    )
+    parser.add_argument(
+        "--plugin",
+        action="store",
+        default="MultiProc",
+        help="Nipype execution plugin for the combined workflow (e.g. MultiProc, Linear)",
+    )
+    parser.add_argument(
+        "--stream-mem-gb",
+        action="store",
+        type=float,
+        default=1.0,
+        help="Memory budget in GB of nodes that stream the bold a few volumes at a time "
+             "(e.g. the roi grand std)",
+    )
+    parser.add_argument(
+        "--hmc-engine",
+        action="store",
+        choices=["ants", "numpy"],
+        default="ants",
+        help="Apply head motion correction by splitting the bold and running "
+             "antsApplyTransforms on each volume (ants) or by resampling the whole "
+             "series in memory with cubic splines (numpy)",
+    )
+    parser.add_argument(
+        "--reuse-split",
+        action="store_true",
+        default=False,
+        help="Apply head motion correction to the volumes fmriprep already split into "
+             "bold_split instead of splitting the bold again (only with --hmc-engine ants, "
+             "and only when their number and geometry match the bold)",
+    )
+    parser.add_argument(
+        "--stats-engine",
+        action="store",
+        choices=["afni", "numpy"],
+        default="afni",
+        help="Compute the scaled bold, tsnr and roi statistics with the chain of AFNI "
+             "nodes (afni) or with a single numpy node that reads the HMC bold once and "
+             "sparse label matrix roi stats (numpy)",
+    )
+    parser.add_argument(
+        "--intermediate-format",
+        action="store",
+        choices=["nii.gz", "nii"],
+        default="nii.gz",
+        help="Format of the images written to the working directory. With nii the "
+             "intermediates are left uncompressed and only the images sent to the "
+             "output directory are gzipped",
+    )
+    parser.add_argument(
+        "--share-t1w-resampling",
+        action="store_true",
+        default=False,
+        help="Resample the mni image and dseg into each subject's T1w space once and "
+             "only apply the T1w to bold (and SDC) transforms per run, instead of "
+             "resampling from MNI space for every run",
+    )
+    parser.add_argument(
+        "--outputs",
+        action="store",
+        type=_output_list,
+        default=set(DEFAULT_OUTPUTS),
+        help="Comma separated list of outputs to write; only the nodes they need are "
+             "run (default: %s; also available: scaled_std)" % ','.join(DEFAULT_OUTPUTS),
+    )
+    parser.add_argument(
+        "--participant-label",
+        action="store",
+        nargs="+",
+        help="Only process these participants (with or without the sub- prefix)",
+    )
+    parser.add_argument(
+        "--run-filter",
+        action="store",
+        help="Only process runs whose bold file or fmriprep func working directory "
+             "name matches this regular expression",
+    )
+    parser.add_argument(
+        "--shard",
+        action="store",
+        type=_shard,
+        help="Only process shard i/N (zero-based, e.g. $SLURM_ARRAY_TASK_ID/100) of the "
+             "selected runs. Runs are balanced across shards by their voxels x volumes",
+    )
+    parser.add_argument(
+        "--index-file",
+        action="store",
+        default=None,
+        help="JSON index of the inputs of every run, refreshed incrementally on each call "
+             "(default: <out_path>/mnitobold_index.json)",
+    )
+    parser.add_argument(
+        "--refresh-index",
+        action="store_true",
+        default=False,
+        help="Probe every run again instead of reusing the unchanged runs of the index",
+    )
+    parser.add_argument(
+        "--probe-threads",
+        action="store",
+        type=int,
+        default=16,
+        help="Number of concurrent filesystem probes used to find the inputs of each run",
+    )
+    parser.add_argument(
+        "--rerun-completed",
+        action="store_true",
+        default=False,
+        help="Rebuild runs even if their manifest shows they completed with the same "
+             "inputs and parameters",
+    )
+    parser.add_argument(
+        "--refresh-environment",
+        action="store_true",
+        default=False,
+        help="Probe the AFNI, ANTs and FSL versions again instead of reading them from "
+             "the cache ($COMPPSYCHFLOWS_ENV_CACHE or ~/.cache/comppsychflows)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Monitor the wall time, CPU time, peak memory and file I/O of every node and "
+             "write a report per run and a summary of the dataset to "
+             "<out_path>/profile/<date>-<time>_<pid> (needs psutil for CPU and memory)",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        default=False,
+        help="Write the timeline of the execution as a Chrome trace (trace.json in the "
+             "profile directory) to open in chrome://tracing or ui.perfetto.dev: one track "
+             "per worker with a span per node, and one track per run",
+    )
+    parser.add_argument(
+        "--no-resource-estimation",
+        action="store_false",
+        dest="estimate_resources",
+        help="Use --node-mem-gb and --omp-nthreads for every node instead of estimating "
+             "each node's memory and threads from the bold header",
     )
 
     return parser
 
 
 # Get the grand mean std
-def roi_grand_std(in_file, dseg_file, out_file=None):
-    from nilearn import image as nli
-    from nilearn._utils.niimg import _safe_get_data
-    from nilearn._utils import check_niimg_4d
-    import pandas as pd
+def roi_grand_std(in_file, dseg_file, out_file=None, n_dummy=4, mem_gb=1.0):
+    import nibabel as nb
+    import numpy as np
+    from comppsychflows.utils.images import iter_volume_chunks
+    from comppsychflows.utils.stats import combine_moments, label_moments, grand_std_table
     import os
-    
-    n_dummy=4
+
     if out_file is None:
         out_file = os.getcwd() + '/grand_std.csv'
-    atlaslabels = nli.load_img(dseg_file).get_fdata()
-    img_nii = check_niimg_4d(in_file, dtype="auto",)
-    func_data = nli.load_img(img_nii).get_fdata()[:,:,:,n_dummy:]
-    ntsteps = func_data.shape[-1]
-    data = func_data[atlaslabels > 0].reshape(-1, ntsteps)
-    oseg = atlaslabels[atlaslabels > 0].reshape(-1)
-    df = pd.DataFrame(data)
-    df['oseg'] = oseg
-    df['oseg'] = df.oseg.astype(int)
-    grand_stats = df.groupby('oseg').apply(lambda x: pd.Series(x.values.flatten().std()))
-    grand_stats.columns = ['grand_std']
-    grand_stats.to_csv( out_file)
+    atlaslabels = np.asanyarray(nb.load(dseg_file).dataobj).reshape(-1, order='F')
+    inmask = atlaslabels > 0
+    oseg = atlaslabels[inmask].astype(int)
+    # Accumulate label-indexed moments a few volumes at a time so that peak memory
+    # stays within mem_gb regardless of the length of the run
+    moments = (np.zeros(0),) * 3
+    for chunk in iter_volume_chunks(in_file, mem_gb=mem_gb, start=n_dummy):
+        moments = combine_moments(moments, label_moments(chunk[inmask], oseg))
+    grand_stats = grand_std_table(moments[0], moments[2])
+    grand_stats.to_csv(out_file)
     return out_file
 
 # hack to get the hmc_transform path
@@ -74,163 +274,430 @@ def copyfile(in_file):
     copyfile(in_file, out_file)
     return  out_file
 
-def main(args=None):
-    """Entry point."""
-    import re
-    import json
-    from pathlib import Path
+def _backtransform_outputs(outputs):
+    """outputnode fields of the backtransform workflow the requested outputs depend on"""
+    fields = [field for output, field in (
+        ('mni2bold_xform', 'combined_transforms'), ('template', 'transformed_template'),
+        ('dseg', 'transformed_dseg')) if output in outputs]
+    if outputs & STAT_OUTPUTS and 'transformed_dseg' not in fields:
+        fields.append('transformed_dseg')
+    return fields
+
+
+def sink_substitutions(bold_basename):
+    """Substitutions that give the sunk outputs of a run their bids-like names"""
+    return [('hmcxform_copymat2itk.txt', bold_basename + 'desc-hmc_xform.txt'),
+            ('MNItohmcbold.nii.gz', bold_basename + 'desc-MNItohmc_xform.nii.gz'),
+            ('vol0000_xform-00000_merged_calc.nii.gz', bold_basename + 'desc-hmcscaled_bold.nii.gz'),
+            ('vol0000_xform-00000_merged.nii.gz', bold_basename + 'desc-hmc_bold.nii.gz'),
+            ('vol0000_xform-00000_merged_tstat.nii.gz', bold_basename + 'desc-hmc_tsnr.nii.gz'),
+            ('vol0000_xform-00000_merged_calc_tstat.nii.gz', bold_basename + 'desc-hmcscaled_std.nii.gz'),
+            ('vol0000_xform-00000_merged_tstat_roistat.1D', bold_basename + 'desc-hmc_roistats.1D'),
+            ('vol0000_xform-00000_merged_calc_roistat.1D', bold_basename + 'desc-hmcscaled_roistats.1D'),
+            ('grand_std.csv', bold_basename + 'desc-hmcscaled_grandstd.1D')]
+
+
+def init_run_wf(name, mem_gb, omp_nthreads, n_dummy, outputs, use_sdc=False, share_t1w=False,
+                reuse_split=False, hmc_engine='ants', stats_engine='afni', use_compression=True,
+                stream_mem_gb=1.0):
+    """
+    Build the mnitobold workflow of a run.
+
+    Only the structure of the workflow is set here; the values of ``inputnode``,
+    the ``base_directory`` and ``substitutions`` (see :func:`sink_substitutions`)
+    of ``sinker``, and the ``manifest_file``, ``inputs`` and ``parameters`` of
+    ``manifest`` are set per run, so that runs with the same arguments can share a
+    prototype (see :class:`~comppsychflows.workflows.prototypes.WorkflowPrototypes`).
+
+    Parameters
+    ----------
+    name : :obj:`str`
+        Name of the workflow (the name of the fmriprep func working directory)
+    mem_gb : :obj:`float`
+        Memory of each node (before resource estimation)
+    omp_nthreads : :obj:`int`
+        Maximum number of threads an individual process may use
+    n_dummy : :obj:`int`
+        Number of dummy scans
+    outputs : :obj:`set`
+        Outputs to sink (see ``OUTPUTS``)
+    use_sdc : :obj:`bool`
+        Invert the Qwarp warp of the run and apply it
+    share_t1w : :obj:`bool`
+        The template and dseg come in T1w space through ``inputnode.t1w_template``
+        and ``inputnode.t1w_dseg``
+    reuse_split : :obj:`bool`
+        ``inputnode.split_bolds`` stand in for the bold
+    hmc_engine, stats_engine : :obj:`str`
+        See ``--hmc-engine`` and ``--stats-engine``
+    use_compression : :obj:`bool`
+        Write intermediates as ``.nii.gz``
+    stream_mem_gb : :obj:`float`
+        Memory budget of the roi grand std
+
+    Returns
+    -------
+    workflow : :obj:`~niworkflows.engine.workflows.LiterateWorkflow`
+
+    """
     from niworkflows.engine.workflows import LiterateWorkflow as Workflow
     from nipype import Function
     from nipype.pipeline import engine as pe
     from nipype.interfaces import utility as niu
-    from nipype.utils.filemanip import hash_infile
+    from nipype.interfaces.afni.preprocess import ROIStats
+    from nipype.interfaces.io import DataSink
     from comppsychflows.workflows.util import init_qwarp_inversion_wf
     from comppsychflows.workflows.util import init_apply_hmc_only_wf
     from comppsychflows.workflows.util import init_backtransform_wf
     from comppsychflows.workflows.util import init_scale_wf
     from comppsychflows.workflows.util import init_getstats_wf
-    from nipype.interfaces.afni.preprocess import ROIStats
-    from nipype.interfaces.io import DataSink
+    from comppsychflows.interfaces.stats import FusedBoldStats
+    from comppsychflows.interfaces.utility import CompressImage
+    from comppsychflows.utils.manifest import write_manifest
+
+    backtransform_outputs = _backtransform_outputs(outputs)
+
+    workflow = Workflow(name=name)
+
+    inputnode = pe.Node(niu.IdentityInterface(
+        fields=['sdc', 'ref', 'hmc_transform',
+                'mni_to_t1', 't1_to_bold',
+                'mni_image', 'dseg', 'bold_file', 'split_bolds',
+                't1w_template', 't1w_dseg']), name='inputnode')
+
+    # Use a sinker to make things pretty
+    sinker = pe.Node(DataSink(), name='sinker')
+
+    def _sink_image(node, field, sink_key):
+        """Connect an image to the sinker, gzipping uncompressed intermediates"""
+        if use_compression:
+            workflow.connect([(node, sinker, [(field, sink_key)])])
+            return
+        compress = pe.Node(CompressImage(num_threads=omp_nthreads),
+                           name='compress_' + sink_key.split('@')[-1],
+                           n_procs=omp_nthreads)
+        workflow.connect([(node, compress, [(field, 'in_file')]),
+                          (compress, sinker, [('out_file', sink_key)])])
+
+    if outputs & (STAT_OUTPUTS | {'hmc_bold'}):
+        hmc_apply_wf = init_apply_hmc_only_wf(mem_gb, omp_nthreads,
+                                              use_compression=use_compression,
+                                              split_file=not reuse_split,
+                                              in_memory=hmc_engine == 'numpy')
+        workflow.connect([(inputnode, hmc_apply_wf, [('bold_file','inputnode.name_source'),
+                                                    ('split_bolds' if reuse_split else 'bold_file',
+                                                     'inputnode.bold_file'),
+                                                    ('hmc_transform', 'inputnode.hmc_xforms')])])
+    if 'hmc_xform' in outputs:
+        hmcxform_copy = pe.Node(Function(input_names=['in_file'],
+                                 output_names=['out_file'],
+                                 function=copyfile),
+                        name='hmcxform_copy')
+        workflow.connect([(inputnode, hmcxform_copy, [('hmc_transform', 'in_file')]),
+                          (hmcxform_copy, sinker, [('out_file', 'mnitobold.@hmc_xforms')])])
+    if 'hmc_bold' in outputs:
+        _sink_image(hmc_apply_wf, 'outputnode.bold', 'mnitobold.@hmc_only_bold')
+
+    if backtransform_outputs:
+        if use_sdc:
+            iwf = init_qwarp_inversion_wf(omp_nthreads, use_compression=use_compression)
+            workflow.connect([(inputnode, iwf, [('sdc', 'inputnode.warp'),
+                                                ('ref', 'inputnode.in_reference')])])
+            n_transforms = 3
+        else:
+            n_transforms = 2
+
+        backtransform_wf = init_backtransform_wf(mem_gb, omp_nthreads,
+                                                 stats_engine=stats_engine,
+                                                 from_t1w=share_t1w,
+                                                 outputs=backtransform_outputs)
+        merge_transforms = pe.Node(niu.Merge(n_transforms), name='merge_xforms',
+                                   run_without_submitting=True, mem_gb=mem_gb)
+        workflow.connect([
+            (inputnode, backtransform_wf, [
+                ('t1w_template' if share_t1w else 'mni_image', 'inputnode.template_file'),
+                ('t1w_dseg' if share_t1w else 'dseg', 'inputnode.dseg_file'),
+                ('ref','inputnode.reference_image')
+                ]),
+            (inputnode, merge_transforms, [('mni_to_t1','in1'),
+                                           ('t1_to_bold', 'in2')]),
+            (merge_transforms, backtransform_wf, [('out', 'inputnode.transforms')]),
+        ])
+        if use_sdc:
+            workflow.connect([(iwf, merge_transforms, [('outputnode.out_warp','in3')])])
+
+        if share_t1w:
+            # The template and dseg come in T1w space, only the run transforms are left
+            merge_run_transforms = pe.Node(niu.Merge(n_transforms - 1), name='merge_run_xforms',
+                                           run_without_submitting=True, mem_gb=mem_gb)
+            workflow.connect([
+                (inputnode, merge_run_transforms, [('t1_to_bold', 'in1')]),
+                (merge_run_transforms, backtransform_wf, [('out', 'inputnode.run_transforms')]),
+            ])
+            if use_sdc:
+                workflow.connect([(iwf, merge_run_transforms, [('outputnode.out_warp', 'in2')])])
+
+        for output, field, sink_key in (
+                ('mni2bold_xform', 'combined_transforms', 'mnitobold.@mni2bold_combined_xforms'),
+                ('template', 'transformed_template', 'mnitobold.@transformed_template'),
+                ('dseg', 'transformed_dseg', 'mnitobold.@transformed_dseg')):
+            if output in outputs:
+                workflow.connect([(backtransform_wf, sinker, [('outputnode.' + field, sink_key)])])
+
+    if stats_engine == 'numpy' and outputs & STAT_OUTPUTS:
+        # Scaling, TSNR, stdev and roi stats from a single read of the HMC bold
+        fused_stats = pe.Node(FusedBoldStats(n_dummy=n_dummy, compress=use_compression),
+                              name='fused_stats',
+                              mem_gb=mem_gb)
+        workflow.connect([(hmc_apply_wf, fused_stats, [('outputnode.bold', 'in_file')]),
+                          (backtransform_wf, fused_stats, [('outputnode.transformed_dseg', 'dseg_file')])])
+        for output, field, sink_key in (('tsnr_roistats', 'tsnr_roi_stats', 'stats.@hmc_tsnr_roistats'),
+                                        ('roistats', 'scaled_roi_stats', 'stats.@scaled_roistats'),
+                                        ('grandstd', 'grand_std', 'stats.@scaled_grandstd')):
+            if output in outputs:
+                workflow.connect([(fused_stats, sinker, [(field, sink_key)])])
+        for output, field, sink_key in (('scaled_bold', 'scaled', 'mnitobold.@hmc_scaled_bold'),
+                                        ('tsnr', 'tsnr', 'stats.@hmc_tsnr'),
+                                        ('scaled_std', 'scaled_std', 'stats.@scaled_std')):
+            if output in outputs:
+                _sink_image(fused_stats, field, sink_key)
+    elif outputs & STAT_OUTPUTS:
+        if outputs & {'tsnr', 'tsnr_roistats'}:
+            # Get TSNR of minimally pocessed HMC Bold
+            gettsnr = init_getstats_wf(mem_gb, omp_nthreads, n_dummy=n_dummy, name='gettsnr',
+                                       use_compression=use_compression)
+            workflow.connect([
+                (hmc_apply_wf, gettsnr, [('outputnode.bold', 'inputnode.bold_file')]),
+                (backtransform_wf, gettsnr, [('outputnode.transformed_dseg', 'inputnode.dseg_file')]),
+            ])
+            if 'tsnr_roistats' in outputs:
+                workflow.connect([(gettsnr, sinker, [('outputnode.roi_stats', 'stats.@hmc_tsnr_roistats')])])
+            if 'tsnr' in outputs:
+                _sink_image(gettsnr, 'outputnode.stat_image', 'stats.@hmc_tsnr')
+
+        if outputs & {'scaled_bold', 'scaled_std', 'roistats', 'grandstd'}:
+            # Scale time series by voxel mean
+            scale_wf = init_scale_wf(mem_gb, omp_nthreads, n_dummy=n_dummy,
+                                     use_compression=use_compression)
+            workflow.connect([(hmc_apply_wf, scale_wf, [('outputnode.bold', 'inputnode.bold_file')])])
+            if 'scaled_bold' in outputs:
+                _sink_image(scale_wf, 'outputnode.scaled', 'mnitobold.@hmc_scaled_bold')
+
+        if 'scaled_std' in outputs:
+            # Calculate the voxel wise standard deviation of the scaled image
+            getstd = init_getstats_wf(mem_gb, omp_nthreads, n_dummy=n_dummy, name='getstd', stat='stdev',
+                                      use_compression=use_compression)
+            workflow.connect([
+                (scale_wf, getstd, [('outputnode.scaled', 'inputnode.bold_file')]),
+                (backtransform_wf, getstd, [('outputnode.transformed_dseg', 'inputnode.dseg_file')]),
+            ])
+            _sink_image(getstd, 'outputnode.stat_image', 'stats.@scaled_std')
+
+        if 'roistats' in outputs:
+            # Get the TR-wise sum and count of each roi
+            roi_stats = pe.Node(ROIStats(stat=['sum', 'voxels']),
+                           name='roi_stats', mem_gb=mem_gb, n_procs=omp_nthreads)
+            workflow.connect([
+                (backtransform_wf, roi_stats, [('outputnode.transformed_dseg', 'mask_file')]),
+                (scale_wf, roi_stats, [('outputnode.scaled', 'in_file')]),
+                (roi_stats, sinker, [('out_file', 'stats.@scaled_roistats')]),
+            ])
 
-    opts = get_parser().parse_args(args=args)
+        if 'grandstd' in outputs:
+            get_grand_std = pe.Node(Function(input_names=['in_file', 'dseg_file', 'out_file',
+                                                          'n_dummy', 'mem_gb'],
+                                         output_names=['out_file'],
+                                         function=roi_grand_std),
+                                name='get_grand_std')
+            get_grand_std.inputs.n_dummy = n_dummy
+            get_grand_std.inputs.mem_gb = stream_mem_gb
+            workflow.connect([
+                (scale_wf, get_grand_std, [('outputnode.scaled','in_file')]),
+                (backtransform_wf, get_grand_std, [('outputnode.transformed_dseg','dseg_file')]),
+                (get_grand_std, sinker, [('out_file', 'stats.@scaled_grandstd')]),
+            ])
+
+    # Record the completed run once everything was sunk
+    manifest = pe.Node(Function(input_names=['out_files', 'manifest_file', 'inputs',
+                                             'parameters'],
+                                output_names=['manifest_file'],
+                                function=write_manifest),
+                       name='manifest', run_without_submitting=True)
+    workflow.connect([(sinker, manifest, [('out_file', 'out_files')])])
+
+    return workflow
+
+
+# Prototypes of the run workflows, kept across calls of main (e.g. by a worker)
+_PROTOTYPES = WorkflowPrototypes(init_run_wf)
+
+
+def main(args=None):
+    """Entry point."""
+    from comppsychflows.utils.limits import node_memory_gb
+
+    # Parse first so that --help and argument errors do not wait for nipype
+    parser = get_parser()
+    opts = parser.parse_args(args=args)
+    # slurm gives the memory of a job in MB (e.g. $SLURM_MEM_PER_NODE)
+    if opts.mem_gb is not None and not 0 < opts.mem_gb <= node_memory_gb():
+        parser.error('--mem-gb %g is not between 0 and the %.0f GB of this node; it is the '
+                     'memory of the job in GB, not MB' % (opts.mem_gb, node_memory_gb()))
+
+    from pathlib import Path
+    from niworkflows.engine.workflows import LiterateWorkflow as Workflow
+    from comppsychflows.workflows.util import init_subject_template_wf
+    from comppsychflows.utils.resources import (estimate_bold_resources,
+                                                estimate_t1w_resources, set_node_resources)
+    from comppsychflows.utils.images import check_split_volumes
+    from comppsychflows.utils.limits import (available_cpus, available_memory_gb,
+                                             limit_node_threads, threads_per_node)
+    from comppsychflows.utils.autotune import (load_tuning, recommend,
+                                               tuning_mismatches, typical_shape)
+    from comppsychflows.utils.fmriprep import index_runs
+    from comppsychflows.utils.scheduling import select_runs, shard_runs
+    from comppsychflows.utils.manifest import file_fingerprints, is_complete
+    from comppsychflows.utils.environment import prime_nipype_versions, probe_environment
+    from comppsychflows.utils.profiling import NodeProfiler, write_chrome_trace, write_reports
+    from comppsychflows import __version__
+    from comppsychflows import COMPPSYCHFLOWS_LOG
+
+    # Tool versions are probed once and shared by every workflow and interface
+    prime_nipype_versions(probe_environment(refresh=opts.refresh_environment))
+    if opts.profile:
+        from nipype import config
+
+        config.enable_resource_monitor()
 
     fmriprep_dir = Path(opts.fmriprep_dir)
-    fmriprep_odir = fmriprep_dir / 'out'
-    fmriprep_wdir = fmriprep_dir / 'wrk'
     mnitobold_dir = opts.out_path
     mnitobold_wdir = (Path(mnitobold_dir) / 'wrk')
     mnitobold_odir = (Path(mnitobold_dir) / 'out')
     dseg_path = opts.dseg_path
     mni_image = opts.mni_image
-    omp_nthreads = opts.omp_nthreads
-    mem_gb = opts.mem_gb
+    mem_gb = opts.node_mem_gb
     n_dummy = opts.n_dummy
+    use_compression = opts.intermediate_format == 'nii.gz'
+    outputs = opts.outputs
+    backtransform_outputs = _backtransform_outputs(outputs)
 
-    func_wds = sorted((fmriprep_wdir/'fmriprep_wf').glob('single_subject_*_wf/func*'))
-    for func_wd in func_wds:
-        sub_extract = re.compile('subject_([0-9]*)')
-        subject = sub_extract.findall(func_wd.as_posix())[0]
-        sdc_path = func_wd / 'sdc_estimate_wf/pepolar_unwarp_wf/qwarp/Qwarp_PLUS_WARP.nii.gz'
-        use_sdc =  sdc_path.exists()
+    # Every run is added to a single meta-workflow so that independent runs
+    # (and independent branches within a run) can be executed concurrently
+    mnitobold_wf = Workflow(name='mnitobold_wf')
+    mnitobold_wf.base_dir = mnitobold_wdir.as_posix()
+    subject_wfs = {}
+    subject_template_wfs = {}
 
-        # get paths needed for workflow
-        ref_path = func_wd / 'bold_reference_wf/enhance_and_skullstrip_bold_wf/n4_correct/ref_bold_corrected.nii.gz'
+    # Inputs of every run, from the run index when they did not change since the last call
+    index_file = Path(opts.index_file) if opts.index_file else Path(mnitobold_dir) / 'mnitobold_index.json'
+    runs = index_runs(fmriprep_dir, index_file=index_file, n_workers=opts.probe_threads,
+                      refresh=opts.refresh_index)
+    runs = select_runs(runs, opts.participant_label, opts.run_filter)
+    if opts.shard is not None:
+        runs = shard_runs(runs, *opts.shard)
 
-        hmc_transform = func_wd / 'bold_hmc_wf/fsl2itk/mat2itk.txt'
-        mni_to_t1 = fmriprep_odir / f'fmriprep/sub-{subject}/anat/sub-{subject}_from-MNI152NLin2009cAsym_to-T1w_mode-image_xfm.h5'
-        t1_to_bold= func_wd / 'bold_reg_wf/bbreg_wf/concat_xfm/out_inv.tfm'
-        split_bolds_dir = func_wd / 'bold_split'
-        split_bolds = sorted(split_bolds_dir.glob('vol*.nii.gz'))
+    # Runs to process, with what their workflow needs besides their index entry
+    scheduled = []
+    for run in runs:
+        func_wd = Path(run['func_wd'])
+        split_bolds_dir = Path(run['split_bolds_dir'])
+        split_bolds = [Path(vol) for vol in run['split_bolds']]
+        t1w_ref = Path(run['t1w_ref'])
+        share_t1w = opts.share_t1w_resampling and bool(backtransform_outputs)
+        if share_t1w and run['files'][run['t1w_ref']] is None:
+            COMPPSYCHFLOWS_LOG.warning('Not sharing the T1w resampling of %s: %s not found',
+                                       func_wd, t1w_ref)
+            share_t1w = False
 
         # We'll use the reference gen workflow to get the bids path
-        validate_json = list((func_wd / 'bold_reference_wf/validate').glob('*.json'))[0]
-        bold_file= json.loads(validate_json.read_text())[0][1][0]
+        bold_file = run['bold_file']
+        if bold_file is None:
+            COMPPSYCHFLOWS_LOG.warning('Skipping %s: no bold_reference_wf/validate outputs', func_wd)
+            continue
         bold_basename = Path(bold_file).parts[-1].replace('bold.nii.gz', '')
 
         # If it's a rest scan replace echo 1 with echo 2
         if ('task-rest' in bold_file) and ('echo-1' in bold_file):
             bold_file = bold_file.replace('echo-1', 'echo-2')
+            # fmriprep's split volumes are from the echo it processed
+            split_bolds = []
 
-        # define workflow
-        workflow = Workflow(name=func_wd.parts[-1])
+        # fmriprep's split volumes can stand in for the bold if they match it
+        reuse_split = opts.reuse_split and opts.hmc_engine == 'ants' and bool(split_bolds)
+        if reuse_split:
+            try:
+                check_split_volumes(bold_file, split_bolds)
+            except ValueError as err:
+                COMPPSYCHFLOWS_LOG.warning('Not reusing %s: %s', split_bolds_dir, err)
+                reuse_split = False
 
-        inputnode = pe.Node(niu.IdentityInterface(
-            fields=['sdc', 'ref', 'hmc_transform',
-                    'mni_to_t1', 't1_to_bold',
-                    'mni_image', 'dseg', 'bold_file']), name='inputnode')
+        # Skip runs that already finished with the same inputs and parameters
+        run_odir = mnitobold_odir / func_wd.parts[-1]
+        manifest_file = run_odir / 'manifest.json'
+        run_inputs = dict(run['files'], **file_fingerprints([bold_file, mni_image, dseg_path]))
+        run_parameters = {'version': __version__, 'n_dummy': n_dummy,
+                          'hmc_engine': opts.hmc_engine, 'reuse_split': reuse_split,
+                          'stats_engine': opts.stats_engine, 'share_t1w': share_t1w,
+                          'outputs': sorted(outputs)}
+        if not opts.rerun_completed and is_complete(manifest_file, run_inputs, run_parameters):
+            COMPPSYCHFLOWS_LOG.info('Skipping %s: completed outputs in %s', func_wd, run_odir)
+            continue
 
-        if use_sdc:
-            iwf = init_qwarp_inversion_wf(omp_nthreads)
-            workflow.connect([(inputnode, iwf, [('sdc', 'inputnode.warp'),
-                                                ('ref', 'inputnode.in_reference')])])
-            n_transforms = 3
-        else:
-            n_transforms = 2
+        scheduled.append(dict(run, bold_file=bold_file, bold_basename=bold_basename,
+                              split_bolds=split_bolds, share_t1w=share_t1w,
+                              reuse_split=reuse_split, run_odir=run_odir,
+                              run_inputs=run_inputs, run_parameters=run_parameters))
+    if not scheduled:
+        return
 
-        hmc_apply_wf = init_apply_hmc_only_wf(mem_gb, omp_nthreads, split_file=True)
-        backtransform_wf = init_backtransform_wf(mem_gb, omp_nthreads)
-        merge_transforms = pe.Node(niu.Merge(n_transforms), name='merge_xforms',
-                                   run_without_submitting=True, mem_gb=mem_gb)
-        # Get TSNR of minimally pocessed HMC Bold
-        gettsnr = init_getstats_wf(mem_gb, omp_nthreads, n_dummy=n_dummy, name='gettsnr')
-
-        # Scale time series by voxel mean
-        scale_wf = init_scale_wf(mem_gb, omp_nthreads, n_dummy=n_dummy)
-
-        # Calculate the voxel wise standard deviation of the scaled image
-        getstd = init_getstats_wf(mem_gb, omp_nthreads, n_dummy=n_dummy, name='getstd', stat='stdev')
-
-        # Get the TR-wise sum and count of each roi
-        roi_stats = pe.Node(ROIStats(stat=['sum', 'voxels']),
-                       name='roi_stats', mem_gb=mem_gb, n_procs=omp_nthreads)
-        
-
-        
-        get_grand_std = pe.Node(Function(input_names=['in_file', 'dseg_file', 'out_file'],
-                                     output_names=['out_file'],
-                                     function=roi_grand_std),
-                            name='get_grand_std')
-        
-        hmcxform_copy = pe.Node(Function(input_names=['in_file'],
-                                 output_names=['out_file'],
-                                 function=copyfile),
-                        name='hmcxform_copy')
-        # Use a sinker to make things pretty
-        sinker = pe.Node(DataSink(), name='sinker')
-        sinker.inputs.base_directory = (mnitobold_odir / func_wd.parts[-1]).as_posix()
-        sinker.inputs.substitutions = [('hmcxform_copymat2itk.txt', bold_basename + 'desc-hmc_xform.txt'),
-                                       ('MNItohmcbold.nii.gz', bold_basename + 'desc-MNItohmc_xform.nii.gz'),
-                                       ('vol0000_xform-00000_merged_calc.nii.gz', bold_basename + 'desc-hmcscaled_bold.nii.gz'),
-                                       ('vol0000_xform-00000_merged.nii.gz', bold_basename + 'desc-hmc_bold.nii.gz'),
-                                       ('vol0000_xform-00000_merged_tstat.nii.gz', bold_basename + 'desc-hmc_tsnr.nii.gz'),
-                                       ('vol0000_xform-00000_merged_tstat_roistat.1D', bold_basename + 'desc-hmc_roistats.1D'),
-                                       ('vol0000_xform-00000_merged_calc_roistat.1D', bold_basename + 'desc-hmcscaled_roistats.1D'),
-                                       ('grand_std.csv', bold_basename + 'desc-hmcscaled_grandstd.1D')
-                                      ]
-        
-        workflow.connect([(inputnode, hmcxform_copy, [('hmc_transform', 'in_file')]),
-                          (inputnode, hmc_apply_wf, [('bold_file','inputnode.name_source'),
-                                                    ('bold_file', 'inputnode.bold_file'),
-                                                    ('hmc_transform', 'inputnode.hmc_xforms')]),
-                          (inputnode, backtransform_wf, [('mni_image', 'inputnode.template_file'),
-                                                        ('dseg', 'inputnode.dseg_file'),
-                                                        ('ref','inputnode.reference_image')
-                                                        ]),
-                          (hmc_apply_wf, backtransform_wf, [('outputnode.bold', 'inputnode.bold_file')]),
-                          (inputnode, merge_transforms, [('mni_to_t1','in1'),
-                                                         ('t1_to_bold', 'in2')])
-                         ])
-        if use_sdc:
-            workflow.connect([(iwf, merge_transforms, [('outputnode.out_warp','in3')])])
+    # Concurrent runs share the CPUs of the job instead of each using all of the node's
+    n_cpus = opts.nprocs or available_cpus()
+    n_concurrent = len(scheduled) if opts.plugin in ('MultiProc', 'LegacyMultiProc') else 1
+    omp_nthreads = opts.omp_nthreads
+    # A calibration of other engines, or on another number of CPUs, does not tell how
+    # the steps of this job scale with threads
+    if omp_nthreads is None and opts.tuning_file:
+        tuning = load_tuning(opts.tuning_file)
+        mismatches = tuning_mismatches(tuning, n_cpus=n_cpus, hmc_engine=opts.hmc_engine,
+                                       stats_engine=opts.stats_engine)
+        if mismatches:
+            COMPPSYCHFLOWS_LOG.warning('Ignoring %s, calibrated with %s', opts.tuning_file,
+                                       ', '.join('%s=%s (not %s)' % (key, *values)
+                                                 for key, values in mismatches.items()))
+        else:
+            n_vols = (typical_shape(scheduled) or tuning['shape'])[3]
+            omp_nthreads = recommend(tuning, n_cpus, n_concurrent, n_vols)['omp_nthreads']
+    omp_nthreads = min(omp_nthreads or threads_per_node(n_cpus, n_concurrent), n_cpus)
+    # Nodes of concurrent runs are only started while their memory estimates fit in the job's
+    memory_gb = opts.mem_gb or available_memory_gb()
+    COMPPSYCHFLOWS_LOG.info('Processing %d runs with %d CPUs, at most %d per node, and %.1f GB',
+                            len(scheduled), n_cpus, omp_nthreads, memory_gb)
+    for run in scheduled:
+        func_wd = Path(run['func_wd'])
+        sdc_path = Path(run['sdc'])
+        use_sdc = run['files'][run['sdc']] is not None
+        ref_path = Path(run['ref'])
+        hmc_transform = Path(run['hmc_transform'])
+        mni_to_t1 = Path(run['mni_to_t1'])
+        t1_to_bold = Path(run['t1_to_bold'])
+        t1w_ref = Path(run['t1w_ref'])
+        bold_file, split_bolds = run['bold_file'], run['split_bolds']
+        share_t1w, reuse_split = run['share_t1w'], run['reuse_split']
+        run_odir = run['run_odir']
 
-        workflow.connect([(merge_transforms, backtransform_wf, [('out', 'inputnode.transforms')])])
-        workflow.connect([ # Wire gettsnr
-                          (hmc_apply_wf, gettsnr, [('outputnode.bold', 'inputnode.bold_file')]),
-                          (backtransform_wf, gettsnr, [('outputnode.transformed_dseg', 'inputnode.dseg_file')]),
-                          # Wire scale_wf
-                          (hmc_apply_wf, scale_wf, [('outputnode.bold', 'inputnode.bold_file')]),
-                          # Wire getstd
-                          (scale_wf, getstd, [('outputnode.scaled', 'inputnode.bold_file')]),
-                          (backtransform_wf, getstd, [('outputnode.transformed_dseg', 'inputnode.dseg_file')]),
-                          # Wire roi_stats
-                          (backtransform_wf, roi_stats, [('outputnode.transformed_dseg', 'mask_file')]),
-                          (scale_wf, roi_stats, [('outputnode.scaled', 'in_file')]),
-                          # Wire get_grand_std
-                          (scale_wf, get_grand_std, [('outputnode.scaled','in_file')]),
-                          (backtransform_wf, get_grand_std, [('outputnode.transformed_dseg','dseg_file')]),
-                          # Wire sinker
-                          (hmcxform_copy, sinker, [('out_file', 'mnitobold.@hmc_xforms')]),
-                          (hmc_apply_wf, sinker, [('outputnode.bold', 'mnitobold.@hmc_only_bold')]),
-                          (scale_wf, sinker, [('outputnode.scaled', 'mnitobold.@hmc_scaled_bold')]),
-                          (backtransform_wf, sinker, [('outputnode.combined_transforms', 'mnitobold.@mni2bold_combined_xforms'),
-                                                      ('outputnode.transformed_template', 'mnitobold.@transformed_template'),
-                                                      ('outputnode.transformed_dseg', 'mnitobold.@transformed_dseg')]),
-                          (gettsnr, sinker, [('outputnode.stat_image', 'stats.@hmc_tsnr'),
-                                             ('outputnode.roi_stats', 'stats.@hmc_tsnr_roistats')]),
-                          (roi_stats, sinker, [('out_file', 'stats.@scaled_roistats')]),
-                          (get_grand_std, sinker, [('out_file', 'stats.@scaled_grandstd')])
-                          ])
-        workflow.base_dir = mnitobold_wdir.as_posix()
+        # Runs with the same structure share a prototype of their workflow
+        workflow = _PROTOTYPES.clone(
+            func_wd.parts[-1], mem_gb=mem_gb, omp_nthreads=omp_nthreads, n_dummy=n_dummy,
+            outputs=frozenset(outputs), use_sdc=use_sdc, share_t1w=share_t1w,
+            reuse_split=reuse_split, hmc_engine=opts.hmc_engine, stats_engine=opts.stats_engine,
+            use_compression=use_compression, stream_mem_gb=opts.stream_mem_gb)
+        sinker = workflow.get_node('sinker')
+        sinker.inputs.base_directory = run_odir.as_posix()
+        sinker.inputs.substitutions = sink_substitutions(run['bold_basename'])
+        manifest = workflow.get_node('manifest')
+        manifest.inputs.manifest_file = (run_odir / 'manifest.json').as_posix()
+        manifest.inputs.inputs = run['run_inputs']
+        manifest.inputs.parameters = run['run_parameters']
 
         # Connect inputs to workflow
         workflow.inputs.inputnode.sdc = sdc_path
@@ -241,8 +708,62 @@ def main(args=None):
         workflow.inputs.inputnode.mni_image = mni_image
         workflow.inputs.inputnode.dseg = dseg_path
         workflow.inputs.inputnode.bold_file = bold_file
+        workflow.inputs.inputnode.split_bolds = [vol.as_posix() for vol in split_bolds]
+
+        if opts.estimate_resources:
+            set_node_resources(workflow, estimate_bold_resources(
+                bold_file, omp_nthreads, stream_mem_gb=opts.stream_mem_gb))
+
+        # Runs are grouped under their fmriprep subject workflow name
+        subject_wf_name = func_wd.parts[-2]
+        if subject_wf_name not in subject_wfs:
+            subject_wfs[subject_wf_name] = Workflow(name=subject_wf_name)
+        subject_wfs[subject_wf_name].add_nodes([workflow])
+
+        if share_t1w:
+            # One resampling into T1w space per subject, shared by all of its runs
+            if subject_wf_name not in subject_template_wfs:
+                template_wf = init_subject_template_wf(mem_gb, omp_nthreads)
+                template_wf.inputs.inputnode.template_file = mni_image
+                template_wf.inputs.inputnode.dseg_file = dseg_path
+                template_wf.inputs.inputnode.reference_image = t1w_ref
+                template_wf.inputs.inputnode.mni_to_t1 = mni_to_t1
+                if opts.estimate_resources:
+                    set_node_resources(template_wf, estimate_t1w_resources(
+                        t1w_ref, mni_to_t1, mni_image, dseg_path, omp_nthreads))
+                subject_template_wfs[subject_wf_name] = template_wf
+            subject_wfs[subject_wf_name].connect([
+                (subject_template_wfs[subject_wf_name], workflow, [
+                    ('outputnode.t1w_template', 'inputnode.t1w_template'),
+                    ('outputnode.t1w_dseg', 'inputnode.t1w_dseg')]),
+            ])
+
+    mnitobold_wf.add_nodes(list(subject_wfs.values()))
+    limit_node_threads(mnitobold_wf, omp_nthreads)
+
+    plugin_settings = {'plugin': opts.plugin, 'plugin_args': {}}
+    if opts.plugin in ('MultiProc', 'LegacyMultiProc'):
+        plugin_settings['plugin_args'] = {'n_procs': n_cpus, 'memory_gb': memory_gb,
+                                          'raise_insufficient': False}
+    profiler = None
+    if opts.profile or opts.trace:
+        profiler = NodeProfiler(mnitobold_wdir / mnitobold_wf.name)
+        plugin_settings['plugin_args']['status_callback'] = profiler
+    try:
+        mnitobold_wf.run(**plugin_settings)
+    finally:
+        if profiler is not None:
+            import time
 
-        wf_res = workflow.run()
+            profile_dir = Path(mnitobold_dir) / 'profile' / ('%s_%d' % (
+                time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+            if opts.profile:
+                summary_file = write_reports(profiler.records, profile_dir)
+                COMPPSYCHFLOWS_LOG.info('Wrote the profile of %d nodes to %s',
+                                        len(profiler.records), summary_file)
+            if opts.trace:
+                trace_file = write_chrome_trace(profiler.records, profile_dir / 'trace.json')
+                COMPPSYCHFLOWS_LOG.info('Wrote the execution trace to %s', trace_file)
 
 if __name__ == "__main__":
     from sys import argv
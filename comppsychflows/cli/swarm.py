@@ -0,0 +1,269 @@
+"""Write swarm or SLURM array job files that run mnitobold over a dataset"""
+import os
+
+# Job states worth resubmitting
+FAILED_STATES = ('FAILED', 'CANCELLED', 'TIMEOUT', 'OUT_OF_MEMORY', 'NODE_FAIL')
+
+
+def _job_options(parser):
+    """Options shared by the commands that write job files"""
+    parser.add_argument("-o", "--out-file", action="store", required=True,
+                        help="swarm file (or SLURM commands file) to write")
+    parser.add_argument("--format", action="store", choices=["swarm", "slurm"],
+                        default="swarm",
+                        help="Write a swarm file with #SWARM directives (swarm) or a commands "
+                             "file and an sbatch array script next to it (slurm)")
+    parser.add_argument("--job-cpus", action="store", type=int, default=32,
+                        help="CPUs of each job")
+    parser.add_argument("--job-mem-gb", action="store", type=float, default=64,
+                        help="Memory in GB of each job")
+    parser.add_argument("--job-hours", action="store", type=float, default=24,
+                        help="Walltime in hours of each job")
+    parser.add_argument("--gres", action="store", default="lscratch:200",
+                        help="Generic resources requested by each job")
+    parser.add_argument("--job-name", action="store", default="mnitobold")
+
+
+def get_parser():
+    """Build parser object."""
+    from argparse import ArgumentParser, RawTextHelpFormatter
+
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    write = subparsers.add_parser(
+        "write", formatter_class=RawTextHelpFormatter,
+        usage="%(prog)s [options] fmriprep_dir out_path mni_image dseg_path "
+              "[-- mnitobold options]",
+        help="Pack the runs of a dataset into jobs and write the job files; options "
+             "after -- are passed on to comppsychflows-mnitobold")
+    write.add_argument("fmriprep_dir", action="store", help="fmriprep directory to pull scans from")
+    write.add_argument("out_path", action="store", help="the mnitobold output directory")
+    write.add_argument('mni_image', action="store", help="mni template image to use")
+    write.add_argument('dseg_path', action="store", help="segmentation to use")
+    _job_options(write)
+    write.add_argument("--participant-label", action="store", nargs="+",
+                       help="Only process these participants (with or without the sub- prefix)")
+    write.add_argument("--run-filter", action="store",
+                       help="Only process runs whose bold file or fmriprep func working "
+                            "directory name matches this regular expression")
+    write.add_argument("--index-file", action="store", default=None,
+                       help="Run index shared with comppsychflows-mnitobold "
+                            "(default: <out_path>/mnitobold_index.json)")
+    write.add_argument("--omp-nthreads", action="store", type=int, default=8,
+                       help="Number of CPUs available to individual processes of a job")
+    write.add_argument("--cpu-hours-per-gvox", action="store", type=float, default=3.0,
+                       help="Estimated CPU hours per 10^9 voxels x volumes of bold, used to "
+                            "pack runs into jobs")
+    write.add_argument("--wrapper", action="store", default="comppsychflows-mnitobold",
+                       help="Command that runs mnitobold (e.g. a script like "
+                            "example_run_mnitobold.sh that activates an environment first)")
+
+    resubmit = subparsers.add_parser(
+        "resubmit", formatter_class=RawTextHelpFormatter,
+        help="Write job files with only the jobs that failed in a job history")
+    resubmit.add_argument("commands_file", action="store",
+                          help="swarm or commands file that was submitted")
+    resubmit.add_argument("jobhist_file", action="store",
+                          help="saved output of 'jobhist <jobid>' or "
+                               "'sacct -j <jobid> --format=JobID,State -P'")
+    _job_options(resubmit)
+    resubmit.add_argument("--states", action="store", nargs="+", default=list(FAILED_STATES),
+                          help="Job states to resubmit (default: %s)" % ' '.join(FAILED_STATES))
+
+    return parser
+
+
+def _walltime(hours):
+    minutes = int(round(hours * 60))
+    return '%d:%02d:00' % (minutes // 60, minutes % 60)
+
+
+def read_commands(commands_file):
+    """Commands of a swarm or commands file, one per job, without directives or comments"""
+    with open(commands_file) as fobj:
+        return [line.rstrip('\n') for line in fobj if line.strip() and not line.startswith('#')]
+
+
+def write_job_files(commands, out_file, fmt='swarm', job_cpus=32, job_mem_gb=64, job_hours=24,
+                    gres='lscratch:200', job_name='mnitobold'):
+    """
+    Write one job per command as a swarm file, or as a commands file plus an sbatch script.
+
+    Parameters
+    ----------
+    commands : :obj:`list` of :obj:`str`
+        Shell command of each job
+    out_file : pathlike
+        swarm file or commands file
+    fmt : :obj:`str`
+        ``'swarm'`` or ``'slurm'``
+
+    Returns
+    -------
+    files : :obj:`list` of :obj:`str`
+        Files written; submit the last one
+
+    """
+    out_file = str(out_file)
+    walltime = _walltime(job_hours)
+    mem = int(job_mem_gb) if float(job_mem_gb).is_integer() else job_mem_gb
+    if fmt == 'swarm':
+        directives = ['#SWARM -t %d -g %s --time %s --job-name %s' % (
+            job_cpus, mem, walltime, job_name)]
+        if gres:
+            directives.append('#SWARM --gres=%s' % gres)
+        with open(out_file, 'w') as fobj:
+            fobj.write('\n'.join(directives + commands) + '\n')
+        return [out_file]
+
+    with open(out_file, 'w') as fobj:
+        fobj.write('\n'.join(commands) + '\n')
+    sbatch_file = os.path.splitext(out_file)[0] + '.sbatch'
+    lines = ['#!/bin/bash',
+             '#SBATCH --job-name=%s' % job_name,
+             '#SBATCH --array=0-%d' % (len(commands) - 1),
+             '#SBATCH --cpus-per-task=%d' % job_cpus,
+             '#SBATCH --mem=%sG' % mem,
+             '#SBATCH --time=%s' % walltime]
+    if gres:
+        lines.append('#SBATCH --gres=%s' % gres)
+    lines.append('eval "$(sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" %s)"' % os.path.abspath(out_file))
+    with open(sbatch_file, 'w') as fobj:
+        fobj.write('\n'.join(lines) + '\n')
+    return [out_file, sbatch_file]
+
+
+def parse_jobhist(jobhist_file):
+    """
+    Read the array index and state of each job in a saved job history.
+
+    Both the table printed by ``jobhist`` (after its summary) and the
+    ``|`` separated output of ``sacct -P`` are understood. Job steps
+    (``<jobid>_<index>.batch``) and jobs without an array index are ignored.
+
+    Parameters
+    ----------
+    jobhist_file : pathlike
+
+    Returns
+    -------
+    states : :obj:`dict`
+        Maps each array index to its state
+
+    Raises
+    ------
+    ValueError
+        When there is no header with ``JobID`` and ``State`` columns
+
+    """
+    import re
+
+    with open(jobhist_file) as fobj:
+        lines = [line for line in fobj.read().split('\n') if line.strip()]
+    # jobhist prints a summary (with a "Jobid : <jobid>" line) before its job table
+    for start, line in enumerate(lines):
+        sep = '|' if '|' in line else None
+        header = [col.lower() for col in line.split(sep)]
+        if 'jobid' in header and 'state' in header:
+            break
+    else:
+        raise ValueError('%s has no JobID and State columns' % jobhist_file)
+    jobid_col, state_col = header.index('jobid'), header.index('state')
+
+    states = {}
+    for line in lines[start + 1:]:
+        fields = line.split(sep)
+        if len(fields) <= max(jobid_col, state_col):
+            continue
+        match = re.fullmatch(r'\d+_(\d+)', fields[jobid_col].strip())
+        if match is not None:
+            states[int(match.group(1))] = fields[state_col].strip().split()[0]
+    return states
+
+
+def _write(opts):
+    import re
+    import shlex
+    from pathlib import Path
+    from comppsychflows import COMPPSYCHFLOWS_LOG
+    from comppsychflows.utils.fmriprep import index_runs
+    from comppsychflows.utils.resources import estimate_bold_resources
+    from comppsychflows.utils.scheduling import pack_runs, run_cost, select_runs
+
+    index_file = opts.index_file or Path(opts.out_path) / 'mnitobold_index.json'
+    runs = index_runs(opts.fmriprep_dir, index_file=index_file)
+    runs = [run for run in select_runs(runs, opts.participant_label, opts.run_filter)
+            if run['bold_file'] is not None]
+    if not runs:
+        COMPPSYCHFLOWS_LOG.warning('No runs to process in %s', opts.fmriprep_dir)
+        return []
+
+    omp_nthreads = min(opts.omp_nthreads, opts.job_cpus)
+    known = [run_cost(run) for run in runs if run['bold_info']]
+    fallback_cost = max(known) if known else 1
+    cpu_hours, mem_gb = [], []
+    for run in runs:
+        if run['bold_info']:
+            cpu_hours.append(run_cost(run) / 1e9 * opts.cpu_hours_per_gvox)
+            resources = estimate_bold_resources(run['bold_file'], omp_nthreads,
+                                                info=run['bold_info'])
+            mem_gb.append(max(res['mem_gb'] for res in resources.values()))
+        else:
+            # Unreadable header: assume it is as large as the largest run
+            cpu_hours.append(fallback_cost / 1e9 * opts.cpu_hours_per_gvox)
+            mem_gb.append(max(mem_gb, default=1.0))
+
+    commands = []
+    for job in pack_runs(cpu_hours, mem_gb, opts.job_cpus, opts.job_mem_gb, opts.job_hours):
+        bold_names = sorted(os.path.basename(runs[run]['bold_file']) for run in job)
+        run_filter = '^(%s)$' % '|'.join(re.escape(name) for name in bold_names)
+        # --mem-gb is shared by the nodes of all the runs of the job; like the default
+        # taken from the job's cgroup, it leaves room to the scheduler process
+        args = [opts.fmriprep_dir, opts.out_path, opts.mni_image, opts.dseg_path,
+                '--nprocs', str(opts.job_cpus), '--omp-nthreads', str(omp_nthreads),
+                '--mem-gb', '%g' % (0.9 * opts.job_mem_gb), '--index-file', str(index_file),
+                '--run-filter', run_filter] + opts.mnitobold_args
+        commands.append(' '.join([opts.wrapper] + [shlex.quote(arg) for arg in args]))
+    COMPPSYCHFLOWS_LOG.info('Packed %d runs (%.1f CPU hours) into %d jobs', len(runs),
+                            sum(cpu_hours), len(commands))
+    return write_job_files(commands, opts.out_file, opts.format, opts.job_cpus,
+                           opts.job_mem_gb, opts.job_hours, opts.gres, opts.job_name)
+
+
+def _resubmit(opts):
+    from comppsychflows import COMPPSYCHFLOWS_LOG
+
+    commands = read_commands(opts.commands_file)
+    states = parse_jobhist(opts.jobhist_file)
+    failed = sorted(idx for idx, state in states.items()
+                    if state in opts.states and idx < len(commands))
+    COMPPSYCHFLOWS_LOG.info('Resubmitting %d of %d jobs', len(failed), len(commands))
+    if not failed:
+        return []
+    return write_job_files([commands[idx] for idx in failed], opts.out_file, opts.format,
+                           opts.job_cpus, opts.job_mem_gb, opts.job_hours, opts.gres,
+                           opts.job_name)
+
+
+def main(args=None):
+    """Entry point."""
+    import sys
+
+    args = list(sys.argv[1:] if args is None else args)
+    # Everything after -- is passed on to comppsychflows-mnitobold
+    mnitobold_args = []
+    if '--' in args:
+        mnitobold_args = args[args.index('--') + 1:]
+        args = args[:args.index('--')]
+    opts = get_parser().parse_args(args=args)
+    opts.mnitobold_args = mnitobold_args
+    files = _write(opts) if opts.command == 'write' else _resubmit(opts)
+    for out_file in files:
+        print(out_file)
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    main(args=argv[1:])
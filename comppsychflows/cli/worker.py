@@ -0,0 +1,207 @@
+"""Process mnitobold runs from a queue directory in a long-lived worker"""
+import signal
+from contextlib import contextmanager
+
+
+class _Terminated(BaseException):
+    """Raised in the worker when the scheduler asks it to stop"""
+
+
+def _raise_terminated(signum, frame):
+    raise _Terminated(signal.Signals(signum).name)
+
+
+def get_parser():
+    """Build parser object."""
+    from argparse import ArgumentParser, RawTextHelpFormatter
+
+    parser = ArgumentParser(description=__doc__, formatter_class=RawTextHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve = subparsers.add_parser(
+        "serve", formatter_class=RawTextHelpFormatter,
+        help="Claim pending runs and process them back to back in this process, so that "
+             "imports, tool versions and in-process caches are paid for once")
+    serve.add_argument("queue_dir", action="store", help="queue directory")
+    serve.add_argument("--poll", action="store", type=float, default=10,
+                       help="Seconds between checks for new runs while the queue is empty")
+    serve.add_argument("--idle-timeout", action="store", type=float, default=0,
+                       help="Exit once the queue has been empty for this many seconds "
+                            "(default: as soon as it is empty)")
+    serve.add_argument("--max-runs", action="store", type=int, default=None,
+                       help="Exit after processing this many runs")
+
+    submit = subparsers.add_parser(
+        "submit", formatter_class=RawTextHelpFormatter,
+        usage="%(prog)s [options] queue_dir [-- mnitobold arguments]",
+        help="Queue the comppsychflows-mnitobold arguments given after --, or every "
+             "command of a swarm or commands file")
+    submit.add_argument("queue_dir", action="store", help="queue directory")
+    submit.add_argument("--from-file", action="store",
+                        help="swarm or commands file written by comppsychflows-swarm; "
+                             "the arguments of each command are queued")
+    submit.add_argument("--name", action="store",
+                        help="Name of the queued run (only with arguments after --)")
+
+    requeue = subparsers.add_parser(
+        "requeue", formatter_class=RawTextHelpFormatter,
+        help="Put back the runs of workers of this host that died while running them")
+    requeue.add_argument("queue_dir", action="store", help="queue directory")
+    requeue.add_argument("--failed", action="store_true", default=False,
+                         help="Also retry the failed runs")
+    requeue.add_argument("--all-running", action="store_true", default=False,
+                         help="Put back every running run, whichever host claimed it "
+                              "(only once no worker is left)")
+
+    status = subparsers.add_parser("status", help="Count the runs in each state")
+    status.add_argument("queue_dir", action="store", help="queue directory")
+    return parser
+
+
+@contextmanager
+def _restore_nipype_config():
+    """
+    Restore nipype's global config once a run is over.
+
+    Runs share the worker's process, so a run with ``--profile``, which turns on
+    nipype's resource monitor, would otherwise leave it on for the runs after it.
+    The cached monitor flag is restored too, since the config options alone do
+    not turn it off again.
+    """
+    from nipype import config
+
+    options = {section: dict(config._config.items(section, raw=True))
+               for section in config._config.sections()}
+    resource_monitor = config._resource_monitor
+    try:
+        yield
+    finally:
+        for section in config._config.sections():
+            if section not in options:
+                config._config.remove_section(section)
+                continue
+            for option in set(config._config.options(section)) - set(options[section]):
+                config._config.remove_option(section, option)
+            for option, value in options[section].items():
+                config._config.set(section, option, value)
+        config._resource_monitor = resource_monitor
+
+
+def serve(queue_dir, poll=10, idle_timeout=0, max_runs=None):
+    """
+    Process queued runs with :func:`comppsychflows.cli.mnitobold.main` until idle.
+
+    A run that raises (including argument errors) is moved to ``failed`` with its
+    traceback; the worker goes on with the next one. Changes a run makes to
+    nipype's global config (e.g. ``--profile``) are undone after it. When the
+    worker receives SIGTERM (e.g. at the end of its job's walltime) or SIGINT,
+    the run it was processing is put back in ``pending`` for another worker;
+    the nipype working directory lets that worker resume it.
+
+    Parameters
+    ----------
+    queue_dir : pathlike
+    poll : :obj:`float`
+        Seconds between checks while the queue is empty
+    idle_timeout : :obj:`float`
+        Seconds the queue may stay empty before the worker exits
+    max_runs : :obj:`int`
+        Number of runs after which the worker exits (default: no limit)
+
+    Returns
+    -------
+    counts : :obj:`dict`
+        Number of runs that were ``done`` and ``failed``
+
+    """
+    import time
+    import traceback
+    from comppsychflows import COMPPSYCHFLOWS_LOG
+    from comppsychflows.cli.mnitobold import main as mnitobold
+    from comppsychflows.utils.runqueue import claim, finish, init_queue
+
+    queue_dir = init_queue(queue_dir)
+    counts = {'done': 0, 'failed': 0}
+    previous = signal.signal(signal.SIGTERM, _raise_terminated)
+    idle_since = time.monotonic()
+    try:
+        while max_runs is None or sum(counts.values()) < max_runs:
+            spec_file, spec = claim(queue_dir)
+            if spec_file is None:
+                if time.monotonic() - idle_since >= idle_timeout:
+                    break
+                time.sleep(poll)
+                continue
+
+            COMPPSYCHFLOWS_LOG.info('Processing %s', spec_file.stem)
+            start = time.monotonic()
+            try:
+                with _restore_nipype_config():
+                    mnitobold(spec['args'])
+            except (_Terminated, KeyboardInterrupt):
+                finish(spec_file, spec, 'pending')
+                COMPPSYCHFLOWS_LOG.warning('Interrupted, put %s back in the queue',
+                                           spec_file.stem)
+                raise
+            except (Exception, SystemExit):
+                finish(spec_file, spec, 'failed', error=traceback.format_exc(),
+                       elapsed=time.monotonic() - start)
+                counts['failed'] += 1
+                COMPPSYCHFLOWS_LOG.error('%s failed', spec_file.stem)
+            else:
+                finish(spec_file, spec, 'done', elapsed=time.monotonic() - start)
+                counts['done'] += 1
+                COMPPSYCHFLOWS_LOG.info('%s done in %.0f s', spec_file.stem,
+                                        time.monotonic() - start)
+            idle_since = time.monotonic()
+    finally:
+        signal.signal(signal.SIGTERM, previous)
+    return counts
+
+
+def main(args=None):
+    """Entry point."""
+    import shlex
+    import sys
+
+    args = list(sys.argv[1:] if args is None else args)
+    # Everything after -- is passed on to comppsychflows-mnitobold
+    mnitobold_args = []
+    if '--' in args:
+        mnitobold_args = args[args.index('--') + 1:]
+        args = args[:args.index('--')]
+    opts = get_parser().parse_args(args=args)
+
+    from comppsychflows.utils.runqueue import queue_status, requeue, submit
+
+    if opts.command == 'serve':
+        try:
+            counts = serve(opts.queue_dir, opts.poll, opts.idle_timeout, opts.max_runs)
+        except _Terminated:
+            sys.exit(128 + signal.SIGTERM)
+        print('done: %d failed: %d' % (counts['done'], counts['failed']))
+    elif opts.command == 'submit':
+        if opts.from_file:
+            from comppsychflows.cli.swarm import read_commands
+
+            # Drop the wrapper that runs mnitobold, keep its arguments
+            queued = [submit(opts.queue_dir, shlex.split(command)[1:])
+                      for command in read_commands(opts.from_file)]
+        elif mnitobold_args:
+            queued = [submit(opts.queue_dir, mnitobold_args, name=opts.name)]
+        else:
+            get_parser().error('give mnitobold arguments after -- or --from-file')
+        for spec_file in queued:
+            print(spec_file)
+    elif opts.command == 'requeue':
+        for name in requeue(opts.queue_dir, opts.failed, opts.all_running):
+            print(name)
+    else:
+        for state, count in queue_status(opts.queue_dir).items():
+            print('%s: %d' % (state, count))
+
+
+if __name__ == "__main__":
+    from sys import argv
+
+    main(args=argv[1:])
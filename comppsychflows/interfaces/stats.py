@@ -0,0 +1,352 @@
+"""Numpy implementations of the AFNI statistics used by mnitobold"""
+import os
+from functools import lru_cache
+
+import numpy as np
+import nibabel as nb
+from scipy import sparse
+
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec,
+    SimpleInterface,
+    TraitedSpec,
+    traits,
+    File,
+    InputMultiObject,
+    isdefined,
+)
+from nipype.utils.filemanip import split_filename
+
+# Column label used by 3dROIstats for each of the statistics it can report,
+# in the order the columns of each ROI are written
+_ROISTAT_LABELS = {
+    'mean': 'NZMean',
+    'voxels': 'NZcount',
+    'sum': 'NZSum',
+    'sigma': 'NZSigma',
+    'median': 'NZMed',
+}
+
+
+def _out_name(in_file, suffix, ext='.nii.gz', newpath=None):
+    """Name outputs the way the equivalent AFNI nodes would have"""
+    _, base, _ = split_filename(in_file)
+    return os.path.join(newpath or os.getcwd(), base + suffix + ext)
+
+
+def _save_like(data, reference, out_file):
+    """Write float32 ``data`` with the geometry of ``reference``"""
+    img = reference.__class__(data.astype(np.float32, copy=False),
+                              reference.affine, reference.header)
+    img.set_data_dtype(np.float32)
+    img.to_filename(out_file)
+    return out_file
+
+
+def _load_labels(dseg_file):
+    """Flat (Fortran order) integer labels of a segmentation"""
+    labels = np.asanyarray(nb.load(dseg_file).dataobj).reshape(-1, order='F')
+    labels = np.where(labels > 0, labels, 0).astype(int)
+    return labels
+
+
+@lru_cache(maxsize=8)
+def _label_matrix(dseg_file, mtime=None):
+    """
+    Sparse (labels x voxels) indicator matrix of a segmentation.
+
+    ``mtime`` is only part of the cache key, so that a segmentation rewritten in
+    place is not served from the cache.
+
+    Returns
+    -------
+    roi_labels : :obj:`numpy.ndarray`
+        Label of each row of ``matrix``
+    matrix : :obj:`scipy.sparse.csr_matrix`
+        ``matrix[i, v]`` is 1 when voxel ``v`` (Fortran order) has label ``roi_labels[i]``
+
+    """
+    labels = _load_labels(dseg_file)
+    roi_labels = np.unique(labels[labels > 0])
+    voxels = np.flatnonzero(labels)
+    rows = np.searchsorted(roi_labels, labels[voxels])
+    matrix = sparse.csr_matrix((np.ones(len(voxels)), (rows, voxels)),
+                               shape=(len(roi_labels), len(labels)))
+    return roi_labels, matrix
+
+
+def _roi_stats(matrix, data, stats, nomeanout=False):
+    """
+    Statistics of the nonzero voxels of every ROI for each column of ``data``.
+
+    Sums and counts are sparse products of the label matrix with the (voxels x time)
+    data, so the cost does not grow with the number of labels.
+
+    Parameters
+    ----------
+    matrix : :obj:`scipy.sparse.csr_matrix`
+        Label matrix from :func:`_label_matrix`
+    data : :obj:`numpy.ndarray`
+        (voxels x sub-bricks) array
+    stats : :obj:`list` of :obj:`str`
+        ``ROIStats`` statistics to compute
+    nomeanout : :obj:`bool`
+        Do not include the zero-inclusive mean
+
+    Returns
+    -------
+    roi_stats : :obj:`list` of :obj:`tuple`
+        ``(name, values)`` pairs as expected by :func:`_write_roistats`
+
+    """
+    nonzero = data != 0
+    roi_size = np.asarray(matrix.sum(axis=1)).ravel()
+    roi_sum = np.asarray(matrix @ data, dtype=np.float64).T
+    roi_count = np.asarray(matrix @ nonzero, dtype=np.float64).T
+    nz_mean = np.divide(roi_sum, roi_count, out=np.zeros_like(roi_sum), where=roi_count > 0)
+
+    results = [] if nomeanout else [('Mean', roi_sum / roi_size)]
+    for stat in _ROISTAT_LABELS:
+        if stat not in stats:
+            continue
+        if stat == 'mean':
+            values = nz_mean
+        elif stat == 'voxels':
+            values = roi_count
+        elif stat == 'sum':
+            values = roi_sum
+        elif stat == 'sigma':
+            deviation = np.where(nonzero, data - matrix.T @ nz_mean.T, 0)
+            values = np.asarray(matrix @ deviation ** 2).T
+            values = np.sqrt(np.divide(values, roi_count - 1, out=np.zeros_like(values),
+                                       where=roi_count > 1))
+        elif stat == 'median':
+            values = np.zeros_like(roi_sum)
+            for idx in range(matrix.shape[0]):
+                voxels = matrix.indices[matrix.indptr[idx]:matrix.indptr[idx + 1]]
+                roi_data = np.where(nonzero[voxels], data[voxels], np.nan)
+                has_data = nonzero[voxels].any(axis=0)
+                values[has_data, idx] = np.nanmedian(roi_data[:, has_data], axis=0)
+        results.append((stat, values))
+    return results
+
+
+def _write_roistats(out_file, in_file, labels, stats):
+    """
+    Write ROI statistics with the layout of ``3dROIstats`` output.
+
+    Parameters
+    ----------
+    out_file : pathlike
+        ``.1D`` file to write
+    in_file : pathlike
+        Name of the dataset reported in the ``File`` column
+    labels : :obj:`numpy.ndarray`
+        ROI labels, one set of columns per label
+    stats : :obj:`list` of :obj:`tuple`
+        ``(name, values)`` pairs, ``name`` being ``'Mean'`` (zero-inclusive mean) or
+        one of the ``ROIStats`` statistics and ``values`` a (sub-bricks x labels) array
+
+    """
+    header = ['File', 'Sub-brick']
+    for label in labels:
+        header += ['%s_%d  ' % (_ROISTAT_LABELS.get(name, name), label)
+                   for name, _ in stats]
+    lines = ['\t'.join(header)]
+    n_briks = stats[0][1].shape[0]
+    for brik in range(n_briks):
+        row = ['%s' % in_file, '%d[#%d]' % (brik, brik)]
+        for idx in range(len(labels)):
+            for name, values in stats:
+                value = values[brik, idx]
+                row.append(' %d' % value if name == 'voxels' else ' %f' % value)
+        lines.append('\t'.join(row))
+    with open(out_file, 'w') as fobj:
+        fobj.write('\n'.join(lines) + '\n')
+    return out_file
+
+
+def _detrended_std(data):
+    """Standard deviation of each row after removing a least squares line (3dTstat -stdev)"""
+    n_t = data.shape[1]
+    if n_t < 2:
+        return np.zeros(data.shape[0])
+    time = np.arange(n_t, dtype=np.float64)
+    time -= time.mean()
+    centered = data - data.mean(axis=1, keepdims=True)
+    slope = centered @ time / (time @ time)
+    ssq = np.einsum('ij,ij->i', centered, centered) - slope ** 2 * (time @ time)
+    return np.sqrt(np.clip(ssq, 0, None) / (n_t - 1))
+
+
+class FusedBoldStatsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="head motion corrected bold series")
+    dseg_file = File(exists=True, mandatory=True,
+                     desc="deterministic segmentation in the space of in_file")
+    n_dummy = traits.Int(0, usedefault=True,
+                         desc="number of dummy scans at the begining of the bold to "
+                              "discard when calculating voxel and roi statistics")
+    block_gb = traits.Float(0.25, usedefault=True,
+                            desc="size in GB of the blocks of voxels processed at once")
+    compress = traits.Bool(True, usedefault=True,
+                           desc="write images as .nii.gz (otherwise uncompressed .nii)")
+
+
+class FusedBoldStatsOutputSpec(TraitedSpec):
+    mean_image = File(exists=True, desc="voxel mean of the bold (3dTstat -mean)")
+    scaled = File(exists=True, desc="bold scaled by its voxel mean (3dcalc)")
+    tsnr = File(exists=True, desc="tsnr of the bold (3dTstat -cvarinvNOD)")
+    tsnr_roi_stats = File(exists=True, desc="sum and voxels of each roi of the tsnr")
+    scaled_std = File(exists=True,
+                      desc="standard deviation of the scaled bold (3dTstat -stdev)")
+    scaled_roi_stats = File(exists=True,
+                            desc="tr-wise sum and voxels of each roi of the scaled bold")
+    grand_std = File(exists=True, desc="standard deviation of each roi of the scaled bold")
+
+
+class FusedBoldStats(SimpleInterface):
+    """
+    Compute every statistic mnitobold extracts from the HMC bold in a single read.
+
+    Replaces the ``scale`` (3dTstat/3dcalc), ``gettsnr`` and ``getstd`` (3dTstat,
+    3dROIstats) workflows, the scaled ``roi_stats`` node (3dROIstats) and
+    ``roi_grand_std``. Outputs are named like the files of the nodes they replace so
+    the sinker substitutions in ``mnitobold`` still apply.
+
+    """
+
+    input_spec = FusedBoldStatsInputSpec
+    output_spec = FusedBoldStatsOutputSpec
+
+    def _run_interface(self, runtime):
+        from ..utils.stats import combine_moments, grand_std_table, label_moments
+
+        in_file = self.inputs.in_file
+        n_dummy = self.inputs.n_dummy
+        img = nb.load(in_file)
+        shape3d = img.shape[:3]
+        data = img.get_fdata(dtype=np.float32).reshape(-1, img.shape[3], order='F')
+        n_vox, n_t = data.shape
+
+        dseg_file = self.inputs.dseg_file
+        labels = _load_labels(dseg_file)
+        if len(labels) != n_vox:
+            raise ValueError('dseg_file and in_file do not have the same number of voxels')
+        roi_labels, matrix = _label_matrix(dseg_file, os.path.getmtime(dseg_file))
+        n_labels = int(labels.max()) + 1
+
+        mean = np.zeros(n_vox, dtype=np.float32)
+        tsnr = np.zeros(n_vox, dtype=np.float32)
+        scaled_std = np.zeros(n_vox, dtype=np.float32)
+        moments = (np.zeros(n_labels),) * 3
+
+        block = max(1, int(self.inputs.block_gb * 1024 ** 3 // (8 * n_t)))
+        for start in range(0, n_vox, block):
+            rows = slice(start, min(start + block, n_vox))
+            values = data[rows].astype(np.float64)
+            kept = values[:, n_dummy:]
+
+            # scale_ref / gettsnr
+            vox_mean = kept.mean(axis=1)
+            vox_std = kept.std(axis=1, ddof=1) if kept.shape[1] > 1 else np.zeros(len(kept))
+            mean[rows] = vox_mean
+            tsnr[rows] = np.divide(np.abs(vox_mean), vox_std,
+                                   out=np.zeros_like(vox_mean), where=vox_std > 0)
+
+            # scale: min(200, a/b*100)*step(a)*step(b)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                scaled = np.minimum(200, values / vox_mean[:, np.newaxis] * 100)
+            scaled[(values <= 0) | (vox_mean[:, np.newaxis] <= 0)] = 0
+            scaled = scaled.astype(np.float32).astype(np.float64)
+            data[rows] = scaled
+
+            # getstd
+            scaled_std[rows] = _detrended_std(scaled[:, n_dummy:])
+
+            # get_grand_std
+            block_labels = labels[rows]
+            inroi = block_labels > 0
+            if inroi.any():
+                moments = combine_moments(moments, label_moments(
+                    scaled[inroi, n_dummy:], block_labels[inroi], n_labels))
+
+        # roi_stats, a few volumes of the scaled bold at a time
+        step = max(1, int(self.inputs.block_gb * 1024 ** 3 // (8 * n_vox)))
+        scaled_roi_stats = [
+            _roi_stats(matrix, data[:, first:first + step], ['sum', 'voxels'])
+            for first in range(0, n_t, step)
+        ]
+        scaled_roi_stats = [
+            (name, np.concatenate([chunk[idx][1] for chunk in scaled_roi_stats]))
+            for idx, (name, _) in enumerate(scaled_roi_stats[0])
+        ]
+
+        ext = '.nii.gz' if self.inputs.compress else '.nii'
+        self._results['mean_image'] = _save_like(
+            mean.reshape(shape3d, order='F'), img, _out_name(in_file, '_mean', ext=ext))
+        self._results['scaled'] = _save_like(
+            data.reshape(img.shape, order='F'), img, _out_name(in_file, '_calc', ext=ext))
+        self._results['tsnr'] = _save_like(
+            tsnr.reshape(shape3d, order='F'), img, _out_name(in_file, '_tstat', ext=ext))
+        self._results['scaled_std'] = _save_like(
+            scaled_std.reshape(shape3d, order='F'), img, _out_name(in_file, '_calc_tstat', ext=ext))
+
+        self._results['tsnr_roi_stats'] = _write_roistats(
+            _out_name(in_file, '_tstat_roistat', ext='.1D'), self._results['tsnr'],
+            roi_labels, _roi_stats(matrix, tsnr[:, np.newaxis], ['sum', 'voxels']))
+        self._results['scaled_roi_stats'] = _write_roistats(
+            _out_name(in_file, '_calc_roistat', ext='.1D'), self._results['scaled'],
+            roi_labels, scaled_roi_stats)
+
+        self._results['grand_std'] = os.path.join(os.getcwd(), 'grand_std.csv')
+        grand_std_table(moments[0], moments[2]).to_csv(self._results['grand_std'])
+        return runtime
+
+
+class SparseROIStatsInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="input dataset")
+    mask_file = File(exists=True, mandatory=True, desc="input mask")
+    stat = InputMultiObject(
+        traits.Enum(list(_ROISTAT_LABELS)),
+        desc="statistics of the nonzero voxels of each roi to compute")
+    nomeanout = traits.Bool(False, usedefault=True,
+                            desc="Do not include the (zero-inclusive) mean among computed stats")
+    mem_gb = traits.Float(1.0, usedefault=True,
+                          desc="memory budget for the volumes read at once")
+
+
+class SparseROIStatsOutputSpec(TraitedSpec):
+    out_file = File(desc="output tab-separated values file", exists=True)
+
+
+class SparseROIStats(SimpleInterface):
+    """
+    Drop-in replacement for AFNI's ``ROIStats`` that runs in-process.
+
+    The segmentation is turned into a sparse (labels x voxels) matrix once, and the
+    statistics of every ROI and TR come from products of that matrix with the
+    (voxels x time) data, read a few volumes at a time. The output has the layout
+    of ``3dROIstats`` and the same name (``<in_file>_roistat.1D``).
+
+    """
+
+    input_spec = SparseROIStatsInputSpec
+    output_spec = SparseROIStatsOutputSpec
+
+    def _run_interface(self, runtime):
+        from ..utils.images import iter_volume_chunks
+
+        mask_file = self.inputs.mask_file
+        roi_labels, matrix = _label_matrix(mask_file, os.path.getmtime(mask_file))
+        stats = self.inputs.stat if isdefined(self.inputs.stat) else []
+        chunks = [
+            _roi_stats(matrix, chunk, stats, nomeanout=self.inputs.nomeanout)
+            for chunk in iter_volume_chunks(self.inputs.in_file, mem_gb=self.inputs.mem_gb)
+        ]
+        roi_stats = [(name, np.concatenate([chunk[idx][1] for chunk in chunks]))
+                     for idx, (name, _) in enumerate(chunks[0])]
+        self._results['out_file'] = _write_roistats(
+            _out_name(self.inputs.in_file, '_roistat', ext='.1D'),
+            self.inputs.in_file, roi_labels, roi_stats)
+        return runtime
@@ -0,0 +1,61 @@
+"""Small file handling interfaces"""
+import os
+import shutil
+import subprocess
+
+from nipype.interfaces.base import (
+    BaseInterfaceInputSpec,
+    SimpleInterface,
+    TraitedSpec,
+    traits,
+    File,
+)
+
+
+class CompressImageInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="image to compress")
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc="number of pigz threads (if pigz is available)")
+    compresslevel = traits.Range(low=1, high=9, value=6, usedefault=True,
+                                 desc="gzip compression level")
+
+
+class CompressImageOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="gzipped image")
+
+
+class CompressImage(SimpleInterface):
+    """
+    Gzip an uncompressed ``.nii`` into ``<name>.nii.gz``.
+
+    Lets the working directory hold uncompressed intermediates while the files
+    handed to the sinker are still compressed. ``pigz`` is used when it is on the
+    ``PATH``; files that are already compressed are passed through untouched.
+
+    """
+
+    input_spec = CompressImageInputSpec
+    output_spec = CompressImageOutputSpec
+
+    def _run_interface(self, runtime):
+        in_file = self.inputs.in_file
+        if not in_file.endswith('.nii'):
+            self._results['out_file'] = in_file
+            return runtime
+
+        out_file = os.path.join(runtime.cwd, os.path.basename(in_file) + '.gz')
+        level = '-%d' % self.inputs.compresslevel
+        pigz = shutil.which('pigz')
+        with open(out_file, 'wb') as fdst:
+            if pigz:
+                subprocess.run([pigz, level, '-p', str(max(1, self.inputs.num_threads)),
+                                '-c', in_file], stdout=fdst, check=True)
+            else:
+                import gzip
+
+                with open(in_file, 'rb') as fsrc, gzip.GzipFile(
+                        filename='', mode='wb', fileobj=fdst,
+                        compresslevel=self.inputs.compresslevel, mtime=0) as gzdst:
+                    shutil.copyfileobj(fsrc, gzdst, 16 * 1024 ** 2)
+        self._results['out_file'] = out_file
+        return runtime
@@ -0,0 +1,65 @@
+"""Tests of the cache of the tool versions"""
+import os
+
+import pytest
+
+from comppsychflows.utils import environment
+
+
+def _executable(directory, name, content='#!/bin/sh\n'):
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / name
+    path.write_text(content)
+    path.chmod(0o755)
+    return path
+
+
+@pytest.fixture
+def probes(tmp_path, monkeypatch):
+    """Tools on a fake PATH whose versions count how often they were probed"""
+    calls = []
+
+    class Info:
+        def __init__(self, tool):
+            self.tool = tool
+
+        def version(self):
+            calls.append(self.tool)
+            return '%s-%d' % (self.tool, len(calls))
+
+    monkeypatch.setattr(environment, '_info', Info)
+    monkeypatch.setattr(environment, '_ENVIRONMENT', None)
+    monkeypatch.setenv('PATH', str(tmp_path / 'bin'))
+    monkeypatch.delenv('ANTSPATH', raising=False)
+    monkeypatch.delenv('FSLDIR', raising=False)
+    for name in ('afni', 'antsRegistration', 'antsApplyTransforms'):
+        _executable(tmp_path / 'bin', name)
+    return calls
+
+
+def test_cache_follows_the_probed_ants(tmp_path, monkeypatch, probes):
+    cache_file = tmp_path / 'environment.json'
+    first = environment.probe_environment(cache_file)
+    assert first['ants']['path'] == str(tmp_path / 'bin' / 'antsRegistration')
+    assert first['fsl'] == {'path': None, 'version': None}
+    assert sorted(probes) == ['afni', 'ants']
+
+    # Another process with the same environment reuses the versions
+    monkeypatch.setattr(environment, '_ENVIRONMENT', None)
+    assert environment.probe_environment(cache_file) == first
+    assert len(probes) == 2
+
+    # nipype runs $ANTSPATH/antsRegistration when ANTSPATH is set
+    ants = _executable(tmp_path / 'ants' / 'bin', 'antsRegistration')
+    monkeypatch.setenv('ANTSPATH', str(ants.parent))
+    monkeypatch.setattr(environment, '_ENVIRONMENT', None)
+    swapped = environment.probe_environment(cache_file)
+    assert swapped['ants']['path'] == str(ants)
+    assert len(probes) == 4
+
+    # An antsRegistration updated in place, while antsApplyTransforms is unchanged
+    ants.write_text('#!/bin/sh\n# 2.5\n')
+    os.utime(ants, ns=(0, os.stat(ants).st_mtime_ns + 10 ** 9))
+    monkeypatch.setattr(environment, '_ENVIRONMENT', None)
+    assert environment.probe_environment(cache_file)['ants'] != swapped['ants']
+    assert len(probes) == 6
@@ -0,0 +1,45 @@
+"""Tests of the run index"""
+import os
+
+import nibabel as nb
+import numpy as np
+
+from comppsychflows.utils.fmriprep import index_runs, is_stale
+from comppsychflows.utils.synthetic import make_fmriprep_dataset
+
+
+def test_index_reprobes_changed_bold(tmp_path):
+    """A bold preprocessed again at the same path is probed again"""
+    fmriprep_dir = make_fmriprep_dataset(tmp_path / 'fmriprep', shape=(8, 8, 6, 5),
+                                         template_shape=(10, 12, 10))
+    index_file = tmp_path / 'index.json'
+    run, = index_runs(fmriprep_dir, index_file=index_file, n_workers=1)
+    assert run['bold_info']['shape'] == (8, 8, 6, 5)
+    assert not is_stale(run)
+
+    bold = nb.load(run['bold_file'])
+    nb.Nifti1Image(np.zeros((8, 8, 6, 9), dtype=np.int16), bold.affine).to_filename(
+        run['bold_file'])
+    # Same size and mtime as an untouched index entry would not be enough
+    os.utime(run['bold_file'], ns=(0, run['files'][run['bold_file']][1] + 1))
+    assert is_stale(run)
+    run, = index_runs(fmriprep_dir, index_file=index_file, n_workers=1)
+    assert run['bold_info']['shape'] == (8, 8, 6, 9)
+
+
+def test_index_reuses_unchanged_runs(tmp_path, monkeypatch):
+    """Unchanged runs come from the index without being probed"""
+    from comppsychflows.utils import fmriprep
+
+    fmriprep_dir = make_fmriprep_dataset(tmp_path / 'fmriprep', shape=(8, 8, 6, 5),
+                                         n_runs=2, template_shape=(10, 12, 10))
+    index_file = tmp_path / 'index.json'
+    first = index_runs(fmriprep_dir, index_file=index_file, n_workers=2)
+
+    def _probe_run(*args):
+        raise AssertionError('probed an unchanged run')
+
+    monkeypatch.setattr(fmriprep, 'probe_run', _probe_run)
+    second = index_runs(fmriprep_dir, index_file=index_file, n_workers=2)
+    assert len(second) == 2
+    assert [run['files'] for run in second] == [run['files'] for run in first]
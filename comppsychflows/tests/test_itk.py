@@ -0,0 +1,57 @@
+"""Tests of the in-memory head motion resampling"""
+import nibabel as nb
+import numpy as np
+
+from comppsychflows.interfaces.itk import SeriesApplyTransforms
+from comppsychflows.utils.synthetic import BOLD_ZOOM, _centered_affine, write_itk_affines
+
+
+def test_identity_keeps_scaled_series(tmp_path, monkeypatch):
+    """A scaled int16 series comes back unchanged through identity transforms"""
+    monkeypatch.chdir(tmp_path)
+    shape = (8, 9, 7, 5)
+    rng = np.random.default_rng(0)
+    raw = rng.integers(0, 1000, size=shape).astype(np.int16)
+    img = nb.Nifti1Image(raw, _centered_affine(shape, BOLD_ZOOM))
+    img.header.set_slope_inter(0.5, 10.0)
+    img.to_filename('bold.nii.gz')
+    write_itk_affines('xforms.txt', [np.eye(4)] * shape[3])
+
+    result = SeriesApplyTransforms(in_file='bold.nii.gz', transforms='xforms.txt',
+                                   order=1, copy_dtype=False, num_threads=2).run()
+    out = nb.load(result.outputs.out_file)
+    assert out.shape == shape
+    assert out.get_data_dtype() == np.float32
+    np.testing.assert_allclose(out.get_fdata(), raw * 0.5 + 10.0, rtol=1e-6)
+
+
+def test_copy_dtype_keeps_scaling(tmp_path, monkeypatch):
+    """Integer outputs keep the slope and intercept of a scaled int16 series"""
+    monkeypatch.chdir(tmp_path)
+    shape = (8, 9, 7, 4)
+    rng = np.random.default_rng(0)
+    raw = rng.integers(-1000, 1000, size=shape).astype(np.int16)
+    img = nb.Nifti1Image(raw, _centered_affine(shape, BOLD_ZOOM))
+    img.header.set_slope_inter(0.25, 100.0)
+    img.to_filename('bold.nii.gz')
+    shift = np.eye(4)
+    shift[0, 3] = 1.3
+    write_itk_affines('identity.txt', [np.eye(4)] * shape[3])
+    write_itk_affines('shift.txt', [shift] * shape[3])
+
+    same = nb.load(SeriesApplyTransforms(in_file='bold.nii.gz', transforms='identity.txt',
+                                         order=1).run().outputs.out_file)
+    assert same.get_data_dtype() == np.int16
+    assert (same.dataobj.slope, same.dataobj.inter) == (0.25, 100.0)
+    np.testing.assert_array_equal(np.asanyarray(same.dataobj.get_unscaled()), raw)
+
+    result = SeriesApplyTransforms(in_file='bold.nii.gz', transforms='shift.txt', order=1,
+                                   out_file='int16.nii.gz').run()
+    float_result = SeriesApplyTransforms(in_file='bold.nii.gz', transforms='shift.txt',
+                                         order=1, copy_dtype=False).run()
+    shifted = nb.load(result.outputs.out_file)
+    assert (shifted.dataobj.slope, shifted.dataobj.inter) == (0.25, 100.0)
+    # Within half a raw unit of the float32 resampling
+    np.testing.assert_allclose(shifted.get_fdata(),
+                               nb.load(float_result.outputs.out_file).get_fdata(),
+                               rtol=0, atol=0.125 + 1e-4)
@@ -0,0 +1,92 @@
+"""Tests of the CPU and memory limits of a job"""
+import pytest
+
+from comppsychflows.utils import limits
+
+
+def _fake_proc(tmp_path, cgroup, mountinfo):
+    proc = tmp_path / 'proc'
+    proc.mkdir()
+    (proc / 'cgroup').write_text(cgroup)
+    (proc / 'mountinfo').write_text(mountinfo)
+    return proc
+
+
+@pytest.fixture
+def cgroup_v2(tmp_path, monkeypatch):
+    """A unified hierarchy where the job's parent cgroup has the limits"""
+    root = tmp_path / 'cgroup2'
+    job = root / 'slurm' / 'job_1'
+    step = job / 'step_0'
+    step.mkdir(parents=True)
+    (step / 'cpu.max').write_text('max 100000\n')
+    (step / 'memory.max').write_text('max\n')
+    (job / 'cpu.max').write_text('400000 100000\n')
+    (job / 'memory.max').write_text('%d\n' % (8 * 1024 ** 3))
+    monkeypatch.setattr(limits, 'PROC_SELF', _fake_proc(
+        tmp_path, '0::/slurm/job_1/step_0\n',
+        '24 30 0:22 / /proc rw - proc proc rw\n'
+        '35 24 0:30 / %s rw,nosuid shared:9 - cgroup2 cgroup2 rw\n' % root))
+    return root
+
+
+@pytest.fixture
+def cgroup_v1(tmp_path, monkeypatch):
+    """Separate cpu and memory hierarchies, mounted from the root of a container"""
+    cpu, memory = tmp_path / 'cpu,cpuacct', tmp_path / 'memory'
+    (cpu / 'job').mkdir(parents=True)
+    (memory / 'job').mkdir(parents=True)
+    (cpu / 'cpu.cfs_quota_us').write_text('-1\n')
+    (cpu / 'cpu.cfs_period_us').write_text('100000\n')
+    (cpu / 'job' / 'cpu.cfs_quota_us').write_text('250000\n')
+    (cpu / 'job' / 'cpu.cfs_period_us').write_text('100000\n')
+    (memory / 'memory.limit_in_bytes').write_text('9223372036854771712\n')
+    (memory / 'job' / 'memory.limit_in_bytes').write_text('%d\n' % (2 * 1024 ** 3))
+    monkeypatch.setattr(limits, 'PROC_SELF', _fake_proc(
+        tmp_path, '5:memory:/docker/abc/job\n4:cpu,cpuacct:/docker/abc/job\n1:name=systemd:/\n',
+        '40 30 0:35 /docker/abc %s rw - cgroup cgroup rw,cpu,cpuacct\n'
+        '41 30 0:36 /docker/abc %s rw - cgroup cgroup rw,memory\n' % (cpu, memory)))
+    return tmp_path
+
+
+def test_cgroup_v2_limits(cgroup_v2):
+    dirs = limits._cgroup_dirs('cpu')
+    assert dirs == [cgroup_v2 / 'slurm' / 'job_1' / 'step_0', cgroup_v2 / 'slurm' / 'job_1',
+                    cgroup_v2 / 'slurm', cgroup_v2]
+    assert limits.cgroup_cpu_limit() == 4
+    assert limits.cgroup_memory_limit_gb() == 8
+    assert limits.available_cpus() <= 4
+
+
+def test_cgroup_v1_limits(cgroup_v1):
+    assert limits._cgroup_dirs('memory') == [cgroup_v1 / 'memory' / 'job', cgroup_v1 / 'memory']
+    assert limits.cgroup_cpu_limit() == 2.5
+    assert limits.cgroup_memory_limit_gb() == 2
+    assert limits.available_memory_gb(fraction=0.5) <= 1
+
+
+def test_no_cgroups(tmp_path, monkeypatch):
+    monkeypatch.setattr(limits, 'PROC_SELF', tmp_path / 'missing')
+    assert limits.cgroup_cpu_limit() is None
+    assert limits.cgroup_memory_limit_gb() is None
+    assert limits.available_cpus() >= 1
+
+
+@pytest.mark.parametrize('n_cpus, n_concurrent, max_threads, expected', [
+    (32, 4, None, 8), (32, 3, None, 10), (32, 64, None, 1), (4, 0, None, 4), (32, 1, 8, 8)])
+def test_threads_per_node(n_cpus, n_concurrent, max_threads, expected):
+    assert limits.threads_per_node(n_cpus, n_concurrent, max_threads) == expected
+
+
+def test_limit_node_threads():
+    pe = pytest.importorskip('nipype.pipeline.engine')
+    from nipype.interfaces.base import CommandLine
+    from nipype.interfaces.utility import IdentityInterface
+
+    workflow = pe.Workflow(name='wf')
+    command = pe.Node(CommandLine(command='true'), name='command', n_procs=16)
+    identity = pe.Node(IdentityInterface(fields=['a']), name='identity')
+    workflow.add_nodes([command, identity])
+    limits.limit_node_threads(workflow, 4)
+    assert command.n_procs == 4 and identity.n_procs == 1
+    assert {command.inputs.environ[variable] for variable in limits.THREAD_VARIABLES} == {'4'}
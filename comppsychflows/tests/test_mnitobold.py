@@ -0,0 +1,12 @@
+"""Tests of the comppsychflows-mnitobold command line"""
+import pytest
+
+
+@pytest.mark.parametrize('mem_gb', ['0', '-4', str(2 * 1024 ** 2)])
+def test_mnitobold_rejects_implausible_memory(mem_gb, capsys):
+    """A job's memory in MB (e.g. $SLURM_MEM_PER_NODE) is caught before anything runs"""
+    from comppsychflows.cli.mnitobold import main
+
+    with pytest.raises(SystemExit):
+        main(['fmriprep', 'out', 'mni.nii.gz', 'dseg.nii.gz', '--mem-gb', mem_gb])
+    assert 'not MB' in capsys.readouterr().err
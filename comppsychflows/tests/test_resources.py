@@ -0,0 +1,58 @@
+"""Tests of the per-node resource estimates"""
+import pytest
+
+from comppsychflows.utils.resources import estimate_bold_resources
+
+INFO = {'shape': (64, 64, 40, 120), 'n_voxels': 64 * 64 * 40, 'n_vols': 120, 'itemsize': 2}
+
+
+def test_estimates_name_built_nodes():
+    """Every estimate applies to a node some configuration of the run workflow builds"""
+    pytest.importorskip('niworkflows')
+    from comppsychflows.cli.mnitobold import OUTPUTS, init_run_wf
+
+    node_names = set()
+    for use_sdc, hmc_engine, stats_engine in ((True, 'ants', 'afni'), (False, 'numpy', 'numpy')):
+        workflow = init_run_wf('run_wf', 1.0, 4, 4, frozenset(OUTPUTS), use_sdc=use_sdc,
+                               hmc_engine=hmc_engine, stats_engine=stats_engine,
+                               use_compression=False)
+        node_names.update(workflow.list_node_names())
+
+    resources = estimate_bold_resources(None, omp_nthreads=4, info=INFO)
+    assert set(resources) - node_names == set()
+
+
+def test_estimates_scale_with_threads():
+    single = estimate_bold_resources(None, omp_nthreads=1, info=INFO)
+    multi = estimate_bold_resources(None, omp_nthreads=8, info=INFO)
+    assert multi['apply_hmc_only.bold_transform']['n_procs'] == 8
+    assert (multi['apply_hmc_only.bold_transform']['mem_gb']
+            > single['apply_hmc_only.bold_transform']['mem_gb'])
+    assert all(res['n_procs'] == 1 for res in single.values())
+
+
+def test_t1w_estimates(tmp_path, monkeypatch):
+    """The template resampling is sized from the T1w grid and the warp, not --node-mem-gb"""
+    from comppsychflows.utils import resources
+
+    # 1mm T1w, 1mm MNI152NLin2009cAsym template and dseg
+    grids = {'T1w.nii.gz': 256 * 256 * 176, 'tpl.nii.gz': 193 * 229 * 193,
+             'dseg.nii.gz': 193 * 229 * 193}
+    monkeypatch.setattr(resources, 'bold_header_info',
+                        lambda path: {'n_voxels': grids[path.rsplit('/', 1)[-1]]})
+    warp = tmp_path / 'xfm.h5'
+    with open(warp, 'wb') as fobj:
+        fobj.truncate(768 * 1024 ** 2)
+
+    estimates = resources.estimate_t1w_resources('T1w.nii.gz', warp, 'tpl.nii.gz',
+                                                 'dseg.nii.gz', omp_nthreads=2)
+    assert estimates == {'template_to_t1w': {'mem_gb': 1.07, 'n_procs': 2},
+                         'dseg_to_t1w': {'mem_gb': 1.19, 'n_procs': 2}}
+    missing = resources.estimate_t1w_resources('T1w.nii.gz', tmp_path / 'missing.h5',
+                                               'tpl.nii.gz', 'dseg.nii.gz')
+    assert missing['template_to_t1w']['mem_gb'] == 1.32
+
+    pytest.importorskip('niworkflows')
+    from comppsychflows.workflows.util import init_subject_template_wf
+
+    assert set(estimates) <= set(init_subject_template_wf(1.0, 2).list_node_names())
@@ -0,0 +1,107 @@
+"""Tests of the state transitions of the run queue"""
+import json
+import os
+import socket
+import subprocess
+import sys
+
+import pytest
+
+from comppsychflows.utils.runqueue import (STATES, claim, finish, init_queue, queue_status,
+                                           requeue, submit)
+
+
+def _status(**counts):
+    return {state: counts.get(state, 0) for state in STATES}
+
+
+def test_claim_in_name_order(tmp_path):
+    queue = init_queue(tmp_path / 'queue')
+    for name in ('b', 'a', 'c'):
+        submit(queue, ['fmriprep', 'out', name], name=name)
+    assert queue_status(queue) == _status(pending=3)
+
+    spec_file, spec = claim(queue)
+    assert spec_file == queue / 'running' / 'a.json'
+    assert spec['args'] == ['fmriprep', 'out', 'a']
+    assert (spec['host'], spec['pid']) == (socket.gethostname(), os.getpid())
+    assert json.loads(spec_file.read_text()) == spec
+    assert queue_status(queue) == _status(pending=2, running=1)
+
+
+def test_finish(tmp_path):
+    queue = tmp_path / 'queue'
+    submit(queue, ['a'], name='a')
+    submit(queue, ['b'], name='b')
+    submit(queue, ['c'], name='c')
+
+    done = finish(*claim(queue), 'done', returncode=0)
+    assert done == queue / 'done' / 'a.json'
+    assert json.loads(done.read_text())['returncode'] == 0
+    failed = finish(*claim(queue), 'failed', error='boom')
+    assert json.loads(failed.read_text())['error'] == 'boom'
+    # A worker that stops early gives its run back untouched
+    pending = finish(*claim(queue), 'pending')
+    assert set(json.loads(pending.read_text())) == {'args', 'submitted'}
+    assert queue_status(queue) == _status(pending=1, done=1, failed=1)
+    assert claim(queue)[0].name == 'c.json'
+    assert claim(queue) == (None, None)
+
+
+def test_duplicate_names_are_rejected(tmp_path):
+    queue = tmp_path / 'queue'
+    submit(queue, ['a'], name='a')
+    finish(*claim(queue), 'done')
+    with pytest.raises(FileExistsError):
+        submit(queue, ['a'], name='a')
+    assert len({submit(queue, ['b']).name for _ in range(3)}) == 3
+
+
+def test_requeue(tmp_path):
+    queue = tmp_path / 'queue'
+    for name in ('alive', 'dead', 'elsewhere', 'failed'):
+        submit(queue, [name], name=name)
+    claim(queue)
+    dead, dead_spec = claim(queue)
+    elsewhere, elsewhere_spec = claim(queue)
+    failed = finish(*claim(queue), 'failed', error='boom')
+
+    # A pid that belonged to a worker that exited
+    child = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                           capture_output=True, text=True, check=True)
+    dead.write_text(json.dumps(dict(dead_spec, pid=int(child.stdout))))
+    elsewhere.write_text(json.dumps(dict(elsewhere_spec, host='another-host', pid=1)))
+
+    assert requeue(queue) == ['dead']
+    spec = json.loads((queue / 'pending' / 'dead.json').read_text())
+    assert spec['attempts'] == 1 and 'pid' not in spec
+    assert requeue(queue, failed=True) == ['failed']
+    assert 'error' not in json.loads((queue / 'pending' / failed.name).read_text())
+    assert queue_status(queue) == _status(pending=2, running=2)
+    assert requeue(queue, all_running=True) == ['alive', 'elsewhere']
+    assert queue_status(queue) == _status(pending=4)
+
+
+def test_worker_restores_nipype_config(tmp_path, monkeypatch):
+    """A run with --profile does not leave the resource monitor on for the next ones"""
+    from nipype import config
+    from comppsychflows.cli import mnitobold, worker
+
+    def fake_mnitobold(args):
+        if '--profile' in args:
+            config._resource_monitor = True
+            config.set('monitoring', 'enabled', 'true')
+            config.set('monitoring', 'sample_frequency', '0.1')
+        seen.append((config.resource_monitor, config.get('monitoring', 'enabled')))
+
+    seen = []
+    monkeypatch.setattr(mnitobold, 'main', fake_mnitobold)
+    enabled = config.get('monitoring', 'enabled')
+    frequency = config.get('monitoring', 'sample_frequency')
+    queue = tmp_path / 'queue'
+    submit(queue, ['--profile'], name='a')
+    submit(queue, [], name='b')
+    assert worker.serve(queue) == {'done': 2, 'failed': 0}
+    assert seen[0][1] == 'true' and seen[1] == (False, enabled)
+    assert config.get('monitoring', 'sample_frequency') == frequency
+    assert not config.resource_monitor
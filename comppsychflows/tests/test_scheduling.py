@@ -0,0 +1,56 @@
+"""Tests of the selection and sharding of runs"""
+import pytest
+
+from comppsychflows.utils.scheduling import (assign_shards, parse_shard, run_cost, select_runs,
+                                             shard_runs)
+
+
+def _run(name, subject='01', n_vols=100):
+    return {'subject': subject, 'func_wd': '/work/func_preproc_%s_wf' % name,
+            'bold_file': '/fmriprep/sub-%s_%s_bold.nii.gz' % (subject, name),
+            'bold_info': {'n_voxels': 1000, 'n_vols': n_vols} if n_vols else None}
+
+
+@pytest.mark.parametrize('value, expected', [('0/1', (0, 1)), ('9/10', (9, 10)),
+                                             (' 2 / 4 ', (2, 4))])
+def test_parse_shard(value, expected):
+    assert parse_shard(value) == expected
+
+
+@pytest.mark.parametrize('value', ['1/1', '4/3', '-1/3', '1', '1/2/3', 'a/b', '0/0'])
+def test_parse_shard_rejects(value):
+    with pytest.raises(ValueError):
+        parse_shard(value)
+
+
+@pytest.mark.parametrize('n_shards', [1, 3, 7, 50])
+def test_shards_cover_runs_once(n_shards):
+    runs = [_run('task-rest_run-%d' % idx, n_vols=(idx * 37) % 300 or None)
+            for idx in range(40)]
+    shards = [shard_runs(runs, index, n_shards) for index in range(n_shards)]
+    names = [run['bold_file'] for shard in shards for run in shard]
+    assert sorted(names) == sorted(run['bold_file'] for run in runs)
+    # Every job computes the same assignment
+    assert shards == [shard_runs(runs, index, n_shards) for index in range(n_shards)]
+
+
+def test_shards_are_balanced():
+    costs = [(idx * 7919) % 101 + 1 for idx in range(200)]
+    shards = assign_shards(costs, 8)
+    loads = [sum(cost for cost, shard in zip(costs, shards) if shard == index)
+             for index in range(8)]
+    # Longest-processing-time-first is off by at most the largest item
+    assert max(loads) - min(loads) <= max(costs)
+
+
+def test_run_cost():
+    assert run_cost(_run('a', n_vols=10)) == 10000
+    assert run_cost(_run('a', n_vols=None)) == 1
+
+
+def test_select_runs():
+    runs = [_run('task-rest_run-1'), _run('task-nback_run-1'), _run('task-rest_run-1', '02')]
+    assert select_runs(runs) == runs
+    assert select_runs(runs, ['sub-02']) == runs[2:]
+    assert select_runs(runs, ['01'], 'task-rest') == runs[:1]
+    assert select_runs(runs, run_filter='^func_preproc_task-nback') == runs[1:2]
@@ -0,0 +1,53 @@
+"""Tests of the label-wise moments of the numpy statistics engines"""
+from functools import reduce
+
+import numpy as np
+import pytest
+
+from comppsychflows.utils.stats import combine_moments, label_moments
+
+
+@pytest.fixture
+def series():
+    rng = np.random.default_rng(0)
+    labels = rng.integers(0, 6, size=500)
+    # A large offset makes the naive sum of squares lose the variance
+    data = 1e6 + rng.normal(scale=np.arange(1, 7)[labels, np.newaxis], size=(500, 40))
+    return data, labels
+
+
+def _expected(data, labels, minlength):
+    present = [label for label in range(minlength) if (labels == label).any()]
+    return (present, [data[labels == label].mean() for label in present],
+            [data[labels == label].std() for label in present])
+
+
+@pytest.mark.parametrize('n_chunks', [1, 3, 40])
+def test_chunked_moments_match_numpy(series, n_chunks):
+    """Volumes accumulated chunk by chunk give numpy's mean and std of each label"""
+    data, labels = series
+    chunks = np.array_split(data, n_chunks, axis=1)
+    count, mean, m2 = reduce(combine_moments, (label_moments(chunk, labels, minlength=7)
+                                               for chunk in chunks))
+    present, means, stds = _expected(data, labels, 7)
+    assert len(count) == 7 and count[6] == 0 and mean[6] == 0 and m2[6] == 0
+    assert count[present].tolist() == [(labels == label).sum() * 40 for label in present]
+    assert np.allclose(mean[present], means, rtol=0, atol=1e-6)
+    assert np.allclose(np.sqrt(m2[present] / count[present]), stds, rtol=1e-9)
+
+
+def test_combine_pads_shorter_moments(series):
+    """Chunks whose labels stop early are merged with the others label by label"""
+    data, labels = series
+    low = labels < 3
+    merged = combine_moments(label_moments(data[low], labels[low]),
+                             label_moments(data[~low], labels[~low]))
+    assert all(np.allclose(a, b) for a, b in zip(merged, label_moments(data, labels)))
+
+
+def test_empty_chunk_is_neutral(series):
+    data, labels = series
+    moments = label_moments(data, labels)
+    empty = (np.zeros(6), np.zeros(6), np.zeros(6))
+    for merged in (combine_moments(moments, empty), combine_moments(empty, moments)):
+        assert all(np.array_equal(a, b) for a, b in zip(merged, moments))
@@ -0,0 +1,117 @@
+"""Tests of the swarm and SLURM job file generator"""
+import re
+import shlex
+
+import pytest
+
+from comppsychflows.cli.swarm import main, parse_jobhist, read_commands, write_job_files
+from comppsychflows.utils.scheduling import pack_runs
+from comppsychflows.utils.synthetic import make_fmriprep_dataset
+
+JOBHIST = """\
+Jobid        : 123
+User         : someone
+
+Jobid          Partition    State      Nodes  CPUs  Walltime  Runtime  MemReq  MemUsed  Nodename
+123_0          norm         COMPLETED  1      4     1:00:00   0:10:00  4.0GB   1.0GB    cn1
+123_1          norm         TIMEOUT    1      4     1:00:00   1:00:00  4.0GB   1.0GB    cn2
+123_2          norm         OUT_OF_MEMORY 1   4     1:00:00   0:30:00  4.0GB   4.0GB    cn3
+"""
+
+SACCT = """\
+JobID|State
+124_0|FAILED
+124_0.batch|FAILED
+124_1|COMPLETED
+124_2|CANCELLED by 42
+124|COMPLETED
+"""
+
+
+def test_pack_runs_fits_jobs():
+    cpu_hours = [5, 1, 4, 2, 3, 3, 0.5]
+    jobs = pack_runs(cpu_hours, [1] * 7, job_cpus=2, job_mem_gb=4, job_hours=4)
+    assert sorted(run for job in jobs for run in job) == list(range(7))
+    assert all(sum(cpu_hours[run] for run in job) <= 8 for job in jobs)
+    assert len(jobs) == 3
+
+
+def test_pack_runs_fits_memory():
+    """Runs whose CPU hours fit in one job are split when they would not fit in memory"""
+    mem_gb = [3, 3, 3, 3, 1, 1]
+    jobs = pack_runs([1] * 6, mem_gb, job_cpus=4, job_mem_gb=7, job_hours=10)
+    assert sorted(run for job in jobs for run in job) == list(range(6))
+    assert all(sum(sorted((mem_gb[run] for run in job), reverse=True)[:4]) <= 7
+               for job in jobs)
+    assert len(jobs) == 2
+    # Only job_cpus runs are counted at once
+    assert pack_runs([1] * 6, [2] * 6, job_cpus=2, job_mem_gb=4, job_hours=10) == [
+        list(range(6))]
+
+
+@pytest.mark.parametrize('cpu_hours, mem_gb', [([9], [1]), ([1], [5])])
+def test_pack_runs_rejects_oversized_runs(cpu_hours, mem_gb):
+    with pytest.raises(ValueError):
+        pack_runs(cpu_hours, mem_gb, job_cpus=2, job_mem_gb=4, job_hours=4)
+
+
+def test_write_swarm_file(tmp_path):
+    out_file, = write_job_files(['echo 1', 'echo 2'], tmp_path / 'jobs.swarm', job_cpus=8,
+                                job_mem_gb=16, job_hours=1.5, job_name='test')
+    assert open(out_file).read().splitlines() == [
+        '#SWARM -t 8 -g 16 --time 1:30:00 --job-name test', '#SWARM --gres=lscratch:200',
+        'echo 1', 'echo 2']
+    assert read_commands(out_file) == ['echo 1', 'echo 2']
+
+
+def test_write_slurm_files(tmp_path):
+    commands_file, sbatch_file = write_job_files(
+        ['echo 1', 'echo 2', 'echo 3'], tmp_path / 'jobs.txt', fmt='slurm', job_cpus=4,
+        job_mem_gb=7.5, job_hours=24, gres=None)
+    assert read_commands(commands_file) == ['echo 1', 'echo 2', 'echo 3']
+    sbatch = open(sbatch_file).read()
+    assert sbatch_file == str(tmp_path / 'jobs.sbatch')
+    for directive in ('--array=0-2', '--cpus-per-task=4', '--mem=7.5G', '--time=24:00:00'):
+        assert '#SBATCH %s\n' % directive in sbatch
+    assert '--gres' not in sbatch
+
+
+@pytest.mark.parametrize('content, expected', [
+    (JOBHIST, {0: 'COMPLETED', 1: 'TIMEOUT', 2: 'OUT_OF_MEMORY'}),
+    (SACCT, {0: 'FAILED', 1: 'COMPLETED', 2: 'CANCELLED'})])
+def test_parse_jobhist(tmp_path, content, expected):
+    (tmp_path / 'jobhist.txt').write_text(content)
+    assert parse_jobhist(tmp_path / 'jobhist.txt') == expected
+
+
+def test_write_and_resubmit(tmp_path, capsys):
+    fmriprep_dir = make_fmriprep_dataset(tmp_path / 'fmriprep', shape=(8, 8, 6, 5),
+                                         n_subjects=2, n_runs=2, template_shape=(10, 12, 10))
+    swarm_file = tmp_path / 'mnitobold.swarm'
+    # Each run needs more than half of a job's CPU hours, so every run gets its own job
+    main(['write', fmriprep_dir, str(tmp_path / 'out'), 'mni.nii.gz', 'dseg.nii.gz',
+          '-o', str(swarm_file), '--job-cpus', '4', '--job-mem-gb', '10', '--job-hours', '1',
+          '--cpu-hours-per-gvox', str(3e9 / 1920), '--', '--stats-engine', 'numpy'])
+    assert capsys.readouterr().out.split() == [str(swarm_file)]
+    commands = read_commands(swarm_file)
+    assert len(commands) == 4
+
+    bold_names = []
+    for command in commands:
+        args = shlex.split(command)
+        assert args[0] == 'comppsychflows-mnitobold'
+        assert args[args.index('--mem-gb') + 1] == '9'
+        assert args[-2:] == ['--stats-engine', 'numpy']
+        run_filter = args[args.index('--run-filter') + 1]
+        assert re.fullmatch(r'\^\(.+\)\$', run_filter)
+        bold_names += re.sub(r'\\(.)', r'\1', run_filter[2:-2]).split('|')
+    assert len(set(bold_names)) == 4
+    assert all(name.endswith('_bold.nii.gz') for name in bold_names)
+
+    jobhist = tmp_path / 'sacct.txt'
+    jobhist.write_text('JobID|State\n1_0|COMPLETED\n1_1|TIMEOUT\n1_2|FAILED\n1_3|RUNNING\n')
+    resubmit_file = tmp_path / 'retry.swarm'
+    main(['resubmit', str(swarm_file), str(jobhist), '-o', str(resubmit_file),
+          '--job-hours', '2'])
+    assert read_commands(resubmit_file) == commands[1:3]
+    assert '--time 2:00:00' in open(resubmit_file).readline()
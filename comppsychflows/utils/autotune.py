@@ -0,0 +1,187 @@
+"""Model the time of the mnitobold steps against their threads and pick the threads per node"""
+import json
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+
+# Calibrated steps and whether their time grows with the number of volumes
+STEPS = {
+    'hmc': True,             # split, MultiApplyTransforms (or the in-memory resampling), merge
+    'backtransform': False,  # ApplyTransforms of the template and dseg into bold space
+    'stats': True,           # TStat and ROIStats (or their numpy counterparts)
+}
+
+
+def typical_shape(runs):
+    """
+    Most common bold geometry of a list of runs.
+
+    Parameters
+    ----------
+    runs : :obj:`list` of :obj:`dict`
+        Runs as returned by :func:`comppsychflows.utils.fmriprep.index_runs`
+
+    Returns
+    -------
+    shape : :obj:`tuple` or None
+        4D shape, ``None`` when no header could be read
+
+    Examples
+    --------
+    >>> typical_shape([{'bold_info': {'shape': (64, 64, 40, 120)}},
+    ...                {'bold_info': {'shape': (64, 64, 40, 120)}},
+    ...                {'bold_info': {'shape': (72, 72, 48, 300)}}, {'bold_info': None}])
+    (64, 64, 40, 120)
+
+    """
+    shapes = Counter(tuple(run['bold_info']['shape']) for run in runs if run.get('bold_info'))
+    if not shapes:
+        return None
+    return shapes.most_common(1)[0][0]
+
+
+def fit_step(threads, seconds):
+    """
+    Fit ``seconds = serial_s + parallel_s / threads`` to the timings of a step.
+
+    Both terms are kept non-negative: when the best fit has a negative one, the
+    other is fitted alone.
+
+    Parameters
+    ----------
+    threads : :obj:`list` of :obj:`int`
+        Threads of each timed task
+    seconds : :obj:`list` of :obj:`float`
+        Its wall time
+
+    Returns
+    -------
+    fit : :obj:`dict`
+        ``serial_s`` and ``parallel_s``
+
+    Examples
+    --------
+    >>> fit = fit_step([1, 2, 4], [10.0, 6.0, 4.0])
+    >>> round(fit['serial_s'], 6), round(fit['parallel_s'], 6)
+    (2.0, 8.0)
+    >>> fit_step([1, 2, 4], [4.0, 5.0, 6.0])
+    {'serial_s': 5.0, 'parallel_s': 0.0}
+
+    """
+    inverse = 1 / np.asarray(threads, dtype=float)
+    seconds = np.asarray(seconds, dtype=float)
+    if len(set(threads)) > 1:
+        design = np.column_stack([np.ones_like(inverse), inverse])
+        (serial, parallel), *_ = np.linalg.lstsq(design, seconds, rcond=None)
+        if serial >= 0 and parallel >= 0:
+            return {'serial_s': float(serial), 'parallel_s': float(parallel)}
+    # A step that does not speed up with threads, or did not slow down without them
+    parallel = float(inverse @ seconds / (inverse @ inverse))
+    residuals = {'serial': ((seconds - seconds.mean()) ** 2).sum(),
+                 'parallel': ((seconds - parallel * inverse) ** 2).sum()}
+    if residuals['serial'] <= residuals['parallel']:
+        return {'serial_s': float(seconds.mean()), 'parallel_s': 0.0}
+    return {'serial_s': 0.0, 'parallel_s': parallel}
+
+
+def run_seconds(tuning, threads, n_vols):
+    """Predicted seconds of the calibrated steps of a run of ``n_vols`` volumes"""
+    total = 0.0
+    for step, fit in tuning['steps'].items():
+        seconds = fit['serial_s'] + fit['parallel_s'] / threads
+        if STEPS.get(step, True):
+            seconds *= n_vols / tuning['calibration_vols']
+        total += seconds
+    return total
+
+
+def recommend(tuning, n_cpus, n_runs, n_vols):
+    """
+    Threads per node that process ``n_runs`` runs the fastest on ``n_cpus`` CPUs.
+
+    Runs go in waves of ``n_cpus // threads`` concurrent runs. The step timings
+    were measured with that many concurrent tasks, so they include the cost of
+    sharing caches and memory bandwidth.
+
+    Parameters
+    ----------
+    tuning : :obj:`dict`
+        Calibration written by ``comppsychflows-autotune`` (see :func:`load_tuning`)
+    n_cpus : :obj:`int`
+        CPUs of the job
+    n_runs : :obj:`int`
+        Runs to process
+    n_vols : :obj:`int`
+        Volumes of a typical run
+
+    Returns
+    -------
+    recommendation : :obj:`dict`
+        ``omp_nthreads``, ``concurrent_runs`` and the ``predicted_s`` wall time
+
+    Examples
+    --------
+    >>> tuning = {'calibration_vols': 10, 'steps': {
+    ...     'hmc': {'serial_s': 1.0, 'parallel_s': 9.0},
+    ...     'backtransform': {'serial_s': 2.0, 'parallel_s': 8.0}}}
+    >>> recommend(tuning, 8, 64, 10)['omp_nthreads']
+    1
+    >>> recommend(tuning, 8, 1, 10)
+    {'omp_nthreads': 8, 'concurrent_runs': 1, 'predicted_s': 5.125}
+
+    """
+    best = None
+    n_runs = max(1, n_runs)
+    for threads in range(1, n_cpus + 1):
+        concurrent = min(n_runs, n_cpus // threads)
+        waves = -(-n_runs // concurrent)
+        seconds = waves * run_seconds(tuning, threads, n_vols)
+        # Ties go to fewer threads, which leave more room to other jobs
+        if best is None or seconds < best['predicted_s'] * (1 - 1e-9):
+            best = {'omp_nthreads': threads, 'concurrent_runs': concurrent,
+                    'predicted_s': seconds}
+    return best
+
+
+def tuning_mismatches(tuning, **job):
+    """
+    Settings of a job that differ from the ones ``tuning`` was calibrated with.
+
+    The step timings only hold for the engines that were timed, and for as many
+    CPUs as were filled with concurrent copies of each step while timing them.
+    Settings a tuning file does not record are not compared.
+
+    Parameters
+    ----------
+    tuning : :obj:`dict`
+        Calibration written by ``comppsychflows-autotune``
+    job : :obj:`dict`
+        Settings of the job, e.g. ``n_cpus``, ``hmc_engine`` and ``stats_engine``
+
+    Returns
+    -------
+    mismatches : :obj:`dict`
+        Maps each differing setting to its ``(calibrated, job)`` values
+
+    Examples
+    --------
+    >>> tuning = {'n_cpus': 32, 'hmc_engine': 'ants', 'stats_engine': 'afni'}
+    >>> tuning_mismatches(tuning, n_cpus=32, hmc_engine='ants', stats_engine='afni')
+    {}
+    >>> tuning_mismatches(tuning, n_cpus=4, hmc_engine='ants', stats_engine='numpy')
+    {'n_cpus': (32, 4), 'stats_engine': ('afni', 'numpy')}
+    >>> tuning_mismatches({'steps': {}}, n_cpus=4)
+    {}
+
+    """
+    return {key: (tuning[key], value) for key, value in job.items()
+            if key in tuning and tuning[key] != value}
+
+
+def load_tuning(tuning_file):
+    """Read a tuning file written by ``comppsychflows-autotune``"""
+    tuning = json.loads(Path(tuning_file).read_text())
+    if not tuning.get('steps') or not tuning.get('calibration_vols'):
+        raise ValueError('%s has no calibration of the mnitobold steps' % tuning_file)
+    return tuning
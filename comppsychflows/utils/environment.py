@@ -0,0 +1,153 @@
+"""Probe the versions of the neuroimaging tools once and cache them across processes"""
+import json
+import os
+import shutil
+from pathlib import Path
+
+# Bumped whenever the layout of the cache file changes
+CACHE_VERSION = 2
+
+# Executable nipype runs to get the version of each tool (looked up on the PATH),
+# and the nipype module whose ``Info`` reports it
+TOOLS = {
+    'afni': ('afni', 'nipype.interfaces.afni.base'),
+    'ants': ('antsRegistration', 'nipype.interfaces.ants.base'),
+    'fsl': ('fslmaths', 'nipype.interfaces.fsl.base'),
+}
+
+_ENVIRONMENT = None
+
+
+def default_cache_file():
+    """``$COMPPSYCHFLOWS_ENV_CACHE``, or ``environment.json`` in the user cache directory"""
+    if os.getenv('COMPPSYCHFLOWS_ENV_CACHE'):
+        return Path(os.environ['COMPPSYCHFLOWS_ENV_CACHE'])
+    cache_home = Path(os.getenv('XDG_CACHE_HOME', Path.home() / '.cache'))
+    return cache_home / 'comppsychflows' / 'environment.json'
+
+
+def _info(tool):
+    from importlib import import_module
+
+    return import_module(TOOLS[tool][1]).Info
+
+
+def _locate(tool):
+    """Path and ``[size, mtime_ns]`` of the executable (and version file) of ``tool``"""
+    executable = TOOLS[tool][0]
+    if tool == 'ants' and os.getenv('ANTSPATH'):
+        # nipype runs $ANTSPATH/antsRegistration rather than the one on the PATH
+        executable = os.path.join(os.environ['ANTSPATH'], executable)
+    located = {'path': shutil.which(executable), 'stat': None}
+    paths = [located['path']]
+    if tool == 'fsl' and os.getenv('FSLDIR'):
+        # nipype reads FSL's version from this file rather than running a command
+        paths.append(os.path.join(os.environ['FSLDIR'], 'etc', 'fslversion'))
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path) if path else None
+        except OSError:
+            st = None
+        stats.append([st.st_size, st.st_mtime_ns] if st else None)
+    located['stat'] = stats
+    return located
+
+
+def _fingerprint():
+    """What the cached versions depend on; the cache is reused while it is unchanged"""
+    return {
+        'PATH': os.getenv('PATH', ''),
+        'FSLDIR': os.getenv('FSLDIR', ''),
+        'ANTSPATH': os.getenv('ANTSPATH', ''),
+        'tools': {tool: _locate(tool) for tool in TOOLS},
+    }
+
+
+def _to_json(version):
+    return list(version) if isinstance(version, tuple) else version
+
+
+def probe_environment(cache_file=None, refresh=False):
+    """
+    Version and executable of AFNI, ANTs and FSL, probed at most once.
+
+    Versions are read from ``cache_file`` when the ``PATH``, ``FSLDIR``,
+    ``ANTSPATH`` and the size and mtime of each executable match the ones
+    recorded there; otherwise the tools are asked for their version (one
+    subprocess each) and the cache is rewritten. Within a process the result is
+    kept in memory.
+
+    Parameters
+    ----------
+    cache_file : pathlike
+        Cache file (default: :func:`default_cache_file`)
+    refresh : :obj:`bool`
+        Ignore the cache and probe the tools again
+
+    Returns
+    -------
+    environment : :obj:`dict`
+        Maps each tool to its executable ``path`` and ``version`` (``None`` for
+        tools that are not installed)
+
+    """
+    global _ENVIRONMENT
+    if _ENVIRONMENT is not None and not refresh:
+        return _ENVIRONMENT
+
+    cache_file = Path(cache_file) if cache_file else default_cache_file()
+    fingerprint = _fingerprint()
+    cached = None
+    if not refresh:
+        try:
+            cached = json.loads(cache_file.read_text())
+        except (OSError, ValueError):
+            cached = None
+    if (cached is None or cached.get('version') != CACHE_VERSION
+            or cached.get('fingerprint') != fingerprint):
+        versions = {tool: (_to_json(_info(tool).version())
+                           if fingerprint['tools'][tool]['path'] else None)
+                    for tool in TOOLS}
+        cached = {'version': CACHE_VERSION, 'fingerprint': fingerprint, 'versions': versions}
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = cache_file.with_name(cache_file.name + '.tmp%d' % os.getpid())
+            tmp_file.write_text(json.dumps(cached, indent=1))
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            pass
+
+    _ENVIRONMENT = {
+        tool: {'path': fingerprint['tools'][tool]['path'],
+               'version': cached['versions'][tool]}
+        for tool in TOOLS
+    }
+    return _ENVIRONMENT
+
+
+def tool_version(tool):
+    """Version of ``tool`` as nipype's ``Info.version()`` reports it (``None`` if missing)"""
+    version = probe_environment()[tool]['version']
+    return tuple(version) if isinstance(version, list) else version
+
+
+def prime_nipype_versions(environment=None):
+    """
+    Seed the version cache of nipype's ``Info`` classes.
+
+    nipype only runs ``<tool> --version`` when ``Info._version`` is unset, so
+    interfaces built or run afterwards in this process (and in the workers it
+    forks) reuse the probed versions.
+
+    Parameters
+    ----------
+    environment : :obj:`dict`
+        Output of :func:`probe_environment` (default: probe it)
+
+    """
+    environment = environment or probe_environment()
+    for tool in TOOLS:
+        version = environment[tool]['version']
+        if version is not None:
+            _info(tool)._version = tuple(version) if isinstance(version, list) else version
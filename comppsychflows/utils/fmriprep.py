@@ -0,0 +1,184 @@
+"""Find the inputs of each run in an fmriprep output and working directory"""
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .resources import bold_header_info
+
+# Bumped whenever the layout of an indexed run changes
+INDEX_VERSION = 4
+
+# Paths of the inputs of a run, relative to its fmriprep func working directory
+_FUNC_WD_PATHS = {
+    'sdc': 'sdc_estimate_wf/pepolar_unwarp_wf/qwarp/Qwarp_PLUS_WARP.nii.gz',
+    'ref': 'bold_reference_wf/enhance_and_skullstrip_bold_wf/n4_correct/ref_bold_corrected.nii.gz',
+    'hmc_transform': 'bold_hmc_wf/fsl2itk/mat2itk.txt',
+    't1_to_bold': 'bold_reg_wf/bbreg_wf/concat_xfm/out_inv.tfm',
+    'split_bolds_dir': 'bold_split',
+    'validate_dir': 'bold_reference_wf/validate',
+}
+# Paths of the anatomical inputs of a subject, relative to the fmriprep output directory
+_ANAT_PATHS = {
+    'mni_to_t1': 'fmriprep/sub-{subject}/anat/'
+                 'sub-{subject}_from-MNI152NLin2009cAsym_to-T1w_mode-image_xfm.h5',
+    't1w_ref': 'fmriprep/sub-{subject}/anat/sub-{subject}_desc-preproc_T1w.nii.gz',
+}
+
+
+def _stat(path):
+    """``[size, mtime_ns]`` of ``path``, or ``None`` if it does not exist"""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+def probe_run(func_wd, fmriprep_odir):
+    """
+    Resolve the inputs of a run and record the size and mtime of each of them.
+
+    Parameters
+    ----------
+    func_wd : pathlike
+        fmriprep working directory of the run
+        (``wrk/fmriprep_wf/single_subject_<label>_wf/func_preproc_..._wf``)
+    fmriprep_odir : pathlike
+        fmriprep output directory
+
+    Returns
+    -------
+    run : :obj:`dict`
+        Input paths of the run (as strings), the ``bold_file`` fmriprep processed
+        (``None`` when its validate node did not run), its header geometry ``bold_info``
+        (see :func:`~comppsychflows.utils.resources.bold_header_info`, ``None`` when
+        it cannot be read), the ``split_bolds`` volumes, and ``files``, the
+        ``[size, mtime_ns]`` of every probed path and of the bold (``None`` for paths
+        that do not exist) used to tell when the run has to be probed again
+
+    """
+    from nibabel.filebasedimages import ImageFileError
+
+    func_wd = Path(func_wd)
+    subject = re.findall('subject_([0-9]*)', func_wd.as_posix())[0]
+    run = {'func_wd': func_wd.as_posix(), 'subject': subject}
+    for key, rel_path in _FUNC_WD_PATHS.items():
+        run[key] = (func_wd / rel_path).as_posix()
+    for key, rel_path in _ANAT_PATHS.items():
+        run[key] = (Path(fmriprep_odir) / rel_path.format(subject=subject)).as_posix()
+
+    run['split_bolds'] = sorted(
+        vol.as_posix() for vol in Path(run['split_bolds_dir']).glob('vol*.nii.gz'))
+    validate_jsons = sorted(Path(run['validate_dir']).glob('*.json'))
+    run['bold_file'] = None
+    if validate_jsons:
+        run['bold_file'] = json.loads(validate_jsons[0].read_text())[0][1][0]
+    run['bold_info'] = None
+    if run['bold_file'] is not None:
+        try:
+            run['bold_info'] = bold_header_info(run['bold_file'])
+        except (OSError, ValueError, ImageFileError):
+            pass
+
+    run['files'] = {
+        run[key]: _stat(run[key]) for key in list(_FUNC_WD_PATHS) + list(_ANAT_PATHS)}
+    # A bold preprocessed again at the same path must not keep its old geometry
+    if run['bold_file'] is not None:
+        run['files'][run['bold_file']] = _stat(run['bold_file'])
+    return run
+
+
+def is_stale(run):
+    """Whether any file recorded in ``run['files']`` was created, changed or removed"""
+    return any(_stat(path) != stat for path, stat in run['files'].items())
+
+
+def find_func_wds(fmriprep_wdir, n_workers=16):
+    """
+    List the func working directories of every subject.
+
+    Parameters
+    ----------
+    fmriprep_wdir : pathlike
+        fmriprep working directory (containing ``fmriprep_wf``)
+    n_workers : :obj:`int`
+        Number of subject directories listed concurrently
+
+    Returns
+    -------
+    func_wds : :obj:`list` of :obj:`pathlib.Path`
+        Sorted like ``glob('single_subject_*_wf/func*')``
+
+    """
+    subject_wds = sorted((Path(fmriprep_wdir) / 'fmriprep_wf').glob('single_subject_*_wf'))
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+        listed = pool.map(lambda subject_wd: sorted(subject_wd.glob('func*')), subject_wds)
+    return sorted(func_wd for func_wds in listed for func_wd in func_wds)
+
+
+def load_index(index_file):
+    """Runs of a run index keyed by func working directory (empty if unusable)"""
+    try:
+        index = json.loads(Path(index_file).read_text())
+    except (OSError, ValueError):
+        return {}
+    if index.get('version') != INDEX_VERSION:
+        return {}
+    return index.get('runs', {})
+
+
+def save_index(index_file, runs):
+    """Atomically write ``runs`` to ``index_file``"""
+    index_file = Path(index_file)
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = index_file.with_name(index_file.name + '.tmp%d' % os.getpid())
+    tmp_file.write_text(json.dumps({'version': INDEX_VERSION, 'runs': runs}, indent=1))
+    os.replace(tmp_file, index_file)
+
+
+def index_runs(fmriprep_dir, index_file=None, n_workers=16, refresh=False):
+    """
+    Find every run of an fmriprep directory, reusing a previous index when possible.
+
+    Runs already in ``index_file`` are only checked by stat-ing the files they
+    recorded; new runs and runs with any changed file are probed again. All
+    filesystem probes run in a thread pool, which hides most of the latency of
+    network filesystems.
+
+    Parameters
+    ----------
+    fmriprep_dir : pathlike
+        Directory with the fmriprep ``out`` and ``wrk`` directories
+    index_file : pathlike
+        JSON run index to read and update (default ``None``, no index)
+    n_workers : :obj:`int`
+        Number of concurrent filesystem probes
+    refresh : :obj:`bool`
+        Ignore the runs already in ``index_file`` and probe every run again
+
+    Returns
+    -------
+    runs : :obj:`list` of :obj:`dict`
+        One entry per run, as returned by :func:`probe_run`, sorted by func
+        working directory
+
+    """
+    fmriprep_dir = Path(fmriprep_dir)
+    fmriprep_odir = fmriprep_dir / 'out'
+    func_wds = find_func_wds(fmriprep_dir / 'wrk', n_workers=n_workers)
+    indexed = {} if (refresh or index_file is None) else load_index(index_file)
+
+    def _get_run(func_wd):
+        run = indexed.get(func_wd.as_posix())
+        if run is None or is_stale(run):
+            run = probe_run(func_wd, fmriprep_odir)
+        return run
+
+    with ThreadPoolExecutor(max_workers=max(1, n_workers)) as pool:
+        runs = list(pool.map(_get_run, func_wds))
+
+    if index_file is not None:
+        save_index(index_file, {run['func_wd']: run for run in runs})
+    return runs
@@ -0,0 +1,81 @@
+"""Helpers to read NIfTI images without holding them in memory"""
+import numpy as np
+
+
+def iter_volume_chunks(in_file, mem_gb=1.0, start=0, bytes_per_voxel=24):
+    """
+    Iterate over a 4D image a few volumes at a time.
+
+    Uncompressed images are memory-mapped; compressed images are decompressed
+    sequentially through a single open file handle, so each chunk only pays for
+    its own decompression.
+
+    Parameters
+    ----------
+    in_file : pathlike
+        4D NIfTI image (a 3D image is returned as a single volume)
+    mem_gb : :obj:`float`
+        Memory budget for a chunk, including the working copies made by the caller
+    start : :obj:`int`
+        First volume to read (e.g. the number of dummy scans)
+    bytes_per_voxel : :obj:`int`
+        Bytes the caller needs per voxel and volume on top of the on-disk data
+
+    Yields
+    ------
+    chunk : :obj:`numpy.ndarray`
+        float64 (voxels x volumes) array, voxels in Fortran order
+
+    """
+    import nibabel as nb
+
+    img = nb.load(str(in_file), mmap='r', keep_file_open=True)
+    n_vox = int(np.prod(img.shape[:3]))
+    n_vols = img.shape[3] if len(img.shape) > 3 else 1
+    voxel_bytes = img.get_data_dtype().itemsize + 8 + bytes_per_voxel
+    chunk_vols = max(1, int(mem_gb * 1024 ** 3 // (n_vox * voxel_bytes)))
+    if len(img.shape) < 4:
+        yield np.asanyarray(img.dataobj, dtype=np.float64).reshape(n_vox, 1, order='F')
+        return
+    for first in range(start, n_vols, chunk_vols):
+        last = min(first + chunk_vols, n_vols)
+        chunk = np.asanyarray(img.dataobj[..., first:last], dtype=np.float64)
+        yield chunk.reshape(n_vox, last - first, order='F')
+
+
+def check_split_volumes(bold_file, split_files, atol=1e-3):
+    """
+    Check that a list of 3D volumes is a volume by volume split of a 4D series.
+
+    Only headers are read: the number of volumes and each volume's shape and
+    affine must match ``bold_file``.
+
+    Parameters
+    ----------
+    bold_file : pathlike
+        4D NIfTI series
+    split_files : :obj:`list` of pathlike
+        3D volumes, in temporal order
+    atol : :obj:`float`
+        Tolerance on the affine of each volume
+
+    Raises
+    ------
+    ValueError
+        When the volumes cannot stand in for ``bold_file``
+
+    """
+    import nibabel as nb
+
+    bold = nb.load(str(bold_file))
+    n_vols = bold.shape[3] if len(bold.shape) > 3 else 1
+    if len(split_files) != n_vols:
+        raise ValueError('Found %d split volumes for %d volumes in %s' % (
+            len(split_files), n_vols, bold_file))
+    for split_file in split_files:
+        volume = nb.load(str(split_file))
+        if tuple(volume.shape[:3]) != tuple(bold.shape[:3]) or volume.shape[3:] not in ((), (1,)):
+            raise ValueError('%s has shape %s, expected %s' % (
+                split_file, volume.shape, bold.shape[:3]))
+        if not np.allclose(volume.affine, bold.affine, atol=atol):
+            raise ValueError('%s is not on the grid of %s' % (split_file, bold_file))
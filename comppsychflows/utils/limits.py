@@ -0,0 +1,198 @@
+"""CPUs and memory granted to this job and how the nodes of its workflows share them"""
+import os
+from pathlib import Path
+
+# Environment variables that size the thread pools of ITK (ANTs) and OpenMP (AFNI)
+THREAD_VARIABLES = ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS')
+
+# Where the cgroups and mounts of this process are listed
+PROC_SELF = Path('/proc/self')
+
+
+def _cgroup_dirs(controller):
+    """
+    Directories of the cgroups of this process that may limit ``controller``.
+
+    Both the cgroup v1 hierarchy of ``controller`` and the unified (v2) hierarchy
+    are looked up in ``mountinfo`` of ``PROC_SELF``. The cgroup of the process comes
+    first, followed by its ancestors up to the mount point, since a limit on any
+    of them applies.
+    """
+    try:
+        memberships = (PROC_SELF / 'cgroup').read_text().splitlines()
+        mounts = (PROC_SELF / 'mountinfo').read_text().splitlines()
+    except OSError:
+        return []
+    # v1 hierarchies are listed with their controllers, the unified one with none
+    cgroup_paths = {}
+    for line in memberships:
+        _, controllers, path = line.split(':', 2)
+        cgroup_paths[controllers] = path
+
+    dirs = []
+    for mount in mounts:
+        fields, _, fs_fields = mount.partition(' - ')
+        fields, fs_fields = fields.split(), fs_fields.split()
+        if len(fields) < 5 or len(fs_fields) < 3:
+            continue
+        if fs_fields[0] == 'cgroup2':
+            key = ''
+        elif fs_fields[0] == 'cgroup' and controller in fs_fields[2].split(','):
+            key = next((key for key in cgroup_paths if controller in key.split(',')), None)
+        else:
+            continue
+        if key not in cgroup_paths:
+            continue
+        mount_root, mount_point = fields[3], Path(fields[4])
+        relpath = os.path.relpath(cgroup_paths[key], mount_root)
+        directory = mount_point if relpath.startswith('..') else mount_point / relpath
+        while True:
+            dirs.append(directory)
+            if directory == mount_point:
+                break
+            directory = directory.parent
+    return dirs
+
+
+def cgroup_cpu_limit():
+    """
+    CPUs allowed by the CPU quota of the cgroups of this process (e.g. ``docker --cpus``).
+
+    Returns
+    -------
+    n_cpus : :obj:`float` or None
+        ``None`` when there is no quota or it cannot be read
+
+    """
+    limits = []
+    for directory in _cgroup_dirs('cpu'):
+        try:
+            if (directory / 'cpu.max').exists():
+                quota, period = (directory / 'cpu.max').read_text().split()[:2]
+            else:
+                quota = (directory / 'cpu.cfs_quota_us').read_text().strip()
+                period = (directory / 'cpu.cfs_period_us').read_text().strip()
+            if quota not in ('max', '-1'):
+                limits.append(int(quota) / int(period))
+        except (OSError, ValueError):
+            continue
+    return min(limits, default=None)
+
+
+def available_cpus():
+    """
+    Number of CPUs this process may use.
+
+    These are the CPUs of its affinity mask (those the scheduler, e.g. slurm, or
+    ``taskset`` gave to the job), or fewer when the CPU quota of its cgroup is
+    lower. ``os.cpu_count()`` counts every CPU of the node instead.
+    """
+    try:
+        n_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n_cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        n_cpus = min(n_cpus, max(1, int(quota)))
+    return n_cpus
+
+
+def cgroup_memory_limit_gb():
+    """
+    Memory limit of the cgroups of this process (e.g. slurm's ``--mem``), in GB.
+
+    Returns
+    -------
+    memory_gb : :obj:`float` or None
+        ``None`` when there is no limit or it cannot be read
+
+    """
+    limits = []
+    for directory in _cgroup_dirs('memory'):
+        for name in ('memory.max', 'memory.limit_in_bytes'):
+            try:
+                limit = (directory / name).read_text().strip()
+            except OSError:
+                continue
+            # cgroup v1 reports no limit as the largest page-aligned int64
+            if limit.isdigit() and int(limit) < 2 ** 62:
+                limits.append(int(limit) / 1024 ** 3)
+            break
+    return min(limits, default=None)
+
+
+def node_memory_gb():
+    """Physical memory of the node, in GB"""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 3
+
+
+def available_memory_gb(fraction=0.9):
+    """
+    Memory the nodes of this job may use at once, in GB.
+
+    A ``fraction`` of the memory of the node, or of the memory limit of the
+    cgroup of the job when it is lower, leaving the rest to the scheduler
+    process and the page cache.
+    """
+    memory_gb = node_memory_gb()
+    limit_gb = cgroup_memory_limit_gb()
+    if limit_gb is not None:
+        memory_gb = min(memory_gb, limit_gb)
+    return fraction * memory_gb
+
+
+def threads_per_node(n_cpus, n_concurrent, max_threads=None):
+    """
+    Threads of each multithreaded node so that concurrent branches share the CPUs.
+
+    Parameters
+    ----------
+    n_cpus : :obj:`int`
+        CPUs of the job
+    n_concurrent : :obj:`int`
+        Number of branches (e.g. runs) that may be processed at the same time
+    max_threads : :obj:`int`
+        Upper bound on the threads of a node
+
+    Examples
+    --------
+    >>> threads_per_node(32, 4)
+    8
+    >>> threads_per_node(32, 100)
+    1
+    >>> threads_per_node(32, 1, max_threads=8)
+    8
+
+    """
+    threads = max(1, n_cpus // max(1, min(n_concurrent, n_cpus)))
+    if max_threads:
+        threads = min(threads, max_threads)
+    return threads
+
+
+def limit_node_threads(workflow, max_threads):
+    """
+    Make every node of ``workflow`` use as many threads as the CPUs it reserves.
+
+    The scheduler (e.g. MultiProc) only counts the CPUs a node reserves with
+    ``n_procs``, while ANTs and AFNI size their thread pools with the
+    environment variables in ``THREAD_VARIABLES``, defaulting to one thread per
+    core of the node. ``n_procs`` is capped at ``max_threads``, which also sets
+    the ``num_threads`` input of the interfaces that have one, and the variables
+    are set in the ``environ`` of every command line, so that nodes that reserve
+    a single CPU run single-threaded.
+
+    Parameters
+    ----------
+    workflow : :obj:`nipype.pipeline.engine.Workflow`
+    max_threads : :obj:`int`
+        Maximum number of threads of a node
+
+    """
+    for node_name in workflow.list_node_names():
+        node = workflow.get_node(node_name)
+        n_threads = max(1, min(node.n_procs, max_threads))
+        node.n_procs = n_threads
+        if hasattr(node.inputs, 'environ'):
+            node.inputs.environ = dict(node.inputs.environ, **{
+                variable: str(n_threads) for variable in THREAD_VARIABLES})
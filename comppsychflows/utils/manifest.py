@@ -0,0 +1,115 @@
+"""Completion manifests that let finished runs be skipped without building their workflow"""
+import json
+import os
+
+# Bumped whenever the layout of a manifest changes
+MANIFEST_VERSION = 1
+
+
+def file_fingerprints(paths):
+    """
+    ``[size, mtime_ns]`` of each of ``paths``, ``None`` for paths that do not exist.
+
+    Parameters
+    ----------
+    paths : iterable of pathlike
+
+    Returns
+    -------
+    fingerprints : :obj:`dict`
+        Maps each path (as a string) to its fingerprint
+
+    """
+    fingerprints = {}
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except OSError:
+            fingerprints[str(path)] = None
+        else:
+            fingerprints[str(path)] = [st.st_size, st.st_mtime_ns]
+    return fingerprints
+
+
+def write_manifest(out_files, manifest_file, inputs, parameters):
+    """
+    Write the completion manifest of a run once its outputs were sunk.
+
+    Meant to run as a :class:`~nipype.interfaces.utility.Function` node connected
+    to the ``out_file`` of the run's ``DataSink``, so it is self-contained.
+
+    Parameters
+    ----------
+    out_files : :obj:`list` of :obj:`str`
+        Files written by the sinker
+    manifest_file : :obj:`str`
+        Path of the manifest
+    inputs : :obj:`dict`
+        Fingerprints of the inputs of the run, see :func:`file_fingerprints`
+    parameters : :obj:`dict`
+        Options the outputs depend on
+
+    Returns
+    -------
+    manifest_file : :obj:`str`
+
+    """
+    import hashlib
+    import json
+    import os
+
+    from comppsychflows.utils.manifest import MANIFEST_VERSION, file_fingerprints
+
+    if isinstance(out_files, str):
+        out_files = [out_files]
+    outputs = {}
+    for out_file, fingerprint in file_fingerprints(sorted(out_files)).items():
+        sha1 = hashlib.sha1()
+        with open(out_file, 'rb') as fobj:
+            for block in iter(lambda: fobj.read(16 * 1024 ** 2), b''):
+                sha1.update(block)
+        outputs[out_file] = {'fingerprint': fingerprint, 'sha1': sha1.hexdigest()}
+
+    manifest = {'version': MANIFEST_VERSION, 'inputs': inputs,
+                'parameters': parameters, 'outputs': outputs}
+    tmp_file = manifest_file + '.tmp%d' % os.getpid()
+    with open(tmp_file, 'w') as fobj:
+        json.dump(manifest, fobj, indent=1)
+    os.replace(tmp_file, manifest_file)
+    return manifest_file
+
+
+def is_complete(manifest_file, inputs, parameters):
+    """
+    Whether a run's manifest shows it finished with the same inputs and parameters.
+
+    Only file sizes and mtimes are compared, so no input or output is read; the
+    checksums of the manifest are there to verify outputs out of band.
+
+    Parameters
+    ----------
+    manifest_file : pathlike
+        Manifest written by :func:`write_manifest`
+    inputs : :obj:`dict`
+        Current fingerprints of the inputs of the run
+    parameters : :obj:`dict`
+        Current options the outputs depend on
+
+    Returns
+    -------
+    complete : :obj:`bool`
+
+    """
+    try:
+        with open(manifest_file) as fobj:
+            manifest = json.load(fobj)
+    except (OSError, ValueError):
+        return False
+    if manifest.get('version') != MANIFEST_VERSION:
+        return False
+    if manifest['inputs'] != inputs or manifest['parameters'] != parameters:
+        return False
+    outputs = manifest['outputs']
+    current = file_fingerprints(outputs)
+    return bool(outputs) and all(
+        current[path] == output['fingerprint'] for path, output in outputs.items())
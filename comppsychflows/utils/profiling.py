@@ -0,0 +1,418 @@
+"""Per-node resource profiles of a workflow execution, reported per run and per dataset"""
+import csv
+import json
+import os
+import re
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+# Columns of the per-run and per-node TSV reports
+RECORD_FIELDS = ('subject', 'run', 'node', 'item', 'status', 'cached', 'submitted', 'start', 'end',
+                 'wall_s', 'cpu_s', 'cpu_percent_max', 'mem_peak_gb', 'mem_gb', 'n_procs',
+                 'in_bytes', 'out_bytes')
+SUMMARY_FIELDS = ('node', 'n', 'n_failed', 'wall_s_total', 'wall_s_mean', 'wall_s_max',
+                  'cpu_s_total', 'mem_peak_gb_max', 'mem_gb', 'n_procs', 'in_bytes',
+                  'out_bytes')
+
+
+def _timestamp(value):
+    """Seconds since the epoch of an ISO timestamp written by nipype (in UTC)"""
+    if not value:
+        return None
+    stamp = datetime.fromisoformat(value)
+    if stamp.tzinfo is None:
+        stamp = stamp.replace(tzinfo=timezone.utc)
+    return stamp.timestamp()
+
+
+def _file_bytes(value, seen):
+    """Total size of the existing files in a (nested) input or output value"""
+    if isinstance(value, (list, tuple)):
+        return sum(_file_bytes(item, seen) for item in value)
+    if isinstance(value, dict):
+        return sum(_file_bytes(item, seen) for item in value.values())
+    if not isinstance(value, (str, os.PathLike)) or str(value) in seen:
+        return 0
+    seen.add(str(value))
+    try:
+        return os.path.getsize(value) if os.path.isfile(value) else 0
+    except (OSError, ValueError):
+        return 0
+
+
+def _cpu_seconds(prof_dict):
+    """CPU time integrated from the CPU percent samples of nipype's resource monitor"""
+    if not prof_dict or len(prof_dict.get('time', [])) < 2:
+        return None
+    samples = list(zip(prof_dict['time'], prof_dict['cpus']))
+    return sum((t1 - t0) * (c0 + c1) / 200 for (t0, c0), (t1, c1) in zip(samples, samples[1:]))
+
+
+def runtime_record(runtime, inputs=None, outputs=None):
+    """
+    Resource use of one interface execution.
+
+    Parameters
+    ----------
+    runtime : :obj:`~nipype.interfaces.base.support.Bunch`
+        ``result.runtime`` of a node, with the resource monitor fields when it was enabled
+    inputs, outputs : :obj:`dict`
+        Inputs and outputs of the node; the sizes of the files they name are
+        reported as the bytes it read and wrote
+
+    Returns
+    -------
+    record : :obj:`dict`
+
+    """
+    start = _timestamp(getattr(runtime, 'startTime', None))
+    end = _timestamp(getattr(runtime, 'endTime', None))
+    seen = set()
+    in_bytes = _file_bytes(inputs or {}, seen)
+    return {
+        'start': start,
+        'end': end,
+        'wall_s': getattr(runtime, 'duration', None),
+        'cpu_s': _cpu_seconds(getattr(runtime, 'prof_dict', None)),
+        'cpu_percent_max': getattr(runtime, 'cpu_percent', None),
+        'mem_peak_gb': getattr(runtime, 'mem_peak_gb', None),
+        'in_bytes': in_bytes,
+        'out_bytes': _file_bytes(outputs or {}, seen),
+    }
+
+
+class NodeProfiler:
+    """
+    A nipype ``status_callback`` that records the resource use of every node.
+
+    Nodes are attributed to a subject and run from their working directory
+    (``<base_dir>/<subject wf>/<run wf>/...``). Subnodes of ``MapNode`` objects
+    are recorded individually, once, whether the plugin submits them as jobs
+    (MultiProc) or runs them within their parent (Linear). Nodes whose results
+    were cached by an earlier execution are flagged as ``cached``. The time each
+    node was handed to the plugin is kept as ``submitted``; failed nodes span from
+    then until the failure was reported.
+
+    Parameters
+    ----------
+    base_dir : pathlike
+        Working directory of the top level workflow (``<base_dir of wf>/<wf name>``)
+
+    """
+
+    def __init__(self, base_dir):
+        self.base_dir = Path(base_dir)
+        self.started = time.time()
+        self.records = []
+        self._seen = set()
+        self._submitted = {}
+
+    def _locate(self, output_dir):
+        """Subject, run, node name and map item of a node working directory"""
+        try:
+            parts = Path(output_dir).relative_to(self.base_dir).parts
+        except ValueError:
+            parts = Path(output_dir).parts[-1:]
+        subject, run = (parts[0], parts[1]) if len(parts) > 2 else ('', '')
+        node_parts, item = list(parts[2:] if len(parts) > 2 else parts), ''
+        if len(node_parts) > 2 and node_parts[-2] == 'mapflow':
+            item = re.sub(r'^_.*?(\d+)$', r'\1', node_parts[-1])
+            node_parts = node_parts[:-2]
+        subject = re.sub(r'^single_subject_(.*)_wf$', r'\1', subject)
+        return subject, run, '.'.join(node_parts), item
+
+    def _add(self, node, output_dir, status, runtime=None, inputs=None, outputs=None):
+        if output_dir in self._seen:
+            return
+        self._seen.add(output_dir)
+        subject, run, name, item = self._locate(output_dir)
+        record = {'subject': subject, 'run': run, 'node': name, 'item': item,
+                  'status': status, 'mem_gb': node.mem_gb, 'n_procs': node.n_procs,
+                  'submitted': self._submitted.get(output_dir)}
+        if runtime is not None:
+            record.update(runtime_record(runtime, inputs, outputs))
+        elif status == 'failed':
+            record.update(start=record['submitted'], end=time.time())
+        record['cached'] = bool(record.get('start') and record['start'] < self.started)
+        self.records.append(record)
+
+    def __call__(self, node, status):
+        output_dir = node.output_dir()
+        if status == 'start':
+            self._submitted[output_dir] = time.time()
+            return
+        if status != 'end':
+            self._add(node, output_dir, 'failed')
+            return
+        try:
+            result = node.result
+        except Exception:  # a missing or unreadable result file should not stop the run
+            result = None
+        if result is None:
+            self._add(node, output_dir, 'end')
+            return
+        outputs = {}
+        if result.outputs is not None:
+            # A TraitedSpec, or a Bunch for MapNode objects
+            outputs = (result.outputs.trait_get() if hasattr(result.outputs, 'trait_get')
+                       else dict(result.outputs.items()))
+        if isinstance(result.runtime, list):
+            # A MapNode run as a whole: one record per subnode not already recorded
+            inputs = result.inputs if isinstance(result.inputs, list) else []
+            for idx, runtime in enumerate(result.runtime):
+                sub_dir = os.path.join(output_dir, 'mapflow', '_%s%d' % (node.name, idx))
+                if runtime is not None:
+                    self._add(node, sub_dir, 'end', runtime,
+                              inputs[idx] if idx < len(inputs) else None,
+                              {key: value[idx] for key, value in outputs.items()
+                               if isinstance(value, list) and idx < len(value)})
+            return
+        self._add(node, output_dir, 'end', result.runtime, result.inputs, outputs)
+
+
+def _write_tsv(out_file, rows, fields):
+    with open(out_file, 'w', newline='') as fobj:
+        writer = csv.DictWriter(fobj, fieldnames=fields, delimiter='\t', extrasaction='ignore',
+                                lineterminator='\n')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: ('n/a' if row.get(key) is None else row[key])
+                             for key in fields})
+
+
+def summarize(records):
+    """
+    Aggregate records per node name (over runs and map items), most wall time first.
+
+    Parameters
+    ----------
+    records : :obj:`list` of :obj:`dict`
+        As collected by :class:`NodeProfiler`
+
+    Returns
+    -------
+    summary : :obj:`list` of :obj:`dict`
+
+    Examples
+    --------
+    >>> summary = summarize([
+    ...     {'node': 'a', 'status': 'end', 'wall_s': 2.0, 'mem_peak_gb': 1.0},
+    ...     {'node': 'a', 'status': 'end', 'wall_s': 4.0, 'mem_peak_gb': 3.0},
+    ...     {'node': 'b', 'status': 'failed'}])
+    >>> [(row['node'], row['n'], row['wall_s_total'], row['mem_peak_gb_max']) for row in summary]
+    [('a', 2, 6.0, 3.0), ('b', 1, 0.0, None)]
+
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault(record['node'], []).append(record)
+
+    def _values(rows, key):
+        return [row[key] for row in rows if row.get(key) is not None]
+
+    summary = []
+    for node, rows in groups.items():
+        walls = _values(rows, 'wall_s')
+        summary.append({
+            'node': node,
+            'n': len(rows),
+            'n_failed': sum(row['status'] == 'failed' for row in rows),
+            'wall_s_total': float(sum(walls)),
+            'wall_s_mean': sum(walls) / len(walls) if walls else None,
+            'wall_s_max': max(walls, default=None),
+            'cpu_s_total': sum(_values(rows, 'cpu_s')) if _values(rows, 'cpu_s') else None,
+            'mem_peak_gb_max': max(_values(rows, 'mem_peak_gb'), default=None),
+            'mem_gb': max(_values(rows, 'mem_gb'), default=None),
+            'n_procs': max(_values(rows, 'n_procs'), default=None),
+            'in_bytes': sum(_values(rows, 'in_bytes')),
+            'out_bytes': sum(_values(rows, 'out_bytes')),
+        })
+    return sorted(summary, key=lambda row: (-row['wall_s_total'], row['node']))
+
+
+def write_reports(records, out_dir):
+    """
+    Write a JSON and TSV profile per run and a summary of all of them.
+
+    Parameters
+    ----------
+    records : :obj:`list` of :obj:`dict`
+        As collected by :class:`NodeProfiler`
+    out_dir : pathlike
+        Directory to write ``<subject>/<run>.{json,tsv}`` and ``summary.{json,tsv}`` to
+
+    Returns
+    -------
+    summary_file : :obj:`str`
+
+    """
+    out_dir = Path(out_dir)
+    runs = {}
+    for record in records:
+        runs.setdefault((record['subject'], record['run']), []).append(record)
+    run_totals = []
+    for (subject, run), rows in sorted(runs.items()):
+        run_dir = out_dir / ('sub-' + subject if subject else 'other')
+        run_dir.mkdir(parents=True, exist_ok=True)
+        rows = sorted(rows, key=lambda row: (row.get('start') or 0, row['node']))
+        name = run or 'nodes'
+        (run_dir / (name + '.json')).write_text(json.dumps(rows, indent=1))
+        _write_tsv(run_dir / (name + '.tsv'), rows, RECORD_FIELDS)
+        starts = [row['start'] for row in rows if row.get('start')]
+        ends = [row['end'] for row in rows if row.get('end')]
+        run_totals.append({
+            'subject': subject, 'run': run, 'n_nodes': len(rows),
+            'n_failed': sum(row['status'] == 'failed' for row in rows),
+            'span_s': max(ends) - min(starts) if starts and ends else None,
+            'wall_s_total': sum(row.get('wall_s') or 0 for row in rows),
+            'cpu_s_total': (sum(row['cpu_s'] for row in rows if row.get('cpu_s') is not None)
+                            if any(row.get('cpu_s') is not None for row in rows) else None),
+            'mem_peak_gb_max': max((row['mem_peak_gb'] for row in rows
+                                    if row.get('mem_peak_gb') is not None), default=None),
+        })
+
+    summary = summarize(records)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    summary_file = out_dir / 'summary.json'
+    summary_file.write_text(json.dumps({'nodes': summary, 'runs': run_totals}, indent=1))
+    _write_tsv(out_dir / 'summary.tsv', summary, SUMMARY_FIELDS)
+    return summary_file.as_posix()
+
+
+def assign_lanes(intervals):
+    """
+    Place intervals on as few lanes as possible, each on the lowest free lane.
+
+    With the intervals of the nodes of an execution, a lane stands for one of the
+    worker slots of the plugin.
+
+    Parameters
+    ----------
+    intervals : :obj:`list` of :obj:`tuple`
+        ``(start, end)`` of each interval
+
+    Returns
+    -------
+    lanes : :obj:`list` of :obj:`int`
+        Lane of each interval
+
+    Examples
+    --------
+    >>> assign_lanes([(0, 4), (1, 2), (2, 5), (4, 6), (1, 3)])
+    [0, 1, 1, 0, 2]
+
+    """
+    import heapq
+
+    lanes = [None] * len(intervals)
+    busy, free, n_lanes = [], [], 0
+    for idx in sorted(range(len(intervals)), key=lambda idx: intervals[idx]):
+        start, end = intervals[idx]
+        while busy and busy[0][0] <= start:
+            heapq.heappush(free, heapq.heappop(busy)[1])
+        if free:
+            lane = heapq.heappop(free)
+        else:
+            lane, n_lanes = n_lanes, n_lanes + 1
+        lanes[idx] = lane
+        heapq.heappush(busy, (end, lane))
+    return lanes
+
+
+def _union_seconds(intervals):
+    """Total time covered by at least one of the intervals"""
+    total, last_end = 0.0, None
+    for start, end in sorted(intervals):
+        if last_end is None or start > last_end:
+            total += end - start
+            last_end = end
+        elif end > last_end:
+            total += end - last_end
+            last_end = end
+    return total
+
+
+def chrome_trace(records):
+    """
+    Chrome trace events (``chrome://tracing``, Perfetto) of a profiled execution.
+
+    Nodes that ran are drawn as spans on ``worker`` tracks, reconstructed from
+    their start and end times with :func:`assign_lanes`, with their subject, run
+    and resources as arguments; a counter shows how many workers were busy. A
+    second process has one track per run spanning from its first submitted node
+    to its last finished one, whose arguments tell how long the run had no node
+    running (``waiting_s``). Cached nodes did not run and are left out.
+
+    Parameters
+    ----------
+    records : :obj:`list` of :obj:`dict`
+        As collected by :class:`NodeProfiler`
+
+    Returns
+    -------
+    trace : :obj:`dict`
+        Trace event JSON object
+
+    """
+    ran = [record for record in records if not record.get('cached')
+           and record.get('start') is not None and record.get('end') is not None]
+    if not ran:
+        return {'traceEvents': [], 'displayTimeUnit': 'ms'}
+    origin = min(min(record['start'], record.get('submitted') or record['start'])
+                 for record in ran)
+
+    def _us(seconds):
+        return round((seconds - origin) * 1e6)
+
+    events = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'workers'}},
+              {'name': 'process_name', 'ph': 'M', 'pid': 2, 'args': {'name': 'runs'}}]
+    lanes = assign_lanes([(record['start'], record['end']) for record in ran])
+    for lane in range(max(lanes) + 1):
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': lane,
+                       'args': {'name': 'worker %d' % lane}})
+    for record, lane in zip(ran, lanes):
+        name = record['node'] + ('[%s]' % record['item'] if record.get('item') else '')
+        events.append({
+            'name': name, 'cat': record['status'], 'ph': 'X', 'pid': 1, 'tid': lane,
+            'ts': _us(record['start']), 'dur': _us(record['end']) - _us(record['start']),
+            'args': {key: record.get(key) for key in (
+                'subject', 'run', 'status', 'wall_s', 'cpu_s', 'mem_peak_gb', 'mem_gb',
+                'n_procs', 'in_bytes', 'out_bytes')},
+        })
+
+    # Number of busy workers over time
+    changes = sorted([(record['start'], 1) for record in ran]
+                     + [(record['end'], -1) for record in ran])
+    busy = 0
+    for stamp, change in changes:
+        busy += change
+        events.append({'name': 'busy workers', 'ph': 'C', 'pid': 1, 'ts': _us(stamp),
+                       'args': {'busy': busy}})
+
+    runs = {}
+    for record in ran:
+        runs.setdefault((record['subject'], record['run']), []).append(record)
+    for tid, ((subject, run), rows) in enumerate(sorted(runs.items())):
+        first = min(row.get('submitted') or row['start'] for row in rows)
+        last = max(row['end'] for row in rows)
+        busy_s = _union_seconds([(row['start'], row['end']) for row in rows])
+        label = '%s %s' % ('sub-' + subject if subject else '', run)
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': 2, 'tid': tid,
+                       'args': {'name': label.strip()}})
+        events.append({
+            'name': label.strip(), 'cat': 'run', 'ph': 'X', 'pid': 2, 'tid': tid,
+            'ts': _us(first), 'dur': _us(last) - _us(first),
+            'args': {'subject': subject, 'run': run, 'n_nodes': len(rows),
+                     'span_s': last - first, 'busy_s': busy_s,
+                     'waiting_s': last - first - busy_s},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms',
+            'otherData': {'origin': origin, 'n_workers': max(lanes) + 1}}
+
+
+def write_chrome_trace(records, out_file):
+    """Write the :func:`chrome_trace` of ``records`` to ``out_file``"""
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+    Path(out_file).write_text(json.dumps(chrome_trace(records)))
+    return str(out_file)
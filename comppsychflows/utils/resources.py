@@ -0,0 +1,175 @@
+"""Estimate the memory and CPUs needed by each node of a mnitobold run"""
+from functools import reduce
+from operator import mul
+
+# Approximate resident size of a single ANTs/AFNI process before it loads any data
+_PROCESS_GB = 0.2
+# Nonlinear MNI to T1w warp and the composite displacement field built from it
+_WARP_GB = 1.0
+
+
+def bold_header_info(bold_file):
+    """
+    Read the geometry of a BOLD series from its NIfTI header without loading the data.
+
+    Parameters
+    ----------
+    bold_file : pathlike
+        BOLD series NIfTI file
+
+    Returns
+    -------
+    info : :obj:`dict`
+        ``shape``, number of voxels per volume (``n_voxels``), number of volumes
+        (``n_vols``) and the on-disk size in bytes of a single voxel (``itemsize``)
+    """
+    import nibabel as nb
+
+    header = nb.load(str(bold_file)).header
+    shape = tuple(int(dim) for dim in header.get_data_shape())
+    return {
+        'shape': shape,
+        'n_voxels': reduce(mul, shape[:3], 1),
+        'n_vols': shape[3] if len(shape) > 3 else 1,
+        'itemsize': header.get_data_dtype().itemsize,
+    }
+
+
+def estimate_bold_resources(bold_file, omp_nthreads=1, stream_mem_gb=1.0, info=None):
+    """
+    Estimate per-node ``mem_gb`` and ``n_procs`` for the mnitobold workflow of a run.
+
+    Only the header of ``bold_file`` is read. Every processing step works on a float32
+    (AFNI, nilearn) or float64 (pandas) copy of the data, so the estimates are derived
+    from the number of voxels and volumes rather than from the on-disk size.
+
+    Parameters
+    ----------
+    bold_file : pathlike
+        BOLD series NIfTI file that will be head motion corrected
+    omp_nthreads : :obj:`int`
+        Maximum number of threads an individual process may use
+    stream_mem_gb : :obj:`float`
+        Memory budget given to nodes that read the bold a few volumes at a time
+    info : :obj:`dict`
+        Output of :func:`bold_header_info` for ``bold_file``, if it was already read
+
+    Returns
+    -------
+    resources : :obj:`dict`
+        Maps the name of a node, relative to the run workflow, to a
+        ``{'mem_gb': float, 'n_procs': int}`` dictionary
+
+    """
+    if info is None:
+        info = bold_header_info(bold_file)
+    volume_gb = info['n_voxels'] * 4 / 1024 ** 3
+    bold_gb = volume_gb * info['n_vols']
+    native_gb = info['n_voxels'] * info['n_vols'] * info['itemsize'] / 1024 ** 3
+    # MultiApplyTransforms runs one antsApplyTransforms per volume in parallel
+    transform_nthreads = max(1, min(omp_nthreads, info['n_vols']))
+
+    def _res(mem_gb, n_procs=1):
+        return {'mem_gb': round(_PROCESS_GB + mem_gb, 2), 'n_procs': n_procs}
+
+    return {
+        'qwarp_invert_wf.invert': _res(12 * volume_gb, omp_nthreads),
+        'qwarp_invert_wf.cphdr_warp': _res(6 * volume_gb),
+        'qwarp_invert_wf.to_ants': _res(6 * volume_gb),
+        'apply_hmc_only.bold_split': _res(native_gb + bold_gb),
+        'apply_hmc_only.bold_transform': _res(
+            transform_nthreads * (_PROCESS_GB + 3 * volume_gb), transform_nthreads),
+        'apply_hmc_only.merge': _res(2 * bold_gb),
+        # on-disk series while it is scaled, float32 input and output series
+        'apply_hmc_only.bold_resample': _res(
+            native_gb + 2 * bold_gb + transform_nthreads * volume_gb, transform_nthreads),
+        'backtransform.combine_transforms': _res(_WARP_GB + 6 * volume_gb, omp_nthreads),
+        'backtransform.resample_template': _res(_WARP_GB + 2 * volume_gb, omp_nthreads),
+        'backtransform.resample_parc': _res(_WARP_GB + 2 * volume_gb, omp_nthreads),
+        'scale.scale_ref': _res(bold_gb + volume_gb),
+        'scale.scale': _res(2 * bold_gb + volume_gb),
+        'gettsnr.getstat': _res(bold_gb + volume_gb),
+        'gettsnr.roi_stats': _res(2 * volume_gb),
+        'getstd.getstat': _res(bold_gb + volume_gb),
+        'getstd.roi_stats': _res(2 * volume_gb),
+        'roi_stats': _res(bold_gb + volume_gb),
+        # streams the bold in chunks that fit in stream_mem_gb, plus the labels
+        'get_grand_std': _res(stream_mem_gb + 3 * volume_gb),
+        # float32 copy of the bold plus float64 temporaries of a block of voxels
+        'fused_stats': _res(bold_gb + 4 * volume_gb + 1.0),
+        # gzip streams the file, pigz keeps a few blocks per thread
+        'compress_hmc_only_bold': _res(0.1, omp_nthreads),
+        'compress_hmc_scaled_bold': _res(0.1, omp_nthreads),
+        'compress_hmc_tsnr': _res(0.1),
+        'compress_scaled_std': _res(0.1),
+    }
+
+
+def estimate_t1w_resources(reference_image, mni_to_t1, template_file, dseg_file,
+                           omp_nthreads=1):
+    """
+    Estimate ``mem_gb`` and ``n_procs`` of the nodes of a subject's template workflow.
+
+    Only the headers of the images are read. ``antsApplyTransforms`` holds the input
+    and output images in float32 for the template (``--float``) and in float64 for
+    the dseg, plus the displacement field of the composite MNI to T1w transform,
+    whose size is taken from ``mni_to_t1`` on disk.
+
+    Parameters
+    ----------
+    reference_image : pathlike
+        T1w image defining the output grid
+    mni_to_t1 : pathlike
+        Composite transformation from standard space to T1w space
+    template_file, dseg_file : pathlike
+        Template and segmentation in standard space
+    omp_nthreads : :obj:`int`
+        Maximum number of threads an individual process may use
+
+    Returns
+    -------
+    resources : :obj:`dict`
+        Maps the name of a node, relative to the subject template workflow
+        (see :func:`~comppsychflows.workflows.util.init_subject_template_wf`),
+        to a ``{'mem_gb': float, 'n_procs': int}`` dictionary
+
+    """
+    import os
+
+    t1w_voxels = bold_header_info(reference_image)['n_voxels']
+    try:
+        warp_gb = os.path.getsize(str(mni_to_t1)) / 1024 ** 3
+    except OSError:
+        warp_gb = _WARP_GB
+
+    def _res(input_file, itemsize):
+        # input image, output image and the copy written to disk
+        n_voxels = bold_header_info(input_file)['n_voxels'] + 2 * t1w_voxels
+        return {'mem_gb': round(_PROCESS_GB + warp_gb + n_voxels * itemsize / 1024 ** 3, 2),
+                'n_procs': omp_nthreads}
+
+    return {
+        'template_to_t1w': _res(template_file, 4),
+        'dseg_to_t1w': _res(dseg_file, 8),
+    }
+
+
+def set_node_resources(workflow, resources):
+    """
+    Overwrite the ``mem_gb`` and ``n_procs`` of the nodes of ``workflow``.
+
+    Parameters
+    ----------
+    workflow : :obj:`nipype.pipeline.engine.Workflow`
+        Workflow whose nodes will be updated
+    resources : :obj:`dict`
+        Output of :func:`estimate_bold_resources` or :func:`estimate_t1w_resources`;
+        nodes that are not listed keep the resources they were built with
+
+    """
+    for node_name in workflow.list_node_names():
+        if node_name not in resources:
+            continue
+        node = workflow.get_node(node_name)
+        node._mem_gb = resources[node_name]['mem_gb']
+        node.n_procs = resources[node_name]['n_procs']
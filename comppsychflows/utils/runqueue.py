@@ -0,0 +1,172 @@
+"""A queue of mnitobold runs kept in a directory, shared by workers through atomic renames"""
+import json
+import os
+import socket
+import time
+from pathlib import Path
+
+# A spec moves from one state directory to the next with os.rename, so exactly one
+# worker can claim it even when several share the queue over a network filesystem
+STATES = ('pending', 'running', 'done', 'failed')
+
+
+def init_queue(queue_dir):
+    """Create the state directories of a queue; return it as a :obj:`~pathlib.Path`"""
+    queue_dir = Path(queue_dir)
+    for state in STATES:
+        (queue_dir / state).mkdir(parents=True, exist_ok=True)
+    return queue_dir
+
+
+def _write_spec(path, spec):
+    """Atomically (re)write a spec"""
+    tmp_file = path.with_name('.%s.tmp%d' % (path.name, os.getpid()))
+    tmp_file.write_text(json.dumps(spec, indent=1))
+    os.replace(tmp_file, path)
+
+
+def submit(queue_dir, args, name=None):
+    """
+    Add a run specification to the queue.
+
+    Parameters
+    ----------
+    queue_dir : pathlike
+    args : :obj:`list` of :obj:`str`
+        Arguments of ``comppsychflows-mnitobold``
+    name : :obj:`str`
+        Name of the spec (default: submission time, host and pid); specs are
+        processed in the order of their names
+
+    Returns
+    -------
+    spec_file : :obj:`pathlib.Path`
+
+    """
+    queue_dir = init_queue(queue_dir)
+    if name is None:
+        name = '%s_%s_%d_%d' % (time.strftime('%Y%m%d-%H%M%S'), socket.gethostname(),
+                                os.getpid(), time.monotonic_ns())
+    spec_file = queue_dir / 'pending' / (name + '.json')
+    for state in STATES:
+        if (queue_dir / state / spec_file.name).exists():
+            raise FileExistsError('%s is already %s in %s' % (name, state, queue_dir))
+    _write_spec(spec_file, {'args': list(args), 'submitted': time.time()})
+    return spec_file
+
+
+def claim(queue_dir):
+    """
+    Move the first pending spec to ``running`` and record this worker in it.
+
+    Returns
+    -------
+    spec_file, spec : :obj:`pathlib.Path`, :obj:`dict`
+        The claimed spec, or ``(None, None)`` when nothing is pending
+
+    """
+    queue_dir = Path(queue_dir)
+    for pending in sorted((queue_dir / 'pending').glob('*.json')):
+        running = queue_dir / 'running' / pending.name
+        try:
+            os.rename(pending, running)
+        except FileNotFoundError:
+            # Claimed by another worker in the meantime
+            continue
+        spec = json.loads(running.read_text())
+        spec.update(host=socket.gethostname(), pid=os.getpid(), started=time.time())
+        _write_spec(running, spec)
+        return running, spec
+    return None, None
+
+
+def finish(spec_file, spec, state, **info):
+    """
+    Move a claimed spec to ``state`` (``'done'``, ``'failed'`` or back to ``'pending'``).
+
+    Parameters
+    ----------
+    spec_file : :obj:`pathlib.Path`
+        The spec in ``running``
+    spec : :obj:`dict`
+        Its content, updated with ``info`` and the finishing time
+
+    Returns
+    -------
+    spec_file : :obj:`pathlib.Path`
+        New location of the spec
+
+    """
+    spec = dict(spec, **info)
+    if state == 'pending':
+        for key in ('host', 'pid', 'started'):
+            spec.pop(key, None)
+    else:
+        spec['finished'] = time.time()
+    _write_spec(spec_file, spec)
+    target = spec_file.parents[1] / state / spec_file.name
+    os.rename(spec_file, target)
+    return target
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def requeue(queue_dir, failed=False, all_running=False):
+    """
+    Move the specs of dead workers (and optionally failed specs) back to ``pending``.
+
+    Only workers on this host can be checked; specs claimed on other hosts are
+    left alone unless ``all_running`` is set.
+
+    Parameters
+    ----------
+    queue_dir : pathlike
+    failed : :obj:`bool`
+        Also retry the failed specs
+    all_running : :obj:`bool`
+        Requeue every running spec, e.g. once all the workers of a job array ended
+
+    Returns
+    -------
+    requeued : :obj:`list` of :obj:`str`
+        Names of the requeued specs
+
+    """
+    queue_dir = Path(queue_dir)
+    host = socket.gethostname()
+    requeued = []
+    candidates = sorted((queue_dir / 'running').glob('*.json'))
+    if failed:
+        candidates += sorted((queue_dir / 'failed').glob('*.json'))
+    for spec_file in candidates:
+        try:
+            spec = json.loads(spec_file.read_text())
+        except (OSError, ValueError):
+            continue
+        if spec_file.parent.name == 'running' and not all_running and (
+                spec.get('host') != host or _alive(spec.get('pid', -1))):
+            continue
+        for key in ('host', 'pid', 'started', 'finished', 'error'):
+            spec.pop(key, None)
+        spec['attempts'] = spec.get('attempts', 0) + 1
+        _write_spec(spec_file, spec)
+        try:
+            os.rename(spec_file, queue_dir / 'pending' / spec_file.name)
+        except FileNotFoundError:
+            continue
+        requeued.append(spec_file.stem)
+    return requeued
+
+
+def queue_status(queue_dir):
+    """Number of specs in each state"""
+    queue_dir = Path(queue_dir)
+    return {state: len(list((queue_dir / state).glob('*.json'))) for state in STATES}
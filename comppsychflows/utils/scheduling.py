@@ -0,0 +1,200 @@
+"""Select and split the runs of a dataset across independent jobs"""
+import heapq
+import re
+
+
+def parse_shard(value):
+    """
+    Parse a ``i/N`` shard specification.
+
+    Parameters
+    ----------
+    value : :obj:`str`
+        Zero-based index of the shard and total number of shards, e.g. ``'0/10'``
+        (``SLURM_ARRAY_TASK_ID/<array size>``)
+
+    Returns
+    -------
+    index, n_shards : :obj:`int`
+
+    Examples
+    --------
+    >>> parse_shard('3/10')
+    (3, 10)
+
+    """
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', value)
+    if match is None:
+        raise ValueError("shard must look like i/N, not %r" % value)
+    index, n_shards = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < n_shards:
+        raise ValueError("shard index must be between 0 and %d, not %d" % (n_shards - 1, index))
+    return index, n_shards
+
+
+def run_cost(run):
+    """
+    Estimated cost of a run: number of voxels times number of volumes of its bold.
+
+    Runs whose bold geometry is unknown cost 1, so they are still spread across shards.
+
+    Parameters
+    ----------
+    run : :obj:`dict`
+        Run as returned by :func:`comppsychflows.utils.fmriprep.probe_run`
+
+    """
+    info = run.get('bold_info')
+    if not info:
+        return 1
+    return info['n_voxels'] * info['n_vols']
+
+
+def select_runs(runs, participant_labels=None, run_filter=None):
+    """
+    Keep the runs of some participants and/or whose name matches a pattern.
+
+    Parameters
+    ----------
+    runs : :obj:`list` of :obj:`dict`
+        Runs as returned by :func:`comppsychflows.utils.fmriprep.index_runs`
+    participant_labels : :obj:`list` of :obj:`str`
+        Participant labels, with or without the ``sub-`` prefix (default: all)
+    run_filter : :obj:`str`
+        Regular expression searched in the bold file name and in the name of the
+        func working directory of each run (default: all)
+
+    Returns
+    -------
+    runs : :obj:`list` of :obj:`dict`
+
+    """
+    if participant_labels:
+        labels = {label[4:] if label.startswith('sub-') else label
+                  for label in participant_labels}
+        runs = [run for run in runs if run['subject'] in labels]
+    if run_filter:
+        pattern = re.compile(run_filter)
+        runs = [run for run in runs if pattern.search(run['func_wd'].rsplit('/', 1)[-1])
+                or pattern.search((run['bold_file'] or '').rsplit('/', 1)[-1])]
+    return runs
+
+
+def assign_shards(costs, n_shards):
+    """
+    Balance items across shards with the longest-processing-time-first heuristic.
+
+    Items are taken from the most to the least expensive and each is given to the
+    shard with the smallest total so far. Ties are broken by item and shard index,
+    so every job computes the same assignment.
+
+    Parameters
+    ----------
+    costs : :obj:`list` of :obj:`float`
+        Cost of each item
+    n_shards : :obj:`int`
+        Number of shards
+
+    Returns
+    -------
+    shards : :obj:`list` of :obj:`int`
+        Shard of each item
+
+    Examples
+    --------
+    >>> assign_shards([5, 1, 4, 2, 3, 3], 2)
+    [0, 0, 1, 1, 1, 0]
+
+    """
+    loads = [(0, shard) for shard in range(n_shards)]
+    shards = [None] * len(costs)
+    for item in sorted(range(len(costs)), key=lambda item: (-costs[item], item)):
+        load, shard = heapq.heappop(loads)
+        shards[item] = shard
+        heapq.heappush(loads, (load + costs[item], shard))
+    return shards
+
+
+def shard_runs(runs, index, n_shards):
+    """
+    Runs of shard ``index`` out of ``n_shards``, balanced by :func:`run_cost`.
+
+    Parameters
+    ----------
+    runs : :obj:`list` of :obj:`dict`
+        Runs as returned by :func:`comppsychflows.utils.fmriprep.index_runs`, in the
+        same order for every shard
+    index, n_shards : :obj:`int`
+        As returned by :func:`parse_shard`
+
+    Returns
+    -------
+    runs : :obj:`list` of :obj:`dict`
+
+    """
+    shards = assign_shards([run_cost(run) for run in runs], n_shards)
+    return [run for run, shard in zip(runs, shards) if shard == index]
+
+
+def pack_runs(cpu_hours, mem_gb, job_cpus, job_mem_gb, job_hours):
+    """
+    Pack runs into as few jobs as possible with first-fit decreasing.
+
+    A job runs its runs concurrently on ``job_cpus`` CPUs, so up to ``job_cpus`` of
+    them may run at once. It is full when the CPU hours of its runs reach
+    ``job_cpus * job_hours``, or when the peak memory of the ``job_cpus`` largest of
+    them would exceed ``job_mem_gb``.
+
+    Parameters
+    ----------
+    cpu_hours : :obj:`list` of :obj:`float`
+        Estimated CPU hours of each run
+    mem_gb : :obj:`list` of :obj:`float`
+        Estimated peak memory of each run
+    job_cpus : :obj:`int`
+        CPUs of a job
+    job_mem_gb : :obj:`float`
+        Memory of a job
+    job_hours : :obj:`float`
+        Walltime of a job
+
+    Returns
+    -------
+    jobs : :obj:`list` of :obj:`list` of :obj:`int`
+        Indices of the runs of each job, most expensive job first
+
+    Raises
+    ------
+    ValueError
+        When a run cannot fit in a job on its own
+
+    Examples
+    --------
+    >>> pack_runs([3, 1, 2, 2, 4], [1] * 5, job_cpus=2, job_mem_gb=4, job_hours=3)
+    [[4, 2], [0, 3, 1]]
+    >>> pack_runs([3, 1, 2, 2, 4], [2, 1, 2, 2, 2], job_cpus=2, job_mem_gb=3, job_hours=3)
+    [[4, 1], [0], [2], [3]]
+
+    """
+    capacity = job_cpus * job_hours
+    for run, (hours, mem) in enumerate(zip(cpu_hours, mem_gb)):
+        if hours > capacity or mem > job_mem_gb:
+            raise ValueError('run %d needs %.1f CPU hours and %.1f GB, more than a job '
+                             'provides (%.1f CPU hours, %.1f GB)' % (
+                                 run, hours, mem, capacity, job_mem_gb))
+
+    def concurrent_gb(runs):
+        return sum(sorted((mem_gb[run] for run in runs), reverse=True)[:job_cpus])
+
+    jobs, loads = [], []
+    for run in sorted(range(len(cpu_hours)), key=lambda run: (-cpu_hours[run], run)):
+        for job, load in enumerate(loads):
+            if (load + cpu_hours[run] <= capacity
+                    and concurrent_gb(jobs[job] + [run]) <= job_mem_gb):
+                jobs[job].append(run)
+                loads[job] += cpu_hours[run]
+                break
+        else:
+            jobs.append([run])
+            loads.append(cpu_hours[run])
+    return jobs
@@ -0,0 +1,107 @@
+"""Label-wise summary statistics shared by the numpy statistics engines"""
+import numpy as np
+
+
+def label_moments(data, labels, minlength=0):
+    """
+    Count, mean and sum of squared deviations of ``data`` grouped by label.
+
+    Every value in a row of ``data`` belongs to the label of that row. The
+    deviations are taken about each label's own mean, so the result does not
+    suffer from the cancellation of the naive sum of squares.
+
+    Parameters
+    ----------
+    data : :obj:`numpy.ndarray`
+        (voxels x time) array
+    labels : :obj:`numpy.ndarray`
+        Non-negative integer label of each row of ``data``
+    minlength : :obj:`int`
+        Minimum length of the returned arrays (usually ``labels.max() + 1``)
+
+    Returns
+    -------
+    count, mean, m2 : :obj:`numpy.ndarray`
+        Number of values, mean and sum of squared deviations from the mean,
+        indexed by label
+
+    Examples
+    --------
+    >>> count, mean, m2 = label_moments(np.array([[1., 3.], [5., 7.], [2., 2.]]),
+    ...                                 np.array([1, 1, 2]))
+    >>> count.tolist(), mean.tolist(), m2.tolist()
+    ([0.0, 4.0, 2.0], [0.0, 4.0, 2.0], [0.0, 20.0, 0.0])
+
+    """
+    data = np.asarray(data, dtype=np.float64).reshape(len(labels), -1)
+    minlength = max(minlength, int(labels.max()) + 1 if len(labels) else 0)
+    count = np.bincount(labels, minlength=minlength) * float(data.shape[1])
+    total = np.bincount(labels, weights=data.sum(axis=1), minlength=minlength)
+    mean = np.divide(total, count, out=np.zeros(minlength), where=count > 0)
+    deviation = data - mean[labels, np.newaxis]
+    m2 = np.bincount(labels, weights=np.einsum('ij,ij->i', deviation, deviation),
+                     minlength=minlength)
+    return count, mean, m2
+
+
+def combine_moments(first, second):
+    """
+    Merge two sets of label moments computed on disjoint parts of the data.
+
+    Uses the pairwise update of Chan, Golub & LeVeque, which keeps the sum of
+    squared deviations accurate when chunks are accumulated one at a time.
+
+    Parameters
+    ----------
+    first, second : :obj:`tuple`
+        ``(count, mean, m2)`` as returned by :func:`label_moments`
+
+    Returns
+    -------
+    count, mean, m2 : :obj:`numpy.ndarray`
+        Moments of the union of both parts
+
+    Examples
+    --------
+    >>> data, labels = np.arange(12.).reshape(6, 2), np.array([1, 2, 1, 2, 1, 1])
+    >>> merged = combine_moments(label_moments(data[:, :1], labels),
+    ...                          label_moments(data[:, 1:], labels, minlength=3))
+    >>> [np.allclose(a, b) for a, b in zip(merged, label_moments(data, labels))]
+    [True, True, True]
+
+    """
+    n_a, mean_a, m2_a = first
+    n_b, mean_b, m2_b = second
+    size = max(len(n_a), len(n_b))
+    n_a, mean_a, m2_a = (np.pad(arr, (0, size - len(arr))) for arr in (n_a, mean_a, m2_a))
+    n_b, mean_b, m2_b = (np.pad(arr, (0, size - len(arr))) for arr in (n_b, mean_b, m2_b))
+    count = n_a + n_b
+    delta = mean_b - mean_a
+    weight = np.divide(n_b, count, out=np.zeros(size), where=count > 0)
+    mean = mean_a + delta * weight
+    m2 = m2_a + m2_b + delta ** 2 * n_a * weight
+    return count, mean, m2
+
+
+def grand_std_table(count, m2):
+    """
+    Build the ``grand_std`` table written by ``roi_grand_std``.
+
+    Parameters
+    ----------
+    count, m2 : :obj:`numpy.ndarray`
+        Label moments as returned by :func:`label_moments`
+
+    Returns
+    -------
+    grand_stats : :obj:`pandas.DataFrame`
+        Population standard deviation of every label that has any values,
+        indexed by ``oseg``
+
+    """
+    import pandas as pd
+
+    present = np.flatnonzero(count > 0)
+    grand_stats = pd.DataFrame({'grand_std': np.sqrt(m2[present] / count[present])},
+                               index=pd.Index(present, name='oseg'))
+    return grand_stats
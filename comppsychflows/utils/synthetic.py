@@ -0,0 +1,292 @@
+"""Write small fmriprep-like datasets to benchmark and tune the workflows without real data"""
+import json
+from pathlib import Path
+
+import numpy as np
+
+from .fmriprep import _ANAT_PATHS, _FUNC_WD_PATHS
+
+# Voxel sizes (mm) of the synthetic bold and template grids
+BOLD_ZOOM = 3.0
+TEMPLATE_ZOOM = 2.0
+
+
+def _centered_affine(shape, zoom):
+    """RAS affine of a grid of ``shape`` voxels of ``zoom`` mm centered on the origin"""
+    affine = np.diag([zoom, zoom, zoom, 1.0])
+    affine[:3, 3] = -zoom * (np.asarray(shape[:3]) - 1) / 2
+    return affine
+
+
+def _brain_mask(shape):
+    """Ellipsoid filling most of a grid of ``shape`` voxels"""
+    grid = np.meshgrid(*[np.linspace(-1, 1, size) for size in shape[:3]], indexing='ij')
+    return sum(axis ** 2 for axis in grid) < 0.8
+
+
+def make_dseg(shape, n_labels):
+    """
+    Parcellate the brain mask of a grid into up to ``n_labels`` labels of similar size.
+
+    Parameters
+    ----------
+    shape : :obj:`tuple`
+        Grid shape
+    n_labels : :obj:`int`
+        Number of labels
+
+    Returns
+    -------
+    dseg : :obj:`numpy.ndarray`
+        int16 labels, 0 outside the brain
+
+    Examples
+    --------
+    >>> dseg = make_dseg((20, 20, 20), 8)
+    >>> int(dseg.max()), bool(dseg[10, 10, 10] > 0), int(dseg[0, 0, 0])
+    (8, True, 0)
+
+    """
+    mask = _brain_mask(shape)
+    # Split each axis into more cells until at least n_labels of them touch the mask
+    n_cells = max(1, int(np.ceil(n_labels ** (1 / 3))))
+    while True:
+        cells = [np.minimum(np.arange(size) * n_cells // size, n_cells - 1)
+                 for size in shape[:3]]
+        cell = (cells[0][:, None, None] * n_cells + cells[1][None, :, None]) * n_cells \
+            + cells[2][None, None, :]
+        # Number the cells that touch the mask consecutively
+        _, labels = np.unique(cell[mask], return_inverse=True)
+        if labels.max() + 1 >= n_labels or n_cells >= max(shape[:3]):
+            break
+        n_cells += 1
+    # Merge the extra cells so that labels run from 1 to n_labels
+    dseg = np.zeros(shape[:3], dtype=np.int16)
+    dseg[mask] = labels * n_labels // (labels.max() + 1) + 1
+    return dseg
+
+
+def make_bold(shape, seed=0):
+    """
+    A bold-like int16 series: a brain with a mean of ~1000 and 1% noise.
+
+    Parameters
+    ----------
+    shape : :obj:`tuple`
+        4D shape of the series
+    seed : :obj:`int`
+        Seed of the noise
+
+    Returns
+    -------
+    bold : :obj:`numpy.ndarray`
+
+    """
+    rng = np.random.default_rng(seed)
+    mean = np.where(_brain_mask(shape), 1000.0, 20.0).astype(np.float32)
+    bold = np.empty(shape, dtype=np.int16)
+    for vol in range(shape[3]):
+        noise = rng.standard_normal(shape[:3], dtype=np.float32) * (0.01 * mean)
+        bold[..., vol] = np.rint(mean + noise)
+    return bold
+
+
+def write_itk_affines(out_file, matrices, transform_type='MatrixOffsetTransformBase_double_3_3'):
+    """
+    Write affines as an ITK text transform file (one ``#Transform`` per matrix).
+
+    Parameters
+    ----------
+    out_file : pathlike
+    matrices : :obj:`list` of :obj:`numpy.ndarray`
+        4x4 affines in ITK's LPS convention
+    transform_type : :obj:`str`
+        ITK transform class written for each matrix
+
+    """
+    lines = ['#Insight Transform File V1.0']
+    for idx, matrix in enumerate(matrices):
+        params = list(np.asarray(matrix)[:3, :3].ravel()) + list(np.asarray(matrix)[:3, 3])
+        lines += ['#Transform %d' % idx,
+                  'Transform: %s' % transform_type,
+                  'Parameters: %s' % ' '.join('%.10g' % param for param in params),
+                  'FixedParameters: 0 0 0']
+    Path(out_file).write_text('\n'.join(lines) + '\n')
+
+
+def write_composite_h5(out_file, affine, field_shape=(10, 12, 10), field_zoom=20.0,
+                       max_displacement=1.0, seed=0):
+    """
+    Write an ANTs composite transform (affine then displacement field) as ITK HDF5.
+
+    Mimics the ``from-MNI152NLin2009cAsym_to-T1w_mode-image_xfm.h5`` of fmriprep with
+    a coarse, smooth displacement field.
+
+    Parameters
+    ----------
+    out_file : pathlike
+    affine : :obj:`numpy.ndarray`
+        4x4 affine in ITK's LPS convention
+    field_shape : :obj:`tuple`
+        Grid of the displacement field
+    field_zoom : :obj:`float`
+        Spacing (mm) of the displacement field
+    max_displacement : :obj:`float`
+        Largest displacement (mm)
+    seed : :obj:`int`
+
+    """
+    import h5py
+
+    rng = np.random.default_rng(seed)
+    # One random sinusoid per axis keeps the field smooth and invertible
+    grid = np.meshgrid(*[np.linspace(0, np.pi, size) for size in field_shape], indexing='ij')
+    phases = rng.uniform(0, np.pi, size=3)
+    field = np.stack([max_displacement * np.sin(grid[axis] + phases[axis]) for axis in range(3)],
+                     axis=-1)
+    # ITK stores the vectors with the first axis varying fastest
+    field = field.transpose(2, 1, 0, 3).astype(np.float64)
+    origin = -field_zoom * (np.asarray(field_shape) - 1) / 2
+    fixed = np.concatenate([field_shape, origin, [field_zoom] * 3, np.eye(3).ravel()])
+
+    with h5py.File(out_file, 'w') as h5:
+        group = h5.create_group('TransformGroup')
+        group.create_group('0')['TransformType'] = [b'CompositeTransform_double_3_3']
+        xfm = group.create_group('1')
+        xfm['TransformType'] = [b'AffineTransform_double_3_3']
+        xfm['TransformParameters'] = np.concatenate(
+            [np.asarray(affine)[:3, :3].ravel(), np.asarray(affine)[:3, 3]])
+        xfm['TransformFixedParameters'] = np.zeros(3)
+        warp = group.create_group('2')
+        warp['TransformType'] = [b'DisplacementFieldTransform_float_3_3']
+        warp['TransformParameters'] = field.ravel()
+        warp['TransformFixedParameters'] = fixed.astype(np.float64)
+
+
+def make_template(out_dir, shape=(80, 96, 80), n_labels=400):
+    """
+    Write a synthetic template and parcellation standing in for MNI space ones.
+
+    Parameters
+    ----------
+    out_dir : pathlike
+    shape : :obj:`tuple`
+        Template grid (2mm voxels)
+    n_labels : :obj:`int`
+        Number of labels of the parcellation
+
+    Returns
+    -------
+    template_file, dseg_file : :obj:`str`
+
+    """
+    import nibabel as nb
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    affine = _centered_affine(shape, TEMPLATE_ZOOM)
+    template = np.where(_brain_mask(shape), 100.0, 0.0).astype(np.float32)
+    template_file = out_dir / 'tpl-synthetic_res-02_T1w.nii.gz'
+    dseg_file = out_dir / 'tpl-synthetic_res-02_atlas-synthetic_dseg.nii.gz'
+    nb.Nifti1Image(template, affine).to_filename(str(template_file))
+    nb.Nifti1Image(make_dseg(shape, n_labels), affine).to_filename(str(dseg_file))
+    return template_file.as_posix(), dseg_file.as_posix()
+
+
+def make_fmriprep_dataset(out_dir, shape=(64, 64, 40, 120), n_subjects=1, n_runs=1,
+                          sdc=False, split=False, template_shape=(80, 96, 80),
+                          motion=0.5, seed=0):
+    """
+    Write an fmriprep output and working directory with everything mnitobold reads.
+
+    Each run gets a bids bold (3mm voxels) and, in its func working directory,
+    the validate result pointing to it, a reference, per-volume head motion
+    affines (``mat2itk.txt``), an identity T1w to bold affine, optionally a zero
+    Qwarp warp (``sdc``) and the split volumes (``split``). Each subject gets a
+    T1w on the template grid and a composite MNI to T1w transform with a small
+    displacement field.
+
+    Parameters
+    ----------
+    out_dir : pathlike
+        Directory to create ``bids``, ``out`` and ``wrk`` in
+    shape : :obj:`tuple`
+        4D shape of each bold
+    n_subjects, n_runs : :obj:`int`
+        Number of subjects and of runs per subject
+    sdc : :obj:`bool`
+        Write a Qwarp warp so that the SDC transform is applied
+    split : :obj:`bool`
+        Write fmriprep's ``bold_split`` volumes
+    template_shape : :obj:`tuple`
+        Grid of the T1w (2mm voxels), matching the template of :func:`make_template`
+    motion : :obj:`float`
+        Largest head motion translation (mm)
+    seed : :obj:`int`
+
+    Returns
+    -------
+    fmriprep_dir : :obj:`str`
+        Directory to pass to mnitobold
+
+    """
+    import nibabel as nb
+
+    rng = np.random.default_rng(seed)
+    out_dir = Path(out_dir)
+    fmriprep_odir = out_dir / 'out'
+    bold_affine = _centered_affine(shape, BOLD_ZOOM)
+    t1w_affine = _centered_affine(template_shape, TEMPLATE_ZOOM)
+
+    for sub_idx in range(n_subjects):
+        subject = '%02d' % (sub_idx + 1)
+        anat = {key: fmriprep_odir / rel_path.format(subject=subject)
+                for key, rel_path in _ANAT_PATHS.items()}
+        anat['t1w_ref'].parent.mkdir(parents=True, exist_ok=True)
+        t1w = np.where(_brain_mask(template_shape), 100.0, 0.0).astype(np.float32)
+        nb.Nifti1Image(t1w, t1w_affine).to_filename(str(anat['t1w_ref']))
+        write_composite_h5(anat['mni_to_t1'], np.eye(4), seed=seed + sub_idx)
+
+        for run_idx in range(n_runs):
+            entities = 'sub-%s_task-rest_run-%d' % (subject, run_idx + 1)
+            bids_func = out_dir / 'bids' / ('sub-' + subject) / 'func'
+            bids_func.mkdir(parents=True, exist_ok=True)
+            bold_file = bids_func / (entities + '_bold.nii.gz')
+            bold = make_bold(shape, seed=seed + 1000 * sub_idx + run_idx)
+            bold_img = nb.Nifti1Image(bold, bold_affine)
+            bold_img.header.set_xyzt_units('mm', 'sec')
+            bold_img.header['pixdim'][4] = 2.0
+            bold_img.to_filename(str(bold_file))
+
+            func_wd = (out_dir / 'wrk' / 'fmriprep_wf' / ('single_subject_%s_wf' % subject)
+                       / ('func_preproc_task_rest_run_%d_wf' % (run_idx + 1)))
+            paths = {key: func_wd / rel_path for key, rel_path in _FUNC_WD_PATHS.items()}
+            for path in paths.values():
+                path.parent.mkdir(parents=True, exist_ok=True)
+            paths['validate_dir'].mkdir(exist_ok=True)
+            # nipype's hashed inputs of the validate node: [[name, [path, hash]], ...]
+            (paths['validate_dir'] / '_0x00000000000000000000000000000000.json').write_text(
+                json.dumps([['in_file', [bold_file.as_posix(), '0' * 32]]]))
+
+            ref = bold[..., 0].astype(np.float32)
+            nb.Nifti1Image(ref, bold_affine).to_filename(str(paths['ref']))
+            hmc = []
+            for _ in range(shape[3]):
+                matrix = np.eye(4)
+                matrix[:3, 3] = rng.uniform(-motion, motion, size=3)
+                hmc.append(matrix)
+            write_itk_affines(paths['hmc_transform'], hmc)
+            write_itk_affines(paths['t1_to_bold'], [np.eye(4)], 'AffineTransform_double_3_3')
+            if sdc:
+                # 3dQwarp writes its warps as a 5D (x, y, z, 1, 3) displacement field
+                warp = np.zeros(shape[:3] + (1, 3), dtype=np.float32)
+                warp_img = nb.Nifti1Image(warp, bold_affine)
+                warp_img.header.set_intent('vector')
+                warp_img.to_filename(str(paths['sdc']))
+            if split:
+                paths['split_bolds_dir'].mkdir(exist_ok=True)
+                for vol in range(shape[3]):
+                    nb.Nifti1Image(bold[..., vol], bold_affine).to_filename(
+                        str(paths['split_bolds_dir'] / ('vol%04d.nii.gz' % vol)))
+
+    return out_dir.as_posix()
@@ -1,14 +1,21 @@
-from nipype.pipeline import engine as pe
-from nipype.interfaces import utility as niu
-from niworkflows.engine.workflows import LiterateWorkflow as Workflow
-from niworkflows.interfaces import CopyHeader
-from nipype.interfaces import afni
-from sdcflows.workflows.pepolar import _fix_hdr
-from templateflow.api import get as get_template
+"""Workflows that bring MNI space images into head motion corrected bold space"""
+from functools import lru_cache
+
+# nipype, niworkflows and sdcflows are imported by each builder so that importing
+# this module (e.g. for ``comppsychflows-mnitobold --help``) stays cheap
+
+
+@lru_cache(maxsize=None)
+def _afni_version():
+    """AFNI version as reported by ``afni.Info``, from the cached environment probe"""
+    from ..utils.environment import tool_version
+
+    return ''.join(['%02d' % v for v in tool_version('afni') or []])
 
 
 def init_qwarp_inversion_wf(omp_nthreads=1,
-                           name="qwarp_invert_wf"):
+                           name="qwarp_invert_wf",
+                           use_compression=True):
     """
     Invert a warp produced by 3dqwarp and convert it to an ANTS formatted warp
     Workflow Graph
@@ -23,6 +30,8 @@ def init_qwarp_inversion_wf(omp_nthreads=1,
         Name for this workflow
     omp_nthreads : int
         Parallelize internal tasks across the number of CPUs given by this option.
+    use_compression : bool
+        Write the inverted warp as ``.nii.gz`` (default) or as uncompressed ``.nii``
     Inputs
     ------
     warp : pathlike
@@ -35,11 +44,16 @@ def init_qwarp_inversion_wf(omp_nthreads=1,
         The corresponding inverted :abbr:`DFM (displacements field map)` compatible with
         ANTs.
     """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+    from niworkflows.engine.workflows import LiterateWorkflow as Workflow
+    from niworkflows.interfaces import CopyHeader
+    from sdcflows.workflows.pepolar import _fix_hdr
     from ..interfaces.afni import InvertWarp
     workflow = Workflow(name=name)
     workflow.__desc__ = """\
 A warp produced by 3dQwarp was inverted by `3dNwarpCat` @afni (AFNI {afni_ver}).
-""".format(afni_ver=''.join(['%02d' % v for v in afni.Info().version() or []]))
+""".format(afni_ver=_afni_version())
 
     inputnode = pe.Node(niu.IdentityInterface(
         fields=['warp', 'in_reference']), name='inputnode')
@@ -49,7 +63,7 @@ A warp produced by 3dQwarp was inverted by `3dNwarpCat` @afni (AFNI {afni_ver}).
         name='outputnode')
 
     invert = pe.Node(InvertWarp(), name='invert', n_procs=omp_nthreads)
-    invert.inputs.outputtype = 'NIFTI_GZ'
+    invert.inputs.outputtype = 'NIFTI_GZ' if use_compression else 'NIFTI'
     to_ants = pe.Node(niu.Function(function=_fix_hdr), name='to_ants',
                       mem_gb=0.01)
 
@@ -70,7 +84,8 @@ def init_apply_hmc_only_wf(mem_gb, omp_nthreads,
                                name='apply_hmc_only',
                                use_compression=True,
                                split_file=False,
-                               interpolation='LanczosWindowedSinc'):
+                               interpolation='LanczosWindowedSinc',
+                               in_memory=False):
     """
     Resample in native (original) space.
     This workflow resamples the input fMRI in its native (original)
@@ -83,12 +98,19 @@ def init_apply_hmc_only_wf(mem_gb, omp_nthreads,
         Maximum number of threads an individual process may use
     name : :obj:`str`
         Name of workflow (default: ``bold_std_trans_wf``)
+    use_compression : :obj:`bool`
+        Write the split, transformed and merged bold as ``.nii.gz`` (default)
+        or as uncompressed ``.nii``
     split_file : :obj:`bool`
         Whether the input file should be splitted (it is a 4D file)
         or it is a list of 3D files (default ``False``, do not split)
     interpolation : :obj:`str`
         Interpolation type to be used by ANTs' ``applyTransforms``
         (default ``'LanczosWindowedSinc'``)
+    in_memory : :obj:`bool`
+        Resample the 4D ``bold_file`` in a single node with cubic splines instead of
+        splitting it, running ``antsApplyTransforms`` per volume and merging
+        (``split_file`` and ``interpolation`` are ignored, default ``False``)
     Inputs
     ------
     bold_file
@@ -103,11 +125,13 @@ def init_apply_hmc_only_wf(mem_gb, omp_nthreads,
     bold
         BOLD series, resampled in native space, including all preprocessing
     """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
     from niworkflows.engine.workflows import LiterateWorkflow as Workflow
-    from niworkflows.func.util import init_bold_reference_wf
     from niworkflows.interfaces.itk import MultiApplyTransforms
     from niworkflows.interfaces.nilearn import Merge
     from nipype.interfaces.fsl import Split as FSLSplit
+    from ..interfaces.itk import SeriesApplyTransforms
 
     workflow = Workflow(name=name)
     workflow.__desc__ = """\
@@ -128,6 +152,22 @@ the transforms to correct for head-motion""")
         niu.IdentityInterface(fields=['bold']),
         name='outputnode')
 
+    if in_memory:
+        # Named like the merged output of the split/transform/merge chain so that
+        # the names of downstream outputs do not depend on the resampling engine
+        bold_resample = pe.Node(
+            SeriesApplyTransforms(
+                num_threads=omp_nthreads,
+                out_file='vol0000_xform-00000_merged.nii%s' % ('.gz' if use_compression else '')),
+            name='bold_resample', mem_gb=mem_gb * 3, n_procs=omp_nthreads)
+        workflow.connect([
+            (inputnode, bold_resample, [('bold_file', 'in_file'),
+                                        ('hmc_xforms', 'transforms'),
+                                        ('name_source', 'header_source')]),
+            (bold_resample, outputnode, [('out_file', 'bold')]),
+        ])
+        return workflow
+
     bold_transform = pe.Node(
         MultiApplyTransforms(interpolation=interpolation, float=True, copy_dtype=True),
         name='bold_transform', mem_gb=mem_gb * 3 * omp_nthreads, n_procs=omp_nthreads)
@@ -143,7 +183,9 @@ the transforms to correct for head-motion""")
 
     # Input file is not splitted
     if split_file:
-        bold_split = pe.Node(FSLSplit(dimension='t'), name='bold_split',
+        bold_split = pe.Node(FSLSplit(dimension='t',
+                                      output_type='NIFTI_GZ' if use_compression else 'NIFTI'),
+                             name='bold_split',
                              mem_gb=mem_gb * 3)
         workflow.connect([
             (inputnode, bold_split, [('bold_file', 'in_file')]),
@@ -172,7 +214,10 @@ def _first(inlist):
 
 def init_backtransform_wf(mem_gb, omp_nthreads,
                                name='backtransform',
-                               interpolation='LanczosWindowedSinc'):
+                               interpolation='LanczosWindowedSinc',
+                               stats_engine='afni',
+                               from_t1w=False,
+                               outputs=None):
     """
     Transform standard space images back to bold_hmc space
     and extract roi level stats for each tr.
@@ -187,6 +232,16 @@ def init_backtransform_wf(mem_gb, omp_nthreads,
     interpolation : :obj:`str`
         Interpolation type to be used by ANTs' ``applyTransforms``
         (default ``'LanczosWindowedSinc'``)
+    stats_engine : :obj:`str`
+        Compute roi stats with AFNI's ``3dROIstats`` (``'afni'``, default) or with
+        an in-process sparse label matrix product (``'numpy'``)
+    from_t1w : :obj:`bool`
+        ``template_file`` and ``dseg_file`` were already resampled into T1w space
+        (see :func:`init_subject_template_wf`), so they are only resampled with
+        ``run_transforms`` (default ``False``, resample with the combined transform)
+    outputs : :obj:`list` of :obj:`str`
+        Fields of ``outputnode`` to compute; nodes that none of them need are not
+        built (default ``None``, all of them)
     Inputs
     ------
     template_file
@@ -199,6 +254,8 @@ def init_backtransform_wf(mem_gb, omp_nthreads,
         bold image to extract stats from
     transforms
         list of transformations for registration from template space to bold space
+    run_transforms
+        list of transformations from T1w space to bold space (only with ``from_t1w``)
     Outputs
     -------
     combined_transforms
@@ -211,14 +268,18 @@ def init_backtransform_wf(mem_gb, omp_nthreads,
         stats on each roi from each tr
 
     """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
     from niworkflows.engine.workflows import LiterateWorkflow as Workflow
     from niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
     from nipype.interfaces.afni.preprocess import ROIStats
+    from ..interfaces.stats import SparseROIStats
     
     workflow = Workflow(name=name)
 
     inputnode = pe.Node(niu.IdentityInterface(fields=[
-        'template_file', 'reference_image','dseg_file', 'bold_file', 'transforms']),
+        'template_file', 'reference_image','dseg_file', 'bold_file', 'transforms',
+        'run_transforms']),
         name='inputnode'
     )
 
@@ -229,47 +290,158 @@ def init_backtransform_wf(mem_gb, omp_nthreads,
                                       'roi_stats']),
         name='outputnode')
 
-    combine_transforms = pe.Node(
-        ApplyTransforms(interpolation=interpolation,
-            float=True,
-            print_out_composite_warp_file=True,
-            output_image = 'MNItohmcbold.nii.gz'),
-        name='combine_transforms', mem_gb=mem_gb, n_procs=omp_nthreads)
+    fields = set(outputs) if outputs is not None else {
+        'combined_transforms', 'transformed_template', 'transformed_dseg', 'roi_stats'}
+    # Nodes are only built when some requested output depends on them
+    need_dseg = fields & {'transformed_dseg', 'roi_stats'}
+    need_combined = 'combined_transforms' in fields or (
+        not from_t1w and (need_dseg or 'transformed_template' in fields))
+
+    if need_combined:
+        combine_transforms = pe.Node(
+            ApplyTransforms(interpolation=interpolation,
+                float=True,
+                print_out_composite_warp_file=True,
+                output_image = 'MNItohmcbold.nii.gz'),
+            name='combine_transforms', mem_gb=mem_gb, n_procs=omp_nthreads)
+        workflow.connect([
+            (inputnode, combine_transforms, [('transforms', 'transforms')]),
+            (inputnode, combine_transforms, [('reference_image', 'reference_image')]),
+            (inputnode, combine_transforms, [('template_file', 'input_image')]),
+            (combine_transforms, outputnode, [('output_image', 'combined_transforms')]),
+        ])
+
+    # The combined transform may still be written for the sinker, but images
+    # already in T1w space only need the short T1w to bold chain
+    if from_t1w:
+        xforms_node, xforms_field = inputnode, 'run_transforms'
+    elif need_combined:
+        xforms_node, xforms_field = combine_transforms, 'output_image'
+
+    if 'transformed_template' in fields:
+        resample_template = pe.Node(
+            ApplyTransforms(interpolation=interpolation, float=True,),
+            name='resample_template', mem_gb=mem_gb, n_procs=omp_nthreads)
+        workflow.connect([
+            (inputnode, resample_template, [('template_file', 'input_image')]),
+            (inputnode, resample_template, [('reference_image', 'reference_image')]),
+            (xforms_node, resample_template, [(xforms_field, 'transforms')]),
+            (resample_template, outputnode, [('output_image', 'transformed_template')]),
+        ])
+
+    if need_dseg:
+        resample_parc = pe.Node(ApplyTransforms(
+            dimension=3,
+            interpolation='MultiLabel'),
+            name='resample_parc', mem_gb=mem_gb, n_procs=omp_nthreads)
+        workflow.connect([
+            (inputnode, resample_parc, [('reference_image', 'reference_image')]),
+            (inputnode, resample_parc, [('dseg_file', 'input_image')]),
+            (xforms_node, resample_parc, [(xforms_field, 'transforms')]),
+            (resample_parc, outputnode, [('output_image', 'transformed_dseg')]),
+        ])
+
+    if 'roi_stats' in fields:
+        if stats_engine == 'numpy':
+            roi_stats = pe.Node(SparseROIStats(stat=['mean', 'sigma', 'median', 'sum', 'voxels']),
+                                name='roi_stats', mem_gb=mem_gb)
+        else:
+            roi_stats = pe.Node(ROIStats(stat=['mean', 'sigma', 'median', 'sum', 'voxels']),
+                               name='roi_stats', mem_gb=mem_gb, n_procs=omp_nthreads)
+        workflow.connect([
+            (inputnode, roi_stats, [('bold_file', 'in_file')]),
+            (resample_parc, roi_stats, [('output_image', 'mask_file')]),
+            (roi_stats, outputnode, [('out_file', 'roi_stats')]),
+        ])
+
+    return workflow
+
+def init_subject_template_wf(mem_gb, omp_nthreads,
+                             name='mni_to_t1w',
+                             interpolation='LanczosWindowedSinc'):
+    """
+    Resample the template and segmentation into a subject's T1w space once.
+
+    Every run of the subject then only resamples the T1w space images with its own
+    T1w to bold (and SDC) transforms. The nodes hash their inputs by content so a
+    rerun, or a new run of the same subject, reuses the cached resampling as long
+    as the template, the segmentation and the MNI to T1w transform are unchanged.
+
+    Parameters
+    ----------
+    mem_gb : :obj:`float`
+        Size of BOLD file in GB
+    omp_nthreads : :obj:`int`
+        Maximum number of threads an individual process may use
+    name : :obj:`str`
+        Name of workflow (default: ``mni_to_t1w``)
+    interpolation : :obj:`str`
+        Interpolation type to be used by ANTs' ``applyTransforms`` for the template
+        (default ``'LanczosWindowedSinc'``)
+    Inputs
+    ------
+    template_file
+        template file in standard space
+    dseg_file
+        deterministic parcelated file in standard space
+    reference_image
+        T1w image defining the output grid
+    mni_to_t1
+        transformation from standard space to T1w space
+    Outputs
+    -------
+    t1w_template
+        template resampled into T1w space
+    t1w_dseg
+        dseg resampled into T1w space
+
+    """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
+    from niworkflows.engine.workflows import LiterateWorkflow as Workflow
+    from niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
+
+    workflow = Workflow(name=name)
 
-    resample_template = pe.Node(
-        ApplyTransforms(interpolation=interpolation, float=True,),
-        name='resample_template', mem_gb=mem_gb, n_procs=omp_nthreads)
+    inputnode = pe.Node(niu.IdentityInterface(fields=[
+        'template_file', 'dseg_file', 'reference_image', 'mni_to_t1']),
+        name='inputnode'
+    )
 
-    resample_parc = pe.Node(ApplyTransforms(
+    outputnode = pe.Node(
+        niu.IdentityInterface(fields=['t1w_template', 't1w_dseg']),
+        name='outputnode')
+
+    template_to_t1w = pe.Node(
+        ApplyTransforms(interpolation=interpolation, float=True),
+        name='template_to_t1w', mem_gb=mem_gb, n_procs=omp_nthreads)
+
+    dseg_to_t1w = pe.Node(ApplyTransforms(
         dimension=3,
         interpolation='MultiLabel'),
-        name='resample_parc', mem_gb=mem_gb, n_procs=omp_nthreads)
-    
-    roi_stats = pe.Node(ROIStats(stat=['mean', 'sigma', 'median', 'sum', 'voxels']),
-                       name='roi_stats', mem_gb=mem_gb, n_procs=omp_nthreads)
-    
+        name='dseg_to_t1w', mem_gb=mem_gb, n_procs=omp_nthreads)
+
+    # Only the config of the workflow that is run reaches the nodes, so the hash
+    # method is set on each node; their config is merged over the run's
+    for node in (template_to_t1w, dseg_to_t1w):
+        node.config = {'execution': {'hash_method': 'content'}}
+
     workflow.connect([
-        (inputnode, combine_transforms, [('transforms', 'transforms')]),
-        (inputnode, combine_transforms, [('reference_image', 'reference_image')]),
-        (inputnode, combine_transforms, [('template_file', 'input_image')]),
-        (inputnode, resample_template, [('template_file', 'input_image')]),
-        (inputnode, resample_template, [('reference_image', 'reference_image')]),
-        (inputnode, resample_parc, [('reference_image', 'reference_image')]),
-        (inputnode, resample_parc, [('dseg_file', 'input_image')]),
-        (inputnode, roi_stats, [('bold_file', 'in_file')]),
-        (combine_transforms, resample_template, [('output_image', 'transforms')]),
-        (combine_transforms, resample_parc, [('output_image', 'transforms')]),
-        (resample_parc, roi_stats, [('output_image', 'mask_file')]),
-        (combine_transforms, outputnode, [('output_image', 'combined_transforms')]),
-        (resample_template, outputnode, [('output_image', 'transformed_template')]),
-        (resample_parc, outputnode, [('output_image', 'transformed_dseg')]),
-        (roi_stats, outputnode, [('out_file', 'roi_stats')]),
+        (inputnode, template_to_t1w, [('template_file', 'input_image'),
+                                      ('reference_image', 'reference_image'),
+                                      ('mni_to_t1', 'transforms')]),
+        (inputnode, dseg_to_t1w, [('dseg_file', 'input_image'),
+                                  ('reference_image', 'reference_image'),
+                                  ('mni_to_t1', 'transforms')]),
+        (template_to_t1w, outputnode, [('output_image', 't1w_template')]),
+        (dseg_to_t1w, outputnode, [('output_image', 't1w_dseg')]),
     ])
-    
+
     return workflow
 
+
 def init_scale_wf(mem_gb, omp_nthreads, n_dummy=None, scale_stat='mean',
-                               name='scale'):
+                               name='scale', use_compression=True):
     """
     Run afni's voxel level mean scaling
     Parameters
@@ -284,6 +456,8 @@ def init_scale_wf(mem_gb, omp_nthreads, n_dummy=None, scale_stat='mean',
         Name of the flag for the statistic to scale relative to (defaul: ``mean``) 
     name : :obj:`str`
         Name of workflow (default: ``bold_std_trans_wf``)
+    use_compression : :obj:`bool`
+        Write outputs as ``.nii.gz`` (default) or as uncompressed ``.nii``
     Inputs
     ------
     bold_file
@@ -293,8 +467,9 @@ def init_scale_wf(mem_gb, omp_nthreads, n_dummy=None, scale_stat='mean',
     scaled
         scaled bold time series
     """
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
     from niworkflows.engine.workflows import LiterateWorkflow as Workflow
-    from niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
     from nipype.interfaces.afni import Calc
     from ..interfaces.afni import TStat 
     
@@ -309,12 +484,13 @@ def init_scale_wf(mem_gb, omp_nthreads, n_dummy=None, scale_stat='mean',
         niu.IdentityInterface(fields=['scaled']),
         name='outputnode')
 
+    outputtype = 'NIFTI_GZ' if use_compression else 'NIFTI'
     scale_ref = pe.Node(
-        TStat(args=f'-{scale_stat}', index=f'[{n_dummy}..$]', outputtype='NIFTI_GZ'),
+        TStat(args=f'-{scale_stat}', index=f'[{n_dummy}..$]', outputtype=outputtype),
         name='scale_ref', mem_gb=mem_gb, n_procs=omp_nthreads)
 
     scale = pe.Node(
-        Calc(outputtype='NIFTI_GZ', expr='min(200, a/b*100)*step(a)*step(b)'),
+        Calc(outputtype=outputtype, expr='min(200, a/b*100)*step(a)*step(b)'),
         name='scale', mem_gb=mem_gb, n_procs=omp_nthreads)
     
     workflow.connect([
@@ -326,7 +502,8 @@ def init_scale_wf(mem_gb, omp_nthreads, n_dummy=None, scale_stat='mean',
     
     return workflow
 
-def init_getstats_wf(mem_gb, omp_nthreads, n_dummy=0, stat='cvarinvNOD',name='getstats'):
+def init_getstats_wf(mem_gb, omp_nthreads, n_dummy=0, stat='cvarinvNOD',name='getstats',
+                     stats_engine='afni', use_compression=True):
     """
     Run some 3dtstat (tsnr by default) and save out roi level stats
     Parameters
@@ -341,6 +518,11 @@ def init_getstats_wf(mem_gb, omp_nthreads, n_dummy=0, stat='cvarinvNOD',name='ge
         Name of the flag for the statistic to extract (defaul: ``tsnr``) 
     name : :obj:`str`
         Name of workflow (default: ``tsnrstats_wf``)
+    stats_engine : :obj:`str`
+        Compute roi stats with AFNI's ``3dROIstats`` (``'afni'``, default) or with
+        an in-process sparse label matrix product (``'numpy'``)
+    use_compression : :obj:`bool`
+        Write the stat image as ``.nii.gz`` (default) or as uncompressed ``.nii``
     Inputs
     ------
     bold_file
@@ -354,10 +536,12 @@ def init_getstats_wf(mem_gb, omp_nthreads, n_dummy=0, stat='cvarinvNOD',name='ge
     roi_stats
         stats on each roi from each tr
     """ 
+    from nipype.pipeline import engine as pe
+    from nipype.interfaces import utility as niu
     from niworkflows.engine.workflows import LiterateWorkflow as Workflow
-    from niworkflows.interfaces.fixes import FixHeaderApplyTransforms as ApplyTransforms
     from ..interfaces.afni import TStat
     from nipype.interfaces.afni.preprocess import ROIStats
+    from ..interfaces.stats import SparseROIStats
 
     workflow = Workflow(name=name)
 
@@ -373,11 +557,16 @@ def init_getstats_wf(mem_gb, omp_nthreads, n_dummy=0, stat='cvarinvNOD',name='ge
         name='outputnode')
 
     getstat = pe.Node(
-        TStat(options=f'-{stat}', index=f'[{n_dummy}..$]', outputtype='NIFTI_GZ'),
+        TStat(options=f'-{stat}', index=f'[{n_dummy}..$]',
+              outputtype='NIFTI_GZ' if use_compression else 'NIFTI'),
         name='getstat', mem_gb=mem_gb, n_procs=omp_nthreads)
 
-    roi_stats = pe.Node(ROIStats(stat=['sum', 'voxels']),
-                   name='roi_stats', mem_gb=mem_gb, n_procs=omp_nthreads)
+    if stats_engine == 'numpy':
+        roi_stats = pe.Node(SparseROIStats(stat=['sum', 'voxels']),
+                            name='roi_stats', mem_gb=mem_gb)
+    else:
+        roi_stats = pe.Node(ROIStats(stat=['sum', 'voxels']),
+                       name='roi_stats', mem_gb=mem_gb, n_procs=omp_nthreads)
 
     workflow.connect([
         (inputnode, getstat, [('bold_file', 'in_file')]),